@@ -0,0 +1,107 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Measures computing and buffering the mutations of a visitor's batch with
+the MutationKernel at several batch sizes:
+
+    python benchmarks/kernel.py --sizes 1,10,100 --batches 200
+"""
+
+import sys
+import os
+import time
+from copy import deepcopy
+from optparse import OptionParser
+from random import Random
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from hiitrack.lib import cassandra
+from hiitrack.lib.cassandra import Buffer
+from hiitrack.models import VisitorModel, EventModel, PropertyValueModel
+from hiitrack.models.kernel import MutationKernel
+from hiitrack.models.visitor import _collapse, _empty_metadata
+
+
+def make_metadata(visitor, random, options):
+    """
+    Metadata of a visitor with history events and a few properties.
+    """
+    metadata = _empty_metadata()
+    models = [[PropertyValueModel("user", "bucket", "p%s" % i, i), 1]
+        for i in range(options.properties)]
+    models.extend([[EventModel(
+        "user",
+        "bucket",
+        "e%s" % random.randint(0, options.events - 1)), 1]
+            for _ in range(options.history)])
+    MutationKernel(visitor).run(models, *metadata)
+    return metadata
+
+
+def make_batches(size, random, options):
+    """
+    Collapsed batches of size random events.
+    """
+    return [_collapse([EventModel(
+        "user",
+        "bucket",
+        "e%s" % random.randint(0, options.events - 1))
+            for _ in range(size)])
+                for _ in range(options.batches)]
+
+
+def kernel(visitor, metadata, models):
+    """
+    Buffer a batch through the kernel.
+    """
+    relations, counters = MutationKernel(visitor).run(models, *metadata)
+    for key, column_id, value in relations:
+        cassandra.BUFFER.insert_relation(key, column_id, value)
+    for key, column_id, value in counters:
+        cassandra.BUFFER.increment_counter(key, column_id, value)
+
+
+def measure(method, visitor, metadata, batches):
+    """
+    Seconds spent buffering batches against copies of the metadata, and
+    the number of buffered columns.
+    """
+    elapsed = 0.0
+    columns = 0
+    for models in batches:
+        cassandra.BUFFER = Buffer()
+        _metadata = deepcopy(metadata)
+        start = time.time()
+        method(visitor, _metadata, models)
+        elapsed += time.time() - start
+        columns += cassandra.BUFFER.size
+    return elapsed, columns
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--sizes", default="1,10,100",
+        help="Comma separated list of events per batch.")
+    parser.add_option("--batches", type="int", default=200)
+    parser.add_option("--events", type="int", default=20)
+    parser.add_option("--history", type="int", default=10,
+        help="Events the visitor has before each batch.")
+    parser.add_option("--properties", type="int", default=2)
+    parser.add_option("--seed", type="int", default=0)
+    options, _ = parser.parse_args()
+    random = Random(options.seed)
+    visitor = VisitorModel("user", "bucket", "visitor")
+    metadata = make_metadata(visitor, random, options)
+    for size in [int(x) for x in options.sizes.split(",")]:
+        batches = make_batches(size, random, options)
+        elapsed, columns = measure(kernel, visitor, metadata, batches)
+        print "%s events: %.3fms per batch, %s columns" % (
+            size,
+            elapsed / options.batches * 1000,
+            columns / options.batches)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,200 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Runs the HiiTrack service in-process and measures ingest and report
+latency and throughput. Several backends can be compared in one run:
+
+    python benchmarks/service.py --backend memory,sqlite,cassandra \
+        --requests 5000 --concurrency 50
+"""
+
+import sys
+import os
+import time
+import tempfile
+import uuid
+import ujson
+from base64 import b64encode
+from optparse import OptionParser
+from random import Random
+from urllib import urlencode
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks, DeferredSemaphore, \
+    DeferredList
+from twisted.web.client import Agent, readBody
+from twisted.web.http_headers import Headers
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), ".."))
+
+from hiitrack import HiiTrack
+from hiitrack.lib.memory import MemoryBackend
+from hiitrack.lib.sqlite import SQLiteBackend
+
+
+AGENT = Agent(reactor)
+
+
+def percentile(values, fraction):
+    """
+    Nearest-rank percentile of a sorted list.
+    """
+    if not values:
+        return 0.0
+    return values[min(len(values) - 1, int(len(values) * fraction))]
+
+
+def report(name, latencies, elapsed):
+    """
+    Print throughput and latency percentiles.
+    """
+    latencies = sorted(latencies)
+    print "%s: %s requests in %.2fs, %.1f/s, p50 %.2fms, p95 %.2fms, " \
+        "p99 %.2fms" % (
+            name,
+            len(latencies),
+            elapsed,
+            len(latencies) / elapsed,
+            percentile(latencies, 0.5) * 1000,
+            percentile(latencies, 0.95) * 1000,
+            percentile(latencies, 0.99) * 1000)
+
+
+@inlineCallbacks
+def timed_request(latencies, method, url, headers=None):
+    """
+    Issue a request and record its latency.
+    """
+    start = time.time()
+    response = yield AGENT.request(method, url, Headers(headers or {}))
+    yield readBody(response)
+    latencies.append(time.time() - start)
+
+
+@inlineCallbacks
+def run_requests(name, urls, concurrency, method="GET", headers=None):
+    """
+    Issue requests with bounded concurrency and report on them.
+    """
+    semaphore = DeferredSemaphore(concurrency)
+    latencies = []
+    start = time.time()
+    yield DeferredList([semaphore.run(
+        timed_request,
+        latencies,
+        method,
+        url,
+        headers) for url in urls])
+    report(name, latencies, time.time() - start)
+
+
+def batch_urls(base_url, options):
+    """
+    Batch ingest URLs for a population of visitors.
+    """
+    random = Random(options.seed)
+    events = ["event-%s" % i for i in range(0, options.events)]
+    visitors = [uuid.uuid4().hex for i in range(0, options.visitors)]
+    urls = []
+    for i in range(0, options.requests):
+        message = b64encode(ujson.dumps([
+            random.sample(events, options.events_per_request),
+            [["property-%s" % random.randint(0, 3),
+              "value-%s" % random.randint(0, 9)]]]))
+        urls.append("%s/batch?%s" % (base_url, urlencode({
+            "message": message,
+            "visitor_id": random.choice(visitors)})))
+    return urls, events
+
+
+@inlineCallbacks
+def benchmark(options, port):
+    """
+    Create a user and bucket, ingest, then query events and funnels.
+    """
+    user_name = uuid.uuid4().hex
+    password = uuid.uuid4().hex
+    root = "http://127.0.0.1:%s" % port
+    response = yield AGENT.request(
+        "POST",
+        "%s/%s?%s" % (root, user_name, urlencode({"password": password})))
+    yield readBody(response)
+    base_url = "%s/%s/%s" % (root, user_name, uuid.uuid4().hex)
+    urls, events = batch_urls(base_url, options)
+    yield run_requests("ingest", urls, options.concurrency)
+    headers = {"Authorization": [
+        "Basic %s" % b64encode("%s:%s" % (user_name, password))]}
+    urls = ["%s/event/%s" % (base_url, events[i % len(events)])
+        for i in range(0, options.queries)]
+    yield run_requests("event", urls, options.concurrency, headers=headers)
+    urls = ["%s/funnel?%s" % (base_url, urlencode([
+        ("event", events[i % len(events)]),
+        ("event", events[(i + 1) % len(events)]),
+        ("property", "property-0")])) for i in range(0, options.queries)]
+    yield run_requests("funnel", urls, options.concurrency, headers=headers)
+
+
+def make_backend(name, options):
+    """
+    Storage backend by name, None for Cassandra.
+    """
+    if name == "memory":
+        return MemoryBackend(
+            latency=options.latency,
+            failure_rate=options.failure_rate,
+            seed=options.seed)
+    elif name == "sqlite":
+        path = options.sqlite_path or os.path.join(
+            tempfile.mkdtemp(),
+            "hiitrack.db")
+        return SQLiteBackend(path)
+    elif name == "cassandra":
+        return None
+    raise ValueError("Unknown backend %s" % name)
+
+
+@inlineCallbacks
+def run(options):
+    """
+    Benchmark each backend in turn.
+    """
+    for i, name in enumerate(options.backend.split(",")):
+        print "%s backend" % name
+        port = options.port + i
+        hiitrack = HiiTrack(port, backend=make_backend(name, options))
+        hiitrack.startService()
+        try:
+            yield benchmark(options, port)
+        finally:
+            # Storage globals point at this backend until its final flush.
+            yield hiitrack.stopService()
+
+
+def main():
+    parser = OptionParser()
+    parser.add_option("--backend", default="memory",
+        help="Comma separated list of memory, sqlite or cassandra.")
+    parser.add_option("--sqlite-path", default=None)
+    parser.add_option("--port", type="int", default=8181)
+    parser.add_option("--requests", type="int", default=2000)
+    parser.add_option("--queries", type="int", default=200)
+    parser.add_option("--concurrency", type="int", default=20)
+    parser.add_option("--visitors", type="int", default=500)
+    parser.add_option("--events", type="int", default=20)
+    parser.add_option("--events-per-request", type="int", default=3)
+    parser.add_option("--latency", type="float", default=0.0,
+        help="Injected backend latency in seconds.")
+    parser.add_option("--failure-rate", type="float", default=0.0,
+        help="Injected backend failure probability.")
+    parser.add_option("--seed", type="int", default=0)
+    options, _ = parser.parse_args()
+
+    def finish(result):
+        reactor.stop()
+        return result
+    reactor.callWhenRunning(lambda: run(options).addBoth(finish))
+    reactor.run()
+
+
+if __name__ == "__main__":
+    main()
@@ -8,15 +8,15 @@ user.
 
 from twisted.internet.defer import inlineCallbacks, returnValue
 from ..lib.authentication import authenticate
-from ..exceptions import BucketException
+from ..exceptions import BucketException, InvalidParameterException
 from ..models import bucket_check, BucketModel, user_authorize, EventModel, \
     PropertyValueModel, VisitorModel, bucket_create
 from ..lib.b64encode import b64encode_keys, uri_b64encode
-from ..lib.parameters import require
+from ..lib.parameters import require, page
+from ..lib.families import parse_families, FAMILIES
 from base64 import b64decode
 import ujson
 from ..lib.profiler import profile
-from ..lib.cassandra import BUFFER
 from uuid import uuid4
 from datetime import datetime, timedelta
 
@@ -44,6 +44,12 @@ class Bucket(object):
             controller=self,
             action='batch',
             conditions={"method": "GET"})
+        dispatcher.connect(
+            name='bucket',
+            route='/{user_name}/{bucket_name}/hot_event',
+            controller=self,
+            action='hot_events',
+            conditions={"method": "GET"})
         dispatcher.connect(
             name='bucket',
             route='/{user_name}/{bucket_name}',
@@ -70,7 +76,8 @@ class Bucket(object):
     @inlineCallbacks
     def post(self, request, user_name, bucket_name):
         """
-        Create a new bucket.
+        Create a new bucket. A comma separated 'disabled' parameter lists
+        counter families the bucket does not keep.
         """
         bucket = BucketModel(user_name, bucket_name)
         exists = yield bucket.exists()
@@ -78,7 +85,13 @@ class Bucket(object):
             request.setResponseCode(403)
             raise BucketException("Bucket already exists.")
         description = request.args["description"][0]
-        yield bucket.create(description)
+        try:
+            disabled = parse_families(request.args.get("disabled", [""])[0])
+        except ValueError:
+            request.setResponseCode(400)
+            raise InvalidParameterException("Parameter 'disabled' must "
+                "list counter families of %s." % ", ".join(FAMILIES))
+        yield bucket.create(description, disabled)
         request.setResponseCode(201)
 
     @authenticate
@@ -88,19 +101,44 @@ class Bucket(object):
     @inlineCallbacks
     def get(self, request, user_name, bucket_name):
         """
-        Information about the bucket.
+        Information about the bucket. With a 'limit' parameter events are
+        returned a page at a time, along with the 'cursor' of the next page.
         """
+        cursor, limit = page(request)
         bucket = BucketModel(user_name, bucket_name)
         description = yield bucket.get_description()
+        disabled = yield bucket.get_disabled()
         properties = yield bucket.get_properties()
-        events = yield bucket.get_events()
+        if limit:
+            events, cursor = yield bucket.get_events_page(cursor, limit)
+        else:
+            events = yield bucket.get_events()
         for value in events.values():
             value["id"] = uri_b64encode(value["id"])
-        returnValue({
+        response = {
             "bucket_name": bucket_name,
             "description": description,
+            "disabled": sorted(disabled),
             "properties": b64encode_keys(properties),
-            "events": events})
+            "events": events}
+        if limit:
+            response["cursor"] = uri_b64encode(cursor) if cursor else None
+        returnValue(response)
+
+    @authenticate
+    @user_authorize
+    @bucket_check
+    @profile
+    @inlineCallbacks
+    def hot_events(self, request, user_name, bucket_name):
+        """
+        Events whose counters are spread over sub-rows, with their number
+        of sub-rows.
+        """
+        hot_events = yield BucketModel(user_name, bucket_name).get_hot_events()
+        for value in hot_events.values():
+            value["id"] = uri_b64encode(value["id"])
+        returnValue({"hot_events": hot_events})
 
     @authenticate
     @user_authorize
@@ -122,6 +160,7 @@ class Bucket(object):
         Batched events and properties.
         """
         cookied_visitor_id = request.getCookie("v")
+        fresh = False
         if "visitor_id" in request.args:
             visitor_id = request.args["visitor_id"][0]
             if visitor_id != cookied_visitor_id:
@@ -131,6 +170,7 @@ class Bucket(object):
                 visitor_id = cookied_visitor_id
             else:
                 visitor_id = uuid4().hex
+                fresh = True
                 set_cookie(request, visitor_id)
         data = ujson.loads(b64decode(request.args["message"][0]))
         if len(data) != 2:
@@ -159,16 +199,12 @@ class Bucket(object):
                 "visitor_id": visitor_id,
                 "error": "Batch request must contain base64 encoded list"
                     " of two values: event_names, properties"})
-        visitor = VisitorModel(user_name, bucket_name, visitor_id)
-        total, path, property_ids = yield visitor.get_metadata()
-        for key, value in properties:
-            pv = PropertyValueModel(user_name, bucket_name, key, value)
-            pv.batch_add(visitor, total, path, property_ids)
-            property_ids.append(pv.id)
-        for event_name in event_names:
-            event = EventModel(user_name, bucket_name, event_name)
-            event.batch_add(visitor, total, path, property_ids)
-        yield BUFFER.flush()
+        visitor = VisitorModel(user_name, bucket_name, visitor_id, fresh)
+        models = [PropertyValueModel(user_name, bucket_name, key, value)
+            for key, value in properties]
+        models.extend([EventModel(user_name, bucket_name, event_name)
+            for event_name in event_names])
+        yield visitor.ingest(models)
         returnValue({"visitor_id":visitor_id})
 
 
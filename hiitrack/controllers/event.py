@@ -14,6 +14,7 @@ from ..lib.b64encode import b64encode_keys, b64encode_nested_keys, \
     uri_b64encode, uri_b64decode
 from ..lib.parameters import require
 from ..lib.profiler import profile
+from ..lib.families import get_disabled
 from ..exceptions import EventException
 
 
@@ -87,7 +88,8 @@ class Event(object):
 @inlineCallbacks
 def _get(request, event):
     """
-    Information about the event.
+    Information about the event, and which of its counters the bucket
+    does not keep.
     """
     if "property" in request.args:
         _property = PropertyModel(
@@ -99,8 +101,17 @@ def _get(request, event):
     response = {"id": uri_b64encode(event.id), "name": event.event_name}
     if "start" in request.args:
         yield _get_interval(request, event, _property, response)
+        if request.args.get("interval", ["day"])[0] == "hour":
+            families = ["hourly_event", "hourly_path"]
+        else:
+            families = ["daily_event", "daily_path"]
     else:
         yield _get_total(event, _property, response)
+        families = ["path"]
+    if _property:
+        families.extend(["property_event", "property_path"])
+    disabled = yield get_disabled(event.user_name, event.bucket_name)
+    response["unavailable"] = sorted(disabled.intersection(families))
     returnValue(response)
 
 
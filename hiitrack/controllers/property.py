@@ -12,7 +12,7 @@ from ..models import bucket_check, user_authorize, bucket_create
 from ..models import PropertyValueModel, VisitorModel, PropertyModel
 from ..lib.authentication import authenticate
 from ..lib.b64encode import b64encode_keys, uri_b64encode, uri_b64decode
-from ..lib.parameters import require
+from ..lib.parameters import require, page
 from ..lib.profiler import profile
 
 
@@ -55,7 +55,7 @@ class Property(object):
         Information about the property.
         """
         _property = PropertyModel(user_name, bucket_name, property_name)
-        return _get(_property, property_name)
+        return _get(_property, property_name, *page(request))
 
     @authenticate
     @user_authorize
@@ -70,10 +70,11 @@ class Property(object):
         """
         Information about the property.
         """
+        cursor, limit = page(request)
         property_id = uri_b64decode(property_id)
         _property = PropertyModel(user_name, bucket_name, property_id=property_id)
         property_name = yield _property.get_name()
-        data = yield _get(_property, property_name)
+        data = yield _get(_property, property_name, cursor, limit)
         returnValue(data)
 
     @require("visitor_id", "value")
@@ -102,19 +103,34 @@ class Property(object):
 
 
 @inlineCallbacks
-def _get(_property, property_name):
+def _get(_property, property_name, cursor=None, limit=None):
     """
-    Information about the property.
+    Information about the property. With a limit, values are returned a
+    page at a time along with the cursor of the next page, and events are
+    those recorded with the values on the page.
     """
-    values = yield _property.get_values()
-    totals = yield _property.get_totals()
-    events = yield _property.get_events()
-    values = dict([(
-        uri_b64encode(x),
-        {"value": values[x], "total": b64encode_keys(totals[x])})
-        for x in values])
-    returnValue({
+    if limit:
+        values, cursor = yield _property.get_values_page(cursor, limit)
+        if values:
+            value_ids = sorted(values)
+            totals = yield _property.get_totals(
+                value_ids[0][16:],
+                value_ids[-1][16:])
+            events = yield _property.get_events(totals)
+        else:
+            totals, events = {}, {}
+    else:
+        values = yield _property.get_values()
+        totals = yield _property.get_totals()
+        events = yield _property.get_events()
+    response = {
         "id":uri_b64encode(_property.id),
         "name":property_name,
-        "values":values,
-        "events":b64encode_keys(events)})
+        "values":dict([(
+            uri_b64encode(x),
+            {"value": values[x], "total": b64encode_keys(totals[x])})
+            for x in values]),
+        "events":b64encode_keys(events)}
+    if limit:
+        response["cursor"] = uri_b64encode(cursor) if cursor else None
+    returnValue(response)
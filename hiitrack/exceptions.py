@@ -44,3 +44,10 @@ class MissingParameterException(HiiTrackException):
     Missing HTTP parameter
     """
     pass
+
+
+class InvalidParameterException(HiiTrackException):
+    """
+    Malformed HTTP parameter
+    """
+    pass
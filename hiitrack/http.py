@@ -15,13 +15,24 @@ from .controllers.event import Event
 from .controllers.property import Property
 from .controllers.funnel import Funnel
 from .lib import cassandra
+from .models import visitor, property as property_model, \
+    event as event_model
+from .lib.wal import WriteAheadLog
+from .lib.ring import Ring
+from .lib.cache import SliceCache
+from .lib.periods import PeriodCache
+from .lib.known import KnownColumns
+from .lib.hot import HotEvents
+from .models.rollup import DailyRollup
+from .lib.keys import VisitorPartitions, TimePartitions, SHARDS
 from .lib.profiler import EXECUTION_TIME, EXECUTION_COUNT
 from twisted.internet.task import LoopingCall
 
 
 class HiiTrack(Service):
     """
-    HiiTrack HTTP interface.
+    HiiTrack HTTP interface. Storage is a Cassandra cluster described by
+    cassandra_settings unless a lib.backend.Backend is given.
     """
 
     listener = None
@@ -29,13 +40,121 @@ class HiiTrack(Service):
     def __init__(
             self,
             port=8080,
-            cassandra_settings=None):
+            cassandra_settings=None,
+            backend=None):
         if not cassandra_settings:
             cassandra_settings = {}
-        cassandra.CLIENT = CassandraClusterPool(
-            cassandra_settings.get("servers", ["127.0.0.1"]),
-            keyspace=cassandra_settings.get("keyspace", "HiiTrack"),
-            pool_size=cassandra_settings.get("pool_size", None))
+        if backend is not None:
+            cassandra.CLIENT = backend
+        else:
+            cassandra.CLIENT = CassandraClusterPool(
+                cassandra_settings.get("servers", ["127.0.0.1"]),
+                keyspace=cassandra_settings.get("keyspace", "HiiTrack"),
+                pool_size=cassandra_settings.get("pool_size", None))
+        if backend is None and cassandra_settings.get("token_aware"):
+            ring = Ring(
+                cassandra.CLIENT,
+                cassandra_settings.get("keyspace", "HiiTrack"),
+                lambda endpoint: CassandraClusterPool(
+                    [endpoint],
+                    keyspace=cassandra_settings.get("keyspace", "HiiTrack"),
+                    pool_size=cassandra_settings.get("replica_pool_size", 1)),
+                cassandra_settings.get("ring_refresh_interval", 60))
+        else:
+            ring = None
+        if cassandra_settings.get("wal_path"):
+            write_ahead_log = WriteAheadLog(
+                cassandra_settings["wal_path"],
+                cassandra_settings.get("wal_sync_interval", 0.01))
+        else:
+            write_ahead_log = None
+        cassandra.BUFFER.configure(
+            commit_interval=cassandra_settings.get("commit_interval", None),
+            commit_size=cassandra_settings.get("commit_size", None),
+            wal=write_ahead_log,
+            max_mutations=cassandra_settings.get("max_batch_mutations", None),
+            max_bytes=cassandra_settings.get("max_batch_bytes", None),
+            retries=cassandra_settings.get("batch_retries", 0),
+            ring=ring)
+        cassandra.PAGE_SIZE = cassandra_settings.get("page_size", 10000)
+        if cassandra_settings.get("counter_cache_size"):
+            cassandra.CACHE = SliceCache(
+                cassandra_settings["counter_cache_size"],
+                cassandra_settings.get("counter_cache_ttl", 5),
+                cassandra_settings.get("counter_cache_stale", 30))
+        else:
+            cassandra.CACHE = None
+        if cassandra_settings.get("period_cache_path"):
+            cassandra.PERIODS = PeriodCache(
+                cassandra_settings["period_cache_path"],
+                cassandra_settings.get("period_cache_grace", 300))
+        else:
+            cassandra.PERIODS = None
+        if cassandra_settings.get("known_relation_size"):
+            cassandra.KNOWN = KnownColumns(
+                cassandra_settings["known_relation_size"],
+                cassandra_settings.get("known_relation_capacity", 1000000),
+                cassandra_settings.get("known_relation_error_rate", 0.000001),
+                cassandra_settings.get("known_relation_rows", 1000),
+                cassandra_settings.get("known_relation_ttl", 3600))
+        else:
+            cassandra.KNOWN = None
+        if cassandra_settings.get("visitor_cache_size"):
+            visitor.METADATA_CACHE = visitor.MetadataCache(
+                cassandra_settings["visitor_cache_size"],
+                cassandra_settings.get("visitor_cache_ttl", 1800))
+        else:
+            visitor.METADATA_CACHE = None
+        visitor.VISITOR_STATE = cassandra_settings.get(
+            "visitor_state",
+            "counter")
+        if visitor.VISITOR_STATE not in ("counter", "migrating", "blob"):
+            raise ValueError(
+                "Unknown visitor_state %s." % visitor.VISITOR_STATE)
+        property_model.PROPERTY_ROWS = cassandra_settings.get(
+            "property_rows",
+            "bucket")
+        if property_model.PROPERTY_ROWS not in (
+                "bucket",
+                "migrating",
+                "property"):
+            raise ValueError(
+                "Unknown property_rows %s." % property_model.PROPERTY_ROWS)
+        visitor.PARTITIONS = VisitorPartitions(
+            cassandra_settings.get("visitor_partitions", SHARDS))
+        if cassandra_settings.get("previous_visitor_partitions"):
+            visitor.PREVIOUS_PARTITIONS = VisitorPartitions(
+                cassandra_settings["previous_visitor_partitions"])
+        else:
+            visitor.PREVIOUS_PARTITIONS = None
+        if cassandra_settings.get("time_partitions"):
+            event_model.TIME_PARTITIONS = TimePartitions(
+                cassandra_settings["time_partitions"])
+        else:
+            event_model.TIME_PARTITIONS = None
+        event_model.TIME_PARTITIONS_MIGRATING = bool(
+            cassandra_settings.get("time_partitions_migrating"))
+        if cassandra_settings.get("daily_rollup_since"):
+            event_model.DAILY_ROLLUP = DailyRollup(
+                cassandra_settings["daily_rollup_since"],
+                ttl=cassandra_settings.get("daily_rollup_ttl", 60))
+        else:
+            event_model.DAILY_ROLLUP = None
+        if cassandra_settings.get("hot_event_rate"):
+            event_model.HOT_EVENTS = HotEvents(
+                cassandra_settings["hot_event_rate"],
+                cassandra_settings.get("hot_event_subrows", 16),
+                cassandra_settings.get("hot_event_window", 60),
+                cassandra_settings.get("hot_event_ttl", 60))
+        else:
+            event_model.HOT_EVENTS = None
+        if cassandra_settings.get("visitor_filter_path"):
+            visitor.VISITOR_FILTERS = visitor.VisitorFilters(
+                cassandra_settings["visitor_filter_path"],
+                cassandra_settings.get("visitor_filter_capacity", 1000000),
+                cassandra_settings.get("visitor_filter_error_rate", 0.01))
+        else:
+            visitor.VISITOR_FILTERS = None
         dispatcher = Dispatcher()
         dispatcher.connect(
             name='index',
@@ -61,6 +180,37 @@ class HiiTrack(Service):
             time, count, name = timer
             mean = time / count
             log.msg("%s: %s, %sx%ss" % (name, time, count, mean))
+        log.msg("Single-flight reads: %s, collapsed: %s" % (
+            cassandra.FLIGHTS.reads,
+            cassandra.FLIGHTS.collapsed))
+        if cassandra.CACHE is not None:
+            log.msg("Counter cache hits: %s, stale: %s, misses: %s" % (
+                cassandra.CACHE.hits,
+                cassandra.CACHE.stale_hits,
+                cassandra.CACHE.misses))
+        if cassandra.PERIODS is not None:
+            log.msg("Period cache hits: %s, misses: %s" % (
+                cassandra.PERIODS.hits,
+                cassandra.PERIODS.misses))
+        if cassandra.KNOWN is not None:
+            log.msg("Relation writes avoided: %s" % cassandra.KNOWN.avoided)
+        if event_model.HOT_EVENTS is not None:
+            log.msg("Hot events: %s, sub-row writes: %s" % (
+                sum([len(x) for x in event_model.HOT_EVENTS.hot.values()]),
+                event_model.HOT_EVENTS.salted))
+        if visitor.METADATA_CACHE is not None:
+            log.msg("Visitor cache hits: %s, misses: %s, entries: %s, "
+                "bytes: %s" % (
+                    visitor.METADATA_CACHE.hits,
+                    visitor.METADATA_CACHE.misses,
+                    len(visitor.METADATA_CACHE.entries),
+                    visitor.METADATA_CACHE.memory()))
+        if visitor.VISITOR_FILTERS is not None:
+            log.msg("Visitor filter skipped reads: %s" % \
+                visitor.VISITOR_FILTERS.skipped)
+        log.msg("Visitor ingests: %s, coalesced: %s" % (
+            visitor.INGEST_STATS["ingests"],
+            visitor.INGEST_STATS["coalesced"]))
 
     def startService(self):
         """
@@ -69,6 +219,10 @@ class HiiTrack(Service):
         self.logloop.start(60*5, False)
         Service.startService(self)
         cassandra.CLIENT.startService()
+        if cassandra.BUFFER.ring is not None:
+            cassandra.BUFFER.ring.start()
+        if cassandra.BUFFER.wal is not None:
+            cassandra.BUFFER.replay()
         self.listener = reactor.listenTCP(self.port, Site(self.dispatcher))
 
     def stopService(self):
@@ -78,6 +232,22 @@ class HiiTrack(Service):
         self.log()
         self.logloop.stop()
         Service.stopService(self)
-        cassandra.CLIENT.stopService()
         if self.listener:
             self.listener.stopListening()
+        # The clients stop once the last group commit is written.
+        deferred = cassandra.BUFFER.stop()
+        deferred.addBoth(self._stop_storage)
+        return deferred
+
+    def _stop_storage(self, result):
+        """
+        Shutdown the storage clients and caches after the final flush.
+        """
+        if visitor.VISITOR_FILTERS is not None:
+            visitor.VISITOR_FILTERS.save()
+        if cassandra.BUFFER.ring is not None:
+            cassandra.BUFFER.ring.stop()
+        cassandra.CLIENT.stopService()
+        if cassandra.PERIODS is not None:
+            cassandra.PERIODS.close()
+        return result
@@ -0,0 +1,119 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Storage backend interface.
+"""
+
+from telephus.cassandra.c08.ttypes import Column, CounterColumn, \
+    ColumnOrSuperColumn
+
+
+def column_result(name, value, counter=False):
+    """
+    Wrap a column name and value the way Cassandra returns them.
+    """
+    if counter:
+        return ColumnOrSuperColumn(
+            counter_column=CounterColumn(name=name, value=value))
+    return ColumnOrSuperColumn(
+        column=Column(name=name, value=value, timestamp=0))
+
+
+class Backend(object):
+    """
+    The subset of the Telephus CassandraClusterPool API that HiiTrack uses.
+    A backend is assigned to lib.cassandra.CLIENT and every method returns
+    a Deferred firing with Cassandra Thrift result types.
+
+    Column names within a row are ordered bytewise. Slices include both
+    start and finish; an empty start or finish leaves that end open.
+    Column families listed in counter_column_families hold counters.
+    """
+
+    counter_column_families = ("counter",)
+
+    def startService(self):
+        """
+        Open connections or files.
+        """
+        pass
+
+    def stopService(self):
+        """
+        Close connections or files.
+        """
+        pass
+
+    def get(self, key, column_family, column, consistency=None):
+        """
+        Return a ColumnOrSuperColumn or fail with NotFoundException.
+        """
+        raise NotImplementedError()
+
+    def get_slice(
+            self,
+            key,
+            column_family,
+            names=None,
+            start='',
+            finish='',
+            count=100,
+            reverse=False,
+            consistency=None):
+        """
+        Return a list of ColumnOrSuperColumn for the named columns or the
+        range of column names.
+        """
+        raise NotImplementedError()
+
+    def multiget_slice(
+            self,
+            keys,
+            column_family,
+            names=None,
+            start='',
+            finish='',
+            count=100,
+            reverse=False,
+            consistency=None):
+        """
+        Return a dictionary of key -> get_slice() result.
+        """
+        raise NotImplementedError()
+
+    def insert(self, key, column_family, value, column, consistency=None):
+        """
+        Insert a single column.
+        """
+        raise NotImplementedError()
+
+    def batch_multikey_insert(self, column_family, mapping, consistency=None):
+        """
+        Insert {key: {column: value}} columns.
+        """
+        raise NotImplementedError()
+
+    def batch_multikey_add(self, column_family, mapping, consistency=None):
+        """
+        Add {key: {column: value}} to counter columns.
+        """
+        raise NotImplementedError()
+
+    def remove(self, key, column_family, column=None, consistency=None):
+        """
+        Remove a column, or the whole row if column is None.
+        """
+        raise NotImplementedError()
+
+    def remove_counter(self, key, column_family, column=None, consistency=None):
+        """
+        Remove a counter column, or the whole row if column is None.
+        """
+        raise NotImplementedError()
+
+    def batch_remove_rows(self, mapping, consistency=None):
+        """
+        Remove whole rows given as {column_family: [key, ...]}.
+        """
+        raise NotImplementedError()
@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Bloom filter over hashed IDs.
+"""
+
+import math
+import struct
+
+
+_HALVES = struct.Struct(">QQ")
+_HEADER = struct.Struct(">QB")
+
+
+class BloomFilter(object):
+    """
+    Bloom filter sized for capacity keys at error_rate false positives.
+
+    Keys are 16 byte hash digests such as those from pack_hash, so bit
+    positions are derived from the key's two 64 bit halves by double
+    hashing instead of hashing it again.
+    """
+
+    def __init__(self, capacity=1000000, error_rate=0.01):
+        self.size = int(math.ceil(
+            -capacity * math.log(error_rate) / math.log(2) ** 2))
+        self.hashes = max(1, int(round(
+            self.size / float(capacity) * math.log(2))))
+        self.bits = bytearray((self.size + 7) // 8)
+
+    def _positions(self, key):
+        """
+        Bit positions of a key.
+        """
+        first, second = _HALVES.unpack(key[0:16])
+        return [(first + i * second) % self.size for i in range(self.hashes)]
+
+    def add(self, key):
+        """
+        Add a key.
+        """
+        for position in self._positions(key):
+            self.bits[position >> 3] |= 1 << (position & 7)
+
+    def __contains__(self, key):
+        for position in self._positions(key):
+            if not self.bits[position >> 3] & 1 << (position & 7):
+                return False
+        return True
+
+    def dumps(self):
+        """
+        Serialize the filter.
+        """
+        return _HEADER.pack(self.size, self.hashes) + str(self.bits)
+
+    @classmethod
+    def loads(cls, data):
+        """
+        Deserialize a filter written by dumps().
+        """
+        bloom_filter = cls.__new__(cls)
+        bloom_filter.size, bloom_filter.hashes = _HEADER.unpack_from(data)
+        bloom_filter.bits = bytearray(data[_HEADER.size:])
+        return bloom_filter
@@ -0,0 +1,193 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Read-through cache of decoded counter slices.
+"""
+
+import time
+from bisect import bisect_left
+from collections import defaultdict
+from pylru import lrucache
+from twisted.internet.defer import succeed
+from twisted.python import log
+from twisted.python.failure import Failure
+
+
+_HIGH_ID = chr(255) * 16
+
+
+class _Entry(object):
+    """
+    Sorted column names, relative to the prefix, and their values.
+    """
+
+    def __init__(self, names, values, first, last, prefix_length):
+        self.names = names
+        self.values = values
+        self.first = first
+        self.last = last
+        self.prefix_length = prefix_length
+        self.expires = 0
+        self.refreshing = False
+
+
+class SliceCache(object):
+    """
+    Bounded LRU cache of counter slices keyed by (row key, prefix, start,
+    finish), with start and finish relative to the prefix.
+
+    Entries are fresh for ttl seconds. For stale seconds after that they
+    are still served while a single background read refreshes them.
+    Increments flushed by the local Buffer are added to the cached slices
+    of their rows once the flush succeeds. Reads that overlap a flush of
+    their row are not cached, as they may or may not include it.
+    """
+
+    def __init__(self, size=10000, ttl=5, stale=30):
+        self.ttl = ttl
+        self.stale = stale
+        self.entries = lrucache(size, self._evicted)
+        self.rows = defaultdict(set)
+        self.pending = defaultdict(lambda:0)
+        self.versions = defaultdict(lambda:0)
+        self.flushing = defaultdict(lambda:0)
+        self.hits = 0
+        self.stale_hits = 0
+        self.misses = 0
+
+    def get(self, entry_key, load):
+        """
+        Return a deferred firing with copies of the (names, values) of a
+        slice. load is called to read the slice when it is not cached.
+        """
+        now = time.time()
+        if entry_key in self.entries:
+            entry = self.entries[entry_key]
+            if now < entry.expires:
+                self.hits += 1
+                return succeed((list(entry.names), list(entry.values)))
+            if now < entry.expires + self.stale:
+                self.stale_hits += 1
+                if not entry.refreshing:
+                    entry.refreshing = True
+                    self._load(entry_key, load).addErrback(
+                        log.err,
+                        "Could not refresh cached slice.")
+                return succeed((list(entry.names), list(entry.values)))
+        self.misses += 1
+        return self._load(entry_key, load).addCallback(
+            lambda x:(list(x[0]), list(x[1])))
+
+    def _load(self, entry_key, load):
+        """
+        Read a slice and cache it unless its row changed in the meantime.
+        """
+        row = entry_key[0]
+        self.pending[row] += 1
+        version = self.versions[row]
+        deferred = load()
+        deferred.addBoth(self._loaded, entry_key, version)
+        return deferred
+
+    def _loaded(self, result, entry_key, version):
+        """
+        Store a slice read by _load().
+        """
+        row = entry_key[0]
+        current = self.versions[row]
+        self.pending[row] -= 1
+        if not self.pending[row]:
+            del self.pending[row]
+            del self.versions[row]
+        if isinstance(result, Failure):
+            if entry_key in self.entries:
+                self.entries[entry_key].refreshing = False
+            return result
+        if version == current and row not in self.flushing:
+            self._store(entry_key, *result)
+        elif entry_key in self.entries:
+            self.entries[entry_key].refreshing = False
+        return result
+
+    def _store(self, entry_key, names, values):
+        """
+        Cache a slice.
+        """
+        row, prefix, start, finish = entry_key
+        if prefix:
+            first = prefix + start
+            last = prefix + finish + _HIGH_ID
+        else:
+            first = start
+            last = finish
+        entry = _Entry(list(names), list(values), first, last, len(prefix))
+        entry.expires = time.time() + self.ttl
+        self.entries[entry_key] = entry
+        self.rows[row].add(entry_key)
+
+    def _evicted(self, entry_key, entry):
+        """
+        Drop an evicted entry from the row index.
+        """
+        row = entry_key[0]
+        self.rows[row].discard(entry_key)
+        if not self.rows[row]:
+            del self.rows[row]
+
+    def begin(self, mutations):
+        """
+        Note the start of a flush of {row key: {column name: delta}}
+        increments.
+        """
+        for row in mutations:
+            self.flushing[row] += 1
+
+    def end(self, result, mutations):
+        """
+        Note the end of a flush started with begin() and, if it succeeded,
+        add its increments to cached slices. Returns result.
+        """
+        for row in mutations:
+            self.flushing[row] -= 1
+            if not self.flushing[row]:
+                del self.flushing[row]
+        if not isinstance(result, Failure):
+            self.patch(mutations)
+        return result
+
+    def patch(self, mutations):
+        """
+        Add {row key: {column name: delta}} increments to cached slices.
+        """
+        for row in mutations:
+            if row in self.versions:
+                self.versions[row] += 1
+            if row not in self.rows:
+                continue
+            columns = mutations[row]
+            for entry_key in self.rows[row]:
+                entry = self.entries.peek(entry_key)
+                for name, delta in columns.iteritems():
+                    if name < entry.first or \
+                            (entry.last and name > entry.last):
+                        continue
+                    name = name[entry.prefix_length:]
+                    index = bisect_left(entry.names, name)
+                    if index < len(entry.names) and \
+                            entry.names[index] == name:
+                        entry.values[index] += delta
+                    else:
+                        entry.names.insert(index, name)
+                        entry.values.insert(index, delta)
+
+    def invalidate(self, rows):
+        """
+        Drop cached slices of deleted rows.
+        """
+        for row in rows:
+            if row in self.versions:
+                self.versions[row] += 1
+            for entry_key in list(self.rows.get(row, ())):
+                del self.entries[entry_key]
+                self._evicted(entry_key, None)
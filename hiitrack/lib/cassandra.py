@@ -6,7 +6,12 @@ Cassandra methods for dealing with hashed keys.
 """
 
 from ..lib.hash import pack_hash
-from twisted.internet.defer import inlineCallbacks, returnValue, DeferredList
+from twisted.internet.defer import inlineCallbacks, returnValue, \
+    DeferredList, Deferred
+from twisted.internet import reactor
+from twisted.internet.task import deferLater
+from twisted.python import log
+from twisted.python.failure import Failure
 import struct
 import time
 try:
@@ -14,12 +19,21 @@ try:
 except ImportError:
     from ordereddict import OrderedDict
 from ..lib.profiler import profile
+from ..lib.wal import RELATION
+from telephus.cassandra.c08.ttypes import UnavailableException, \
+    TimedOutException
 from collections import defaultdict
 
 
 CLIENT = None
+CACHE = None
+PERIODS = None
+KNOWN = None
 LOW_ID = chr(255) * 16
 HIGH_ID = chr(255) * 16
+SPILL_RETRY_INTERVAL = 1.0
+CHUNK_RETRY_INTERVAL = 0.1
+PAGE_SIZE = 10000
 
 
 def _counter_buffer():
@@ -29,46 +43,447 @@ def _counter_buffer():
 class Buffer(object):
     """
     Buffer to batch inserts and adds.
+
+    In group-commit mode (commit_interval set) requests call commit() and
+    wait on a shared flush that fires every commit_interval seconds, or as
+    soon as commit_size columns are buffered. Counter increments for the
+    same row and column are summed across requests before they are sent.
+
+    With a write-ahead log, commit() fires as soon as the buffered
+    mutations are on disk and flushes happen in the background. Mutations
+    from a failed flush are returned to the buffer and the log, except
+    counter adds that timed out, which may have been applied.
+
+    Flushes larger than max_mutations columns or max_bytes are split into
+    chunks that are sent concurrently over the pool's connections. Each
+    chunk is retried up to retries times on its own, waiting
+    CHUNK_RETRY_INTERVAL seconds before the first retry and twice as long
+    before each next one. Counter adds are not idempotent, so counter
+    chunks are only retried when the cluster was unavailable and applied
+    nothing; a timed out add may have landed.
+
+    With a token ring, counter rows are grouped by owning replica and each
+    group is sent straight to that replica, retries included.
     """
 
-    def __init__(self):
+    def __init__(
+            self,
+            commit_interval=None,
+            commit_size=None,
+            wal=None,
+            max_mutations=None,
+            max_bytes=None,
+            retries=0,
+            ring=None):
         self.relation = defaultdict(dict)
+        self.once = defaultdict(set)
         self.counter = _counter_buffer()
+        self.size = 0
+        self.waiting = []
+        self.delayed_flush = None
+        self.flushing = []
+        self.configure(
+            commit_interval,
+            commit_size,
+            wal,
+            max_mutations,
+            max_bytes,
+            retries,
+            ring)
+
+    def configure(
+            self,
+            commit_interval=None,
+            commit_size=None,
+            wal=None,
+            max_mutations=None,
+            max_bytes=None,
+            retries=0,
+            ring=None):
+        """
+        Set group-commit mode, the write-ahead log, flush chunking and
+        token-aware routing.
+        """
+        self.commit_interval = commit_interval
+        self.commit_size = commit_size
+        self.wal = wal
+        self.max_mutations = max_mutations
+        self.max_bytes = max_bytes
+        self.retries = retries
+        self.ring = ring
 
     def flush_relation(self):
         """
         Batch insert buffered relations.
         """
         relation, self.relation = self.relation, defaultdict(dict)
-        return CLIENT.batch_multikey_insert("relation", relation)
+        once, self.once = self.once, defaultdict(set)
+        self.size -= sum([len(x) for x in relation.values()])
+        deferreds = []
+        for chunk in self._chunk(relation):
+            deferred = self._send_chunk(
+                "batch_multikey_insert",
+                "relation",
+                chunk,
+                self.retries)
+            if KNOWN is not None and once:
+                deferred.addCallback(_known, chunk, once)
+            if self.wal is not None:
+                deferred.addErrback(self._spill_relation, chunk)
+            deferreds.append(deferred)
+        return _gather(deferreds).addBoth(FLIGHTS.wrote)
 
     def flush_counter(self):
         """
         Batch add buffered counters.
         """
         counter, self.counter = self.counter, _counter_buffer()
-        return CLIENT.batch_multikey_add("counter", counter)
+        self.size -= sum([len(x) for x in counter.values()])
+        if self.ring is None:
+            groups = {None: counter}
+        else:
+            groups = self.ring.group(counter)
+        deferreds = []
+        for endpoint, mutations in groups.items():
+            if endpoint is None:
+                client = CLIENT
+            else:
+                client = self.ring.client_for(endpoint)
+            for chunk in self._chunk(mutations):
+                if CACHE is not None:
+                    CACHE.begin(chunk)
+                deferred = self._send_chunk(
+                    "batch_multikey_add",
+                    "counter",
+                    chunk,
+                    self.retries,
+                    client)
+                if CACHE is not None:
+                    deferred.addBoth(CACHE.end, chunk)
+                if self.wal is not None:
+                    deferred.addErrback(self._spill_counter, chunk)
+                deferreds.append(deferred)
+        return _gather(deferreds).addBoth(FLIGHTS.wrote)
+
+    def _chunk(self, mutations):
+        """
+        Split buffered mutations by the configured limits.
+        """
+        if not self.max_mutations and not self.max_bytes:
+            return [mutations]
+        return chunk_mutations(mutations, self.max_mutations, self.max_bytes)
+
+    def _send_chunk(
+            self,
+            method,
+            column_family,
+            chunk,
+            retries,
+            client=None,
+            delay=None):
+        """
+        Send one chunk, retrying only that chunk on failure.
+        """
+        deferred = getattr(client or CLIENT, method)(column_family, chunk)
+        if retries:
+            deferred.addErrback(
+                self._retry_chunk,
+                method,
+                column_family,
+                chunk,
+                retries,
+                client,
+                delay or CHUNK_RETRY_INTERVAL)
+        return deferred
+
+    def _retry_chunk(
+            self,
+            failure,
+            method,
+            column_family,
+            chunk,
+            retries,
+            client,
+            delay):
+        """
+        Send a failed chunk again after delay seconds, unless it holds
+        counter adds that may have been applied.
+        """
+        if column_family == "counter" and \
+                not failure.check(UnavailableException):
+            return failure
+        return deferLater(
+            reactor,
+            delay,
+            self._send_chunk,
+            method,
+            column_family,
+            chunk,
+            retries - 1,
+            client,
+            delay * 2)
+
+    def _spill_relation(self, failure, relation):
+        """
+        Return relations from a failed flush to the buffer and the log.
+        """
+        log.err(failure, "Relation flush failed, retrying from log.")
+        for key in relation:
+            for column_id, value in relation[key].items():
+                # Keep anything written since the failed flush started.
+                if column_id not in self.relation[key]:
+                    self.insert_relation(key, column_id, value)
+        self._schedule_flush(SPILL_RETRY_INTERVAL)
 
-    def insert_relation(self, key, column_id, value):
+    def _spill_counter(self, failure, counter):
         """
-        Add a relation insert to the buffer.
+        Return counters from a failed flush to the buffer and the log.
         """
+        if failure.check(TimedOutException):
+            log.err(failure, "Counter flush timed out, not retrying.")
+            return
+        log.err(failure, "Counter flush failed, retrying from log.")
+        for key in counter:
+            for column_id, value in counter[key].items():
+                self.increment_counter(key, column_id, value)
+        self._schedule_flush(SPILL_RETRY_INTERVAL)
+
+    def insert_relation(self, key, column_id, value, once=False):
+        """
+        Add a relation insert to the buffer. Columns inserted once, whose
+        value never changes, are noted in KNOWN when flushed.
+        """
+        if self.wal is not None:
+            self.wal.append_relation(key, column_id, value)
+        if column_id not in self.relation[key]:
+            self.size += 1
         self.relation[key][column_id] = value
+        if once:
+            self.once[key].add(column_id)
+        elif key in self.once:
+            self.once[key].discard(column_id)
 
     def increment_counter(self, key, column_id, value):
         """
         Add a counter add to the buffer.
         """
+        if self.wal is not None:
+            self.wal.append_counter(key, column_id, value)
+        if column_id not in self.counter[key]:
+            self.size += 1
         self.counter[key][column_id] += value
 
     def flush(self):
         """
         Batch add and insert simultaneously.
         """
-        return DeferredList([self.flush_relation(), self.flush_counter()])
+        if self.wal is None:
+            return DeferredList([self.flush_relation(), self.flush_counter()])
+        segment_id = self.wal.rotate()
+        deferred = DeferredList([self.flush_relation(), self.flush_counter()])
+        deferred.addCallback(self._truncate, segment_id)
+        return deferred
+
+    def _truncate(self, result, segment_id):
+        """
+        Remove a flushed log segment once any spilled mutations are synced
+        to the current one.
+        """
+        deferred = self.wal.sync()
+        deferred.addCallback(lambda _: self.wal.remove([segment_id]))
+        deferred.addCallback(lambda _: result)
+        return deferred
+
+    def replay(self):
+        """
+        Buffer and flush mutations from log segments left by a previous
+        process.
+        """
+        segment_ids = self.wal.closed_segments()
+        for kind, key, column_id, value in self.wal.read(segment_ids):
+            if kind == RELATION:
+                self.insert_relation(key, column_id, value)
+            else:
+                self.increment_counter(key, column_id, value)
+        deferred = self.wal.sync()
+        deferred.addCallback(lambda _: self.wal.remove(segment_ids))
+        deferred.addCallback(lambda _: self.flush())
+        return deferred
+
+    def commit(self):
+        """
+        Flush the buffer, or return a deferred that fires when the next
+        shared flush completes (group-commit mode) or when the buffered
+        mutations are logged (write-ahead log).
+        """
+        if self.wal is None and not self.commit_interval:
+            return self.flush()
+        if self.wal is None:
+            deferred = Deferred()
+            self.waiting.append(deferred)
+        else:
+            deferred = self.wal.sync()
+        if self.commit_size and self.size >= self.commit_size:
+            self._group_flush()
+        else:
+            self._schedule_flush(self.commit_interval)
+        return deferred
+
+    def stop(self):
+        """
+        Flush anything pending immediately. Returns a deferred that fires
+        when every group flush has completed.
+        """
+        if self.waiting or self.delayed_flush is not None:
+            self._group_flush()
+        return DeferredList(self.flushing[:])
+
+    def _schedule_flush(self, delay):
+        """
+        Schedule a shared flush unless one is already pending.
+        """
+        if self.delayed_flush is None:
+            self.delayed_flush = reactor.callLater(
+                delay or 0,
+                self._group_flush)
+
+    def _group_flush(self):
+        """
+        Flush everything buffered and release the waiting requests.
+        """
+        if self.delayed_flush is not None:
+            if self.delayed_flush.active():
+                self.delayed_flush.cancel()
+            self.delayed_flush = None
+        waiting, self.waiting = self.waiting, []
+        deferred = self.flush()
+        deferred.addCallback(_release, waiting)
+        self.flushing.append(deferred)
+        deferred.addBoth(self._flushed, deferred)
+        return deferred
+
+    def _flushed(self, result, deferred):
+        """
+        Stop tracking a completed group flush.
+        """
+        self.flushing.remove(deferred)
+        return result
+
+
+def chunk_mutations(mutations, max_mutations=None, max_bytes=None):
+    """
+    Split a {key: {column_id: value}} mapping into mappings holding at most
+    max_mutations columns and roughly max_bytes of keys, names and values.
+    """
+    chunks = []
+    chunk = defaultdict(dict)
+    count = 0
+    size = 0
+    for key in mutations:
+        for column_id, value in mutations[key].items():
+            if isinstance(value, str):
+                column_size = len(key) + len(column_id) + len(value)
+            else:
+                column_size = len(key) + len(column_id) + 8
+            full = (max_mutations and count >= max_mutations) or \
+                (max_bytes and size + column_size > max_bytes)
+            if count and full:
+                chunks.append(chunk)
+                chunk = defaultdict(dict)
+                count = 0
+                size = 0
+            chunk[key][column_id] = value
+            count += 1
+            size += column_size
+    if count:
+        chunks.append(chunk)
+    return chunks
+
+
+def _gather(deferreds):
+    """
+    Wait for several deferreds, failing with the first failure if any
+    failed.
+    """
+    def _first_failure(results):
+        for success, result in results:
+            if not success:
+                return result
+    deferred = DeferredList(deferreds, consumeErrors=True)
+    deferred.addCallback(_first_failure)
+    return deferred
+
+
+def _release(result, waiting):
+    """
+    Fire deferreds waiting on a group commit.
+    """
+    for deferred in waiting:
+        deferred.callback(result)
+    return result
+
+
+class SingleFlight(object):
+    """
+    Shares the result of a read with identical reads issued while it is
+    in flight, so they make a single request to the cluster.
+
+    Every completed write starts a new generation. Reads only join flights
+    from the current generation, so a read issued after a write has
+    finished always sees it.
+    """
+
+    def __init__(self):
+        self.flights = {}
+        self.generation = 0
+        self.reads = 0
+        self.collapsed = 0
+
+    def read(self, method, **kwargs):
+        """
+        Call a read method of CLIENT or join the identical call in flight.
+        """
+        self.reads += 1
+        flight = (self.generation, method, tuple(sorted([
+            (x[0], tuple(x[1]) if isinstance(x[1], list) else x[1])
+                for x in kwargs.items()])))
+        if flight in self.flights:
+            self.collapsed += 1
+            deferred = Deferred()
+            self.flights[flight].append(deferred)
+            return deferred
+        self.flights[flight] = []
+        deferred = getattr(CLIENT, method)(**kwargs)
+        deferred.addBoth(self._land, flight)
+        return deferred
+
+    def _land(self, result, flight):
+        """
+        Pass the result of a flight to the reads that joined it.
+        """
+        for deferred in self.flights.pop(flight):
+            if isinstance(result, Failure):
+                deferred.errback(result)
+            else:
+                deferred.callback(result)
+        return result
+
+    def write(self, method, *args, **kwargs):
+        """
+        Call a write method of CLIENT.
+        """
+        return getattr(CLIENT, method)(*args, **kwargs).addBoth(self.wrote)
+
+    def wrote(self, result=None):
+        """
+        Start a new generation after a write.
+        """
+        self.generation += 1
+        return result
 
 
 BUFFER = Buffer()
+FLIGHTS = SingleFlight()
 
 
 def pack_hour(timestamp=None):
@@ -104,6 +519,15 @@ def unpack_timestamp(timestamp):
     return struct.unpack(">1i", timestamp)[0]
 
 
+def pack_key(key):
+    """
+    Hash a row key tuple. Keys that are already packed are returned as is.
+    """
+    if isinstance(key, tuple):
+        return pack_hash(key)
+    return key
+
+
 def cols_to_dict(columns, prefix=None):
     """
     Convert a Cassandra row into a dictionary.
@@ -137,7 +561,8 @@ def set_user(key, column, value, consistency=None):
     """
     Sets a key and column in the user column family.
     """
-    return CLIENT.insert(
+    return FLIGHTS.write(
+        "insert",
         key=key,
         column_family="user",
         consistency=consistency,
@@ -151,7 +576,8 @@ def get_user(key, column, consistency=None):
     """
     Gets a key and column in the user column family.
     """
-    result = yield CLIENT.get(
+    result = yield FLIGHTS.read(
+        "get",
         key=key,
         column_family="user",
         consistency=consistency,
@@ -164,7 +590,8 @@ def delete_user(key, consistency=None):
     """
     Deletes a key and column in the user column family.
     """
-    return CLIENT.remove(
+    return FLIGHTS.write(
+        "remove",
         key=key,
         column_family="user",
         consistency=consistency)
@@ -178,32 +605,37 @@ def get_relation(
         prefix=None,
         column_ids=None,
         consistency=None,
-        count=10000):
+        count=None):
     """
-    Get a row, column, or slice from the relation column family.
+    Get a row, column, or slice from the relation column family. Slices are
+    read in pages of count columns.
     """
-    key = pack_hash(key)
+    key = pack_key(key)
     if column_id:
-        result = yield CLIENT.get(
+        result = yield FLIGHTS.read(
+            "get",
             key=key,
             column_family="relation",
             consistency=consistency,
             column=column_id)
         returnValue(result.column.value)
     elif column:
-        result = yield CLIENT.get(
+        result = yield FLIGHTS.read(
+            "get",
             key=key,
             column_family="relation",
             consistency=consistency,
             column=pack_hash(column))
         returnValue(result.column.value)
     elif column_ids:
-        result = yield CLIENT.get_slice(
+        column_ids = list(column_ids)
+        result = yield FLIGHTS.read(
+            "get_slice",
             key=key,
             column_family="relation",
             names=column_ids,
             consistency=consistency,
-            count=count)
+            count=len(column_ids))
         returnValue(cols_to_dict(result))
     else:
         if prefix:
@@ -212,22 +644,57 @@ def get_relation(
         else:
             start = ''
             finish = ''
-        result = yield CLIENT.get_slice(
-            key=key,
-            column_family="relation",
-            start=start,
-            finish=finish,
-            consistency=consistency,
-            count=count)
+        result = []
+        yield scan(
+            key,
+            "relation",
+            result.extend,
+            start,
+            finish,
+            consistency,
+            count)
         returnValue(cols_to_dict(result, prefix=prefix))
 
+
+@profile
+@inlineCallbacks
+def get_relation_page(
+        key,
+        prefix=None,
+        cursor=None,
+        limit=100,
+        consistency=None):
+    """
+    Get up to limit columns of a relation row or prefix, starting after
+    the cursor. Returns the columns and the cursor of the next page, which
+    is None on the last page. Cursors are column names without the prefix.
+    """
+    prefix = prefix or ''
+    start = prefix
+    if cursor is not None:
+        start = "".join([prefix, cursor, "\x00"])
+    finish = prefix + HIGH_ID if prefix else ''
+    result = yield FLIGHTS.read(
+        "get_slice",
+        key=pack_key(key),
+        column_family="relation",
+        start=start,
+        finish=finish,
+        consistency=consistency,
+        count=limit + 1)
+    cursor = None
+    if len(result) > limit:
+        result = result[:limit]
+        cursor = result[-1].column.name[len(prefix):]
+    returnValue((cols_to_dict(result, prefix=prefix), cursor))
+
 @profile
 def insert_relation(key, column, value, commit=False):
     """
     Insert a column into the relation column family using a hashed
     column tuple.
     """
-    key = pack_hash(key)
+    key = pack_key(key)
     column_id = pack_hash(column)
     return _insert_relation(key, column_id, value, commit)
 
@@ -236,10 +703,20 @@ def insert_relation_by_id(key, column_id, value, commit=False):
     """
     Insert a column into the relation column family using a column ID.
     """
-    key = pack_hash(key)
+    key = pack_key(key)
     return _insert_relation(key, column_id, value, commit)
 
 
+def insert_relation_once(key, column_id, value):
+    """
+    Insert a relation column whose value never changes, unless KNOWN has
+    it stored.
+    """
+    if KNOWN is not None and KNOWN.known(key, column_id):
+        return
+    BUFFER.insert_relation(key, column_id, value, once=KNOWN is not None)
+
+
 def _insert_relation(key, column_id, value, commit):
     """
     Insert a column into the relation column family.
@@ -254,24 +731,28 @@ def delete_relation(key, column=None, column_id=None, consistency=None):
     """
     Delete a row or column from the relation column family.
     """
-    key = pack_hash(key)
+    key = pack_key(key)
     if column_id:
-        return CLIENT.remove(
+        deferred = FLIGHTS.write(
+            "remove",
             key=key,
             column_family="relation",
             column=column_id,
             consistency=consistency)
     elif column:
-        return CLIENT.remove(
+        deferred = FLIGHTS.write(
+            "remove",
             key=key,
             column_family="relation",
             column=pack_hash(column),
             consistency=consistency)
     else:
-        return CLIENT.remove(
+        deferred = FLIGHTS.write(
+            "remove",
             key=key,
             column_family="relation",
             consistency=consistency)
+    return deferred.addBoth(_forget, [key])
 
 
 @profile
@@ -279,51 +760,191 @@ def delete_relations(keys, consistency=None):
     """
     Delete several relations from the relation column family.
     """
-    keys = [pack_hash(key) for key in keys]
-    return CLIENT.batch_remove_rows({"relation":keys}, consistency=consistency)
+    keys = [pack_key(key) for key in keys]
+    return FLIGHTS.write(
+        "batch_remove_rows",
+        {"relation":keys},
+        consistency=consistency).addBoth(_forget, keys)
+
+
+def _column_name(column):
+    """
+    Name of a column or counter column.
+    """
+    if column.counter_column is not None:
+        return column.counter_column.name
+    return column.column.name
+
+
+@inlineCallbacks
+def scan(
+        key,
+        column_family,
+        consumer,
+        start='',
+        finish='',
+        consistency=None,
+        page_size=None):
+    """
+    Read a slice of a row page_size columns at a time, each page starting
+    after the last column name of the page before. The consumer is called
+    with every page as it arrives and may return a deferred to hold back
+    the next page. Returns the number of columns read.
+    """
+    page_size = page_size or PAGE_SIZE
+    key = pack_key(key)
+    total = 0
+    while not finish or start <= finish:
+        result = yield FLIGHTS.read(
+            "get_slice",
+            key=key,
+            column_family=column_family,
+            consistency=consistency,
+            start=start,
+            finish=finish,
+            count=page_size)
+        if result:
+            total += len(result)
+            yield consumer(result)
+        if len(result) < page_size:
+            break
+        start = _column_name(result[-1]) + "\x00"
+    returnValue(total)
+
+
+def _get_counter_slice(key, consistency, prefix, start, finish, cached):
+    """
+    Get a slice of counter columns, optionally within a column prefix, as
+    a list of names without the prefix and a list of values. Cached reads
+    go through CACHE if there is one.
+    """
+    if cached and CACHE is not None:
+        return CACHE.get(
+            (pack_key(key), prefix or '', start, finish),
+            lambda:_read_counter_slice(key, consistency, prefix, start, finish))
+    return _read_counter_slice(key, consistency, prefix, start, finish)
 
 
-@profile
 @inlineCallbacks
-def get_counter(key, consistency=None, prefix=None, start='', finish=''):
+def _read_counter_slice(key, consistency, prefix, start, finish):
     """
-    Get all columns from a row of counters.
+    Read a slice for _get_counter_slice().
     """
-    key = pack_hash(key)
+    prefix_length = len(prefix or '')
     if prefix:
         start = "".join([prefix, start])
         finish = "".join([prefix, finish, HIGH_ID])
-    result = yield CLIENT.get_slice(
-        key=key,
-        column_family="counter",
-        consistency=consistency,
-        start=start,
-        finish=finish,
-        count=10000)
-    returnValue(counter_cols_to_dict(result, prefix=prefix))
+    result = []
+    yield scan(key, "counter", result.extend, start, finish, consistency)
+    returnValue((
+        [x.counter_column.name[prefix_length:] for x in result],
+        [x.counter_column.value for x in result]))
+
+
+@profile
+@inlineCallbacks
+def get_counter(
+        key,
+        consistency=None,
+        prefix=None,
+        start='',
+        finish='',
+        cached=False):
+    """
+    Get all columns from a row of counters. Cached reads may be up to the
+    cache's TTL old, plus increments flushed by this process.
+    """
+    names, values = yield _get_counter_slice(
+        key,
+        consistency,
+        prefix,
+        start,
+        finish,
+        cached)
+    returnValue(defaultdict(lambda:0, zip(names, values)))
+
+
+@profile
+def get_counter_arrays(
+        key,
+        consistency=None,
+        prefix=None,
+        start='',
+        finish='',
+        cached=False):
+    """
+    Get columns from a row of counters as a list of names, without the
+    prefix, and a list of values.
+    """
+    return _get_counter_slice(key, consistency, prefix, start, finish, cached)
+
+
+@profile
+def get_timed_counter(
+        key,
+        prefix,
+        start,
+        finish,
+        period,
+        consistency=None):
+    """
+    Get columns named packed timestamp + suffix from a row of counters
+    with timestamps from start to finish, as a list of names without the
+    prefix and a list of values. Periods of period seconds that have ended
+    are read from PERIODS if there is one.
+    """
+    key = pack_key(key)
+    start = int(start or time.time())
+    finish = int(finish or time.time())
+    def load(start, finish, closed):
+        return get_counter_arrays(
+            key,
+            consistency,
+            prefix,
+            pack_timestamp(start),
+            pack_timestamp(finish),
+            cached=not closed)
+    if PERIODS is None:
+        return load(start, finish, False)
+    return PERIODS.get(key, prefix, start, finish, period, load)
 
 
 @profile
 @inlineCallbacks
 def get_counters(keys, consistency=None, prefix=None):
     """
-    Get counters from several rows at once.
+    Get counters from several rows at once. Rows that fill the first page
+    are read to the end one at a time.
     """
-    keys = [pack_hash(key) for key in keys]
+    keys = [pack_key(key) for key in keys]
     if prefix:
         start = prefix
         finish = prefix + HIGH_ID
     else:
         start = ''
         finish = ''
-    data = yield CLIENT.multiget_slice(
+    data = yield FLIGHTS.read(
+        "multiget_slice",
         keys=keys,
         column_family="counter",
         consistency=consistency,
         start=start,
         finish=finish,
-        count=10000)
-    returnValue([counter_cols_to_dict(data[x], prefix=prefix) for x in keys])
+        count=PAGE_SIZE)
+    rows = []
+    for key in keys:
+        # Results may be shared with other reads, so copy before extending.
+        result = list(data.get(key, []))
+        if len(result) == PAGE_SIZE:
+            yield scan(
+                key,
+                "counter",
+                result.extend,
+                _column_name(result[-1]) + "\x00",
+                finish,
+                consistency)
+        rows.append(counter_cols_to_dict(result, prefix=prefix))
+    returnValue(rows)
 
 
 @profile
@@ -336,7 +957,7 @@ def increment_counter(
     """
     Increment a counter specified by a hashed column tuple or a column_id.
     """
-    key = pack_hash(key)
+    key = pack_key(key)
     column_id = column_id or pack_hash(column)
     BUFFER.increment_counter(key, column_id, value)
     if commit:
@@ -348,29 +969,66 @@ def delete_counter(key, column=None, column_id=None, consistency=None):
     """
     Delete a row or column from the counter CF.
     """
-    key = pack_hash(key)
+    key = pack_key(key)
     if column_id:
-        return CLIENT.remove_counter(
+        deferred = FLIGHTS.write(
+            "remove_counter",
             key=key,
             column_family="counter",
             column=column_id,
             consistency=consistency)
     elif column:
-        return CLIENT.remove_counter(
+        deferred = FLIGHTS.write(
+            "remove_counter",
             key=key,
             column_family="counter",
             column=pack_hash(column),
             consistency=consistency)
     else:
-        return CLIENT.remove_counter(
+        deferred = FLIGHTS.write(
+            "remove_counter",
             key=key,
             column_family="counter",
             consistency=consistency)
+    return deferred.addBoth(_invalidate, [key])
 
 @profile
 def delete_counters(keys, consistency=None):
     """
     Delete several counters from the counter column family.
     """
-    keys = [pack_hash(key) for key in keys]
-    return CLIENT.batch_remove_rows({"counter":keys}, consistency=consistency)
+    keys = [pack_key(key) for key in keys]
+    deferred = FLIGHTS.write(
+        "batch_remove_rows",
+        {"counter":keys},
+        consistency=consistency)
+    return deferred.addBoth(_invalidate, keys)
+
+
+def _invalidate(result, keys):
+    """
+    Drop cached columns of counter rows after a delete.
+    """
+    if CACHE is not None:
+        CACHE.invalidate(keys)
+    if PERIODS is not None:
+        PERIODS.invalidate(keys)
+    return result
+
+
+def _known(result, relation, once):
+    """
+    Note the columns inserted once of a flushed relation chunk.
+    """
+    KNOWN.add(dict([(key, [x for x in relation[key] if x in once[key]])
+        for key in relation if key in once]))
+    return result
+
+
+def _forget(result, keys):
+    """
+    Forget known columns of relation rows after a delete.
+    """
+    if KNOWN is not None:
+        KNOWN.forget(keys)
+    return result
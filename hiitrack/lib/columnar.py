@@ -0,0 +1,70 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Columnar decoding of timed counter slices. Uses NumPy when it is installed.
+"""
+
+import struct
+from collections import defaultdict
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+_TIMESTAMP = struct.Struct(">1i")
+
+
+def decode_timed(names, values):
+    """
+    Group counter columns named packed timestamp + id by id.
+
+    names are fixed width column names (prefix removed) whose first four
+    bytes are a big-endian timestamp. Returns a list of
+    (id, timestamps, counts) with the timestamps in ascending order.
+    """
+    if not names:
+        return []
+    width = len(names[0])
+    if numpy is None or (width - 4) % 8 or \
+            any([len(x) != width for x in names]):
+        return _decode_timed(names, values)
+    matrix = numpy.frombuffer("".join(names), dtype=numpy.uint8)
+    matrix = matrix.reshape(len(names), width)
+    timestamps = numpy.ascontiguousarray(matrix[:, 0:4]).view(">i4")[:, 0]
+    counts = numpy.array(values, dtype=numpy.int64)
+    ids = numpy.ascontiguousarray(matrix[:, 4:])
+    # Big-endian words order the same way as the id bytes.
+    words = ids.view(">u8")
+    sort_keys = [timestamps] + \
+        [words[:, i] for i in range(words.shape[1] - 1, -1, -1)]
+    order = numpy.lexsort(sort_keys)
+    timestamps = timestamps[order]
+    counts = counts[order]
+    words = words[order]
+    changes = numpy.any(words[1:] != words[:-1], axis=1)
+    starts = numpy.concatenate(([0], numpy.nonzero(changes)[0] + 1))
+    ends = numpy.concatenate((starts[1:], [len(order)]))
+    ids = ids[order]
+    return [(
+        ids[start].tostring(),
+        timestamps[start:end].tolist(),
+        counts[start:end].tolist()) for start, end in zip(starts, ends)]
+
+
+def _decode_timed(names, values):
+    """
+    Pure Python version of decode_timed.
+    """
+    groups = defaultdict(list)
+    for name, value in zip(names, values):
+        groups[name[4:]].append((name[0:4], value))
+    result = []
+    for _id in sorted(groups):
+        columns = sorted(groups[_id])
+        result.append((
+            _id,
+            [_TIMESTAMP.unpack(x[0])[0] for x in columns],
+            [x[1] for x in columns]))
+    return result
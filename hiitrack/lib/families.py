@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Counter families a bucket can turn off.
+"""
+
+import ujson
+from pylru import lrucache
+from twisted.internet.defer import inlineCallbacks, returnValue
+from telephus.cassandra.c08.ttypes import NotFoundException
+from .cassandra import get_relation
+
+
+# Each family covers its unique variant. property_event is the property
+# columns of the event totals and the property rows, property_path the
+# property columns of the paths, whose totals are in the path rows.
+FAMILIES = (
+    "hourly_event",
+    "daily_event",
+    "path",
+    "hourly_path",
+    "daily_path",
+    "property_event",
+    "property_path")
+DISABLED_CACHE = lrucache(1000)
+
+
+def parse_families(value):
+    """
+    Sorted tuple of the families in a comma separated list.
+    """
+    families = tuple(sorted(set([x.strip() for x in value.split(",")
+        if x.strip()])))
+    for family in families:
+        if family not in FAMILIES:
+            raise ValueError("Unknown counter family %s." % family)
+    return families
+
+
+@inlineCallbacks
+def get_disabled(user_name, bucket_name):
+    """
+    Families a bucket was created without, read from its bucket relation
+    column. Buckets are never changed, so they are cached.
+    """
+    cache_key = (user_name, bucket_name)
+    if cache_key in DISABLED_CACHE:
+        returnValue(DISABLED_CACHE[cache_key])
+    try:
+        data = yield get_relation(
+            (user_name, "bucket"),
+            column_id=bucket_name)
+    except NotFoundException:
+        returnValue(frozenset())
+    disabled = DISABLED_CACHE[cache_key] = frozenset(
+        ujson.loads(data).get("disabled", []))
+    returnValue(disabled)
+
+
+def forget_disabled(user_name, bucket_name):
+    """
+    Drop the cached families of a deleted bucket.
+    """
+    if (user_name, bucket_name) in DISABLED_CACHE:
+        del DISABLED_CACHE[(user_name, bucket_name)]
@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Registry of events whose counter rows are split into salted sub-rows.
+"""
+
+import time
+import ujson
+from random import randrange
+from collections import defaultdict
+from twisted.internet.defer import inlineCallbacks, returnValue
+from twisted.python import log
+from .cassandra import get_relation, insert_relation_by_id
+from .hash import pack_hash
+
+
+HOT_EVENT_KINDS = ("event", "unique_event", "path", "unique_path")
+
+
+class HotEvents(object):
+    """
+    Finds events added more than rate times a second and spreads their
+    event, unique_event, path, and unique_path increments over subrows
+    salted rows of their own, so one popular event does not make every
+    writer contend for the same counter cells.
+
+    Adds are counted per window seconds. An event over the rate at the end
+    of a window is registered in the bucket's hot_event relation row with
+    its number of sub-rows, and stays hot. Reads sum the shard row and the
+    sub-rows of the events registered there, reloading a bucket's
+    registry after ttl seconds, so events found hot by other processes are
+    read from their sub-rows within ttl. Increments of a hot event go on
+    to the shard row until ttl seconds after its registration is stored,
+    or after it is loaded from the registry, so no reader misses them.
+    Keep subrows and ttl the same across processes and restarts.
+    """
+
+    def __init__(self, rate, subrows=16, window=60, ttl=60):
+        if not 0 < subrows <= 256:
+            raise ValueError("Hot event sub-rows must be 1 to 256.")
+        self.rate = rate
+        self.subrows = subrows
+        self.window = window
+        self.ttl = ttl
+        self.window_start = time.time()
+        self.counts = defaultdict(lambda:0)
+        self.hot = defaultdict(dict)
+        # Time from which every reader has the hot events that are not yet
+        # salted, or None while the registration is being stored.
+        self.since = defaultdict(dict)
+        self.loaded = {}
+        self.salted = 0
+
+    def record(self, keys, event_id, count=1):
+        """
+        Count adds of an event, registering the events over the rate when
+        a window ends.
+        """
+        self.counts[(keys, event_id)] += count
+        now = time.time()
+        if now - self.window_start < self.window:
+            return
+        threshold = self.rate * (now - self.window_start)
+        for (_keys, _event_id), _count in self.counts.items():
+            bucket = _bucket(_keys)
+            hot = self.hot[bucket]
+            if _count > threshold and _event_id not in hot:
+                hot[_event_id] = self.subrows
+                self.since[bucket][_event_id] = None
+                deferred = insert_relation_by_id(
+                    _keys.relation("hot_event"),
+                    _event_id,
+                    ujson.dumps(self.subrows),
+                    commit=True)
+                deferred.addCallbacks(
+                    self._registered,
+                    self._unregistered,
+                    callbackArgs=(bucket, _event_id),
+                    errbackArgs=(bucket, _event_id))
+        self.counts.clear()
+        self.window_start = now
+
+    def row(self, keys, kind, event_id):
+        """
+        Key of the row an increment of kind for an event goes to, a random
+        one of the event's sub-rows if it is hot and every reader has it.
+        """
+        bucket = _bucket(keys)
+        subrows = self.hot[bucket].get(event_id)
+        if subrows is None or not self._salting(bucket, event_id):
+            return keys.counter(kind, event_id[0])
+        self.salted += 1
+        return _salted_row(keys, kind, event_id, randrange(subrows))
+
+    @inlineCallbacks
+    def rows(self, keys, kind, event_id):
+        """
+        Keys of the shard row and the sub-rows of kind holding an event's
+        counters.
+        """
+        hot = yield self.load(keys)
+        subrows = hot.get(event_id, 0)
+        returnValue([keys.counter(kind, event_id[0])] + \
+            hot_event_rows(keys, kind, event_id, subrows))
+
+    @inlineCallbacks
+    def load(self, keys):
+        """
+        Read a bucket's registry if it was not read in the last ttl
+        seconds. Returns the hot events and their number of sub-rows.
+        """
+        bucket = _bucket(keys)
+        now = time.time()
+        if now - self.loaded.get(bucket, 0) >= self.ttl:
+            data = yield get_relation(keys.relation("hot_event"))
+            self.loaded[bucket] = now
+            for event_id, subrows in data.items():
+                if event_id not in self.hot[bucket]:
+                    # Registered by another process at some point up to now.
+                    self.since[bucket][event_id] = now
+                self.hot[bucket][event_id] = ujson.loads(subrows)
+        returnValue(self.hot[bucket])
+
+    def _salting(self, bucket, event_id):
+        """
+        True once ttl seconds have passed since every reader could load a
+        hot event from the registry.
+        """
+        since = self.since[bucket]
+        if event_id not in since:
+            return True
+        if since[event_id] is None or time.time() - since[event_id] < self.ttl:
+            return False
+        del since[event_id]
+        return True
+
+    def _registered(self, result, bucket, event_id):
+        """
+        Start the wait of a hot event once its registration is stored.
+        """
+        if event_id in self.since.get(bucket, {}):
+            self.since[bucket][event_id] = time.time()
+
+    def _unregistered(self, failure, bucket, event_id):
+        """
+        Let an event whose registration failed be found hot again.
+        """
+        log.err(failure, "Hot event registration failed.")
+        self.hot[bucket].pop(event_id, None)
+        self.since[bucket].pop(event_id, None)
+
+    def forget(self, keys):
+        """
+        Drop the state of a deleted bucket.
+        """
+        bucket = _bucket(keys)
+        self.hot.pop(bucket, None)
+        self.since.pop(bucket, None)
+        self.loaded.pop(bucket, None)
+        for key in self.counts.keys():
+            if _bucket(key[0]) == bucket:
+                del self.counts[key]
+
+
+def _bucket(keys):
+    """
+    (user_name, bucket_name) of a key table.
+    """
+    return (keys.user_name, keys.bucket_name)
+
+
+def _salted_row(keys, kind, event_id, salt):
+    """
+    Packed key of a hot event's sub-row of kind.
+    """
+    return pack_hash((
+        keys.user_name,
+        keys.bucket_name,
+        kind,
+        event_id,
+        "hot/%s" % salt))
+
+
+def hot_event_rows(keys, kind, event_id, subrows):
+    """
+    Packed keys of every sub-row of kind of a hot event.
+    """
+    return [_salted_row(keys, kind, event_id, x) for x in range(subrows)]
@@ -0,0 +1,254 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Precomputed row keys for a bucket's relation and sharded counter rows.
+"""
+
+import calendar
+import struct
+from datetime import datetime
+from pylru import lrucache
+from ..lib.hash import pack_hash
+
+
+RELATION_KINDS = (
+    "event",
+    "funnel",
+    "property",
+    "property_name",
+    "time_partition",
+    "hot_event",
+    "rollup")
+COUNTER_KINDS = (
+    "property",
+    "event",
+    "hourly_event",
+    "daily_event",
+    "unique_event",
+    "hourly_unique_event",
+    "daily_unique_event",
+    "path",
+    "hourly_path",
+    "daily_path",
+    "unique_path",
+    "hourly_unique_path",
+    "daily_unique_path",
+    "visitor_event",
+    "visitor_path",
+    "visitor_property")
+TIMED_KINDS = tuple([x for x in COUNTER_KINDS
+    if x.startswith("hourly") or x.startswith("daily")])
+SHARDS = 256
+_COUNTER_INDEX = dict([(x, i * SHARDS) for i, x in enumerate(COUNTER_KINDS)])
+KEY_CACHE = lrucache(256)
+_PARTITION = struct.Struct(">I")
+
+
+class BucketKeys(object):
+    """
+    Table of packed row keys covering every counter kind and shard of a
+    bucket. Keys are hashed the first time they are used.
+    """
+
+    def __init__(self, user_name, bucket_name):
+        self.user_name = user_name
+        self.bucket_name = bucket_name
+        self.relations = dict([
+            (x, pack_hash((user_name, bucket_name, x)))
+                for x in RELATION_KINDS])
+        self.rows = [None] * (len(COUNTER_KINDS) * SHARDS)
+        self.states = [None] * SHARDS
+
+    def relation(self, kind):
+        """
+        Packed key of a bucket relation row.
+        """
+        return self.relations[kind]
+
+    def counter(self, kind, shard):
+        """
+        Packed key of a sharded counter row.
+        """
+        index = _COUNTER_INDEX[kind] + ord(shard)
+        key = self.rows[index]
+        if key is None:
+            key = self.rows[index] = pack_hash((
+                self.user_name,
+                self.bucket_name,
+                kind,
+                shard))
+        return key
+
+    def state(self, shard):
+        """
+        Packed key of a sharded visitor state relation row.
+        """
+        index = ord(shard)
+        key = self.states[index]
+        if key is None:
+            key = self.states[index] = pack_hash((
+                self.user_name,
+                self.bucket_name,
+                "visitor_state",
+                shard))
+        return key
+
+    def property(self, property_id):
+        """
+        Packed key of the relation row of a property's values.
+        """
+        return pack_hash((
+            self.user_name,
+            self.bucket_name,
+            "property",
+            property_id))
+
+    def counters(self):
+        """
+        Packed keys of every counter row in the bucket.
+        """
+        return [self.counter(kind, chr(i))
+            for kind in COUNTER_KINDS for i in range(0, SHARDS)]
+
+
+class VisitorPartitions(object):
+    """
+    Maps visitors to the rows holding their visitor_event, visitor_path,
+    visitor_property, and visitor_state columns.
+
+    Visitors are split into partitions by the leading bits of their ID.
+    With the default 256 partitions these are the bucket's shard rows.
+    Other partition counts use rows of their own, so a bucket can be
+    migrated from one scheme to another while both are read.
+    """
+
+    def __init__(self, partitions=SHARDS):
+        if not 0 < partitions <= 65536:
+            raise ValueError("Visitor partitions must be 1 to 65536.")
+        self.partitions = partitions
+
+    def partition(self, visitor_id):
+        """
+        Partition of a visitor.
+        """
+        return _PARTITION.unpack(visitor_id[0:4])[0] * self.partitions >> 32
+
+    def row(self, keys, kind, visitor_id):
+        """
+        Packed key of a visitor's row of kind.
+        """
+        if self.partitions == SHARDS:
+            if kind == "visitor_state":
+                return keys.state(visitor_id[0])
+            return keys.counter(kind, visitor_id[0])
+        return self._row(keys, kind, self.partition(visitor_id))
+
+    def rows(self, keys, kind):
+        """
+        Packed keys of every row of kind in the bucket.
+        """
+        if self.partitions == SHARDS:
+            if kind == "visitor_state":
+                return [keys.state(chr(i)) for i in range(SHARDS)]
+            return [keys.counter(kind, chr(i)) for i in range(SHARDS)]
+        return [self._row(keys, kind, i) for i in range(self.partitions)]
+
+    def _row(self, keys, kind, partition):
+        """
+        Packed key of a partition's row of kind.
+        """
+        return pack_hash((
+            keys.user_name,
+            keys.bucket_name,
+            kind,
+            "%s/%s" % (self.partitions, partition)))
+
+
+class TimePartitions(object):
+    """
+    Splits the hourly and daily counter rows of a bucket by time.
+
+    Each column goes to the row of the partition its hour or day starts
+    in. Partitions are calendar months (UTC) for the period "month", or
+    runs of period seconds since the epoch for a number. Rows of a
+    partition are keyed by the period as well as the partition start, so
+    rows written under different periods never mix.
+    """
+
+    def __init__(self, period="month"):
+        if period != "month" and not int(period) > 0:
+            raise ValueError("Time partitions must be 'month' or seconds.")
+        self.period = str(period)
+        self.keys = lrucache(4096)
+
+    def partition(self, timestamp):
+        """
+        Start of the partition of a timestamp.
+        """
+        timestamp = int(timestamp)
+        if self.period == "month":
+            date = datetime.utcfromtimestamp(timestamp)
+            return calendar.timegm((date.year, date.month, 1, 0, 0, 0))
+        return timestamp - timestamp % int(self.period)
+
+    def next(self, partition):
+        """
+        Start of the partition after the one starting at partition.
+        """
+        if self.period == "month":
+            date = datetime.utcfromtimestamp(partition)
+            year, month = divmod(date.year * 12 + date.month, 12)
+            return calendar.timegm((year, month + 1, 1, 0, 0, 0))
+        return partition + int(self.period)
+
+    def ranges(self, start, finish):
+        """
+        (partition, start, finish) of every partition overlapping start to
+        finish, clipped to it.
+        """
+        result = []
+        partition = self.partition(start)
+        while partition <= finish:
+            following = self.next(partition)
+            result.append((
+                partition,
+                max(start, partition),
+                min(finish, following - 1)))
+            partition = following
+        return result
+
+    def row(self, keys, kind, shard, partition):
+        """
+        Packed key of a partition's row of a timed counter kind and shard.
+        """
+        cache_key = (keys.user_name, keys.bucket_name, kind, shard, partition)
+        try:
+            return self.keys[cache_key]
+        except KeyError:
+            key = self.keys[cache_key] = pack_hash((
+                keys.user_name,
+                keys.bucket_name,
+                kind,
+                shard,
+                "%s/%s" % (self.period, partition)))
+            return key
+
+    def rows(self, keys, partition):
+        """
+        Packed keys of every timed counter row of a partition.
+        """
+        return [self.row(keys, kind, chr(i), partition)
+            for kind in TIMED_KINDS for i in range(SHARDS)]
+
+
+def bucket_keys(user_name, bucket_name):
+    """
+    Cached key table for a bucket.
+    """
+    cache_key = (user_name, bucket_name)
+    try:
+        return KEY_CACHE[cache_key]
+    except KeyError:
+        keys = KEY_CACHE[cache_key] = BucketKeys(user_name, bucket_name)
+        return keys
@@ -0,0 +1,99 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Registry of relation columns known to be stored.
+"""
+
+import time
+from pylru import lrucache
+from .bloom import BloomFilter
+from .hash import pack_hash
+
+
+class KnownColumns(object):
+    """
+    Per-row sets of relation column IDs inserted with
+    insert_relation_once() and flushed to the cluster, used to skip
+    re-inserting columns whose value never changes, such as event and
+    property value names.
+
+    A row's set holds up to size IDs and then becomes a Bloom filter with
+    capacity IDs at error_rate false positives. A false positive skips a
+    column that was never stored, so the rate is kept low. Up to rows rows
+    are kept, the least recently used dropped first.
+
+    Deleting a row through this process forgets it. A row deleted through
+    another process, e.g. with its bucket, is still known here until ttl
+    seconds after this process first noted it, so names of a recreated
+    bucket may be missing for up to ttl seconds.
+    """
+
+    def __init__(
+            self,
+            size=10000,
+            capacity=1000000,
+            error_rate=0.000001,
+            rows=1000,
+            ttl=3600):
+        self.size = size
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.ttl = ttl
+        self.rows = lrucache(rows)
+        self.avoided = 0
+
+    def _row(self, key):
+        """
+        IDs of a row that has not expired, or None.
+        """
+        entry = self.rows.get(key)
+        if entry is None:
+            return None
+        if time.time() - entry[0] >= self.ttl:
+            del self.rows[key]
+            return None
+        return entry[1]
+
+    def known(self, key, column_id):
+        """
+        True if the column is stored, counting the write it avoids.
+        """
+        row = self._row(key)
+        if row is None:
+            return False
+        if isinstance(row, BloomFilter):
+            column_id = pack_hash((column_id,))
+        if column_id in row:
+            self.avoided += 1
+            return True
+        return False
+
+    def add(self, relation):
+        """
+        Note the columns of a flushed {key: {column_id: value}} mapping.
+        """
+        for key, columns in relation.items():
+            row = self._row(key)
+            if row is None:
+                row = set()
+                self.rows[key] = [time.time(), row]
+            if isinstance(row, set):
+                row.update(columns)
+                if len(row) <= self.size:
+                    continue
+                bloom_filter = BloomFilter(self.capacity, self.error_rate)
+                self.rows[key][1] = bloom_filter
+                columns = row
+            else:
+                bloom_filter = row
+            for column_id in columns:
+                bloom_filter.add(pack_hash((column_id,)))
+
+    def forget(self, keys):
+        """
+        Forget deleted rows.
+        """
+        for key in keys:
+            if key in self.rows:
+                del self.rows[key]
@@ -0,0 +1,250 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+In-memory storage backend for benchmarks and tests.
+"""
+
+from bisect import bisect_left, bisect_right, insort
+from collections import defaultdict
+from random import Random
+from twisted.internet import reactor
+from twisted.internet.defer import maybeDeferred
+from twisted.internet.task import deferLater
+from telephus.cassandra.c08.ttypes import NotFoundException, \
+    TimedOutException
+from ..lib.backend import Backend, column_result
+
+
+class _Row(object):
+    """
+    Columns of a row, kept sorted by name.
+    """
+
+    __slots__ = ("names", "values")
+
+    def __init__(self):
+        self.names = []
+        self.values = {}
+
+    def set(self, name, value):
+        """
+        Set a column value.
+        """
+        if name not in self.values:
+            insort(self.names, name)
+        self.values[name] = value
+
+    def add(self, name, value):
+        """
+        Add to a counter column.
+        """
+        self.set(name, self.values.get(name, 0) + value)
+
+    def remove(self, name):
+        """
+        Remove a column if it exists.
+        """
+        if name in self.values:
+            del self.values[name]
+            del self.names[bisect_left(self.names, name)]
+
+    def slice(self, start, finish, count, reverse):
+        """
+        Column names between start and finish, inclusive.
+        """
+        if reverse:
+            start, finish = finish, start
+        if start:
+            low = bisect_left(self.names, start)
+        else:
+            low = 0
+        if finish:
+            high = bisect_right(self.names, finish)
+        else:
+            high = len(self.names)
+        names = self.names[low:high]
+        if reverse:
+            names.reverse()
+        return names[:count]
+
+
+class MemoryBackend(Backend):
+    """
+    Sorted in-memory column families with counter semantics.
+
+    latency is a number of seconds (or a callable returning one) to delay
+    each response by. failure_rate is the probability that a call fails
+    with TimedOutException without being applied.
+    """
+
+    def __init__(self, latency=0, failure_rate=0, seed=None):
+        self.data = defaultdict(dict)
+        self.latency = latency
+        self.failure_rate = failure_rate
+        self.random = Random(seed)
+        self.calls = defaultdict(lambda:0)
+
+    def _respond(self, method, *args):
+        """
+        Run method after the injected latency, or fail.
+        """
+        self.calls[method.__name__.lstrip("_")] += 1
+        if self.failure_rate and self.random.random() < self.failure_rate:
+            method, args = _time_out, ()
+        if callable(self.latency):
+            delay = self.latency()
+        else:
+            delay = self.latency
+        if delay:
+            return deferLater(reactor, delay, method, *args)
+        return maybeDeferred(method, *args)
+
+    def _row(self, column_family, key, create=False):
+        """
+        Return a row, optionally creating it.
+        """
+        rows = self.data[column_family]
+        if create and key not in rows:
+            rows[key] = _Row()
+        return rows.get(key)
+
+    def _slice(self, column_family, key, names, start, finish, count, reverse):
+        """
+        Return a list of column results.
+        """
+        row = self._row(column_family, key)
+        if row is None:
+            return []
+        counter = column_family in self.counter_column_families
+        if names is not None:
+            names = sorted([x for x in names if x in row.values])
+            if reverse:
+                names.reverse()
+        else:
+            names = row.slice(start, finish, count, reverse)
+        return [column_result(x, row.values[x], counter) for x in names]
+
+    def get(self, key, column_family, column, consistency=None):
+        return self._respond(self._get, key, column_family, column)
+
+    def _get(self, key, column_family, column):
+        row = self._row(column_family, key)
+        if row is None or column not in row.values:
+            raise NotFoundException()
+        counter = column_family in self.counter_column_families
+        return column_result(column, row.values[column], counter)
+
+    def get_slice(
+            self,
+            key,
+            column_family,
+            names=None,
+            start='',
+            finish='',
+            count=100,
+            reverse=False,
+            consistency=None):
+        return self._respond(
+            self._slice,
+            column_family,
+            key,
+            names,
+            start,
+            finish,
+            count,
+            reverse)
+
+    def multiget_slice(
+            self,
+            keys,
+            column_family,
+            names=None,
+            start='',
+            finish='',
+            count=100,
+            reverse=False,
+            consistency=None):
+        return self._respond(
+            self._multiget_slice,
+            keys,
+            column_family,
+            names,
+            start,
+            finish,
+            count,
+            reverse)
+
+    def _multiget_slice(
+            self,
+            keys,
+            column_family,
+            names,
+            start,
+            finish,
+            count,
+            reverse):
+        return dict([(key, self._slice(
+            column_family,
+            key,
+            names,
+            start,
+            finish,
+            count,
+            reverse)) for key in keys])
+
+    def insert(self, key, column_family, value, column, consistency=None):
+        return self._respond(
+            self._batch_multikey_insert,
+            column_family,
+            {key: {column: value}})
+
+    def batch_multikey_insert(self, column_family, mapping, consistency=None):
+        return self._respond(
+            self._batch_multikey_insert,
+            column_family,
+            mapping)
+
+    def _batch_multikey_insert(self, column_family, mapping):
+        for key in mapping:
+            row = self._row(column_family, key, create=True)
+            for column, value in mapping[key].items():
+                row.set(column, value)
+
+    def batch_multikey_add(self, column_family, mapping, consistency=None):
+        return self._respond(self._batch_multikey_add, column_family, mapping)
+
+    def _batch_multikey_add(self, column_family, mapping):
+        for key in mapping:
+            row = self._row(column_family, key, create=True)
+            for column, value in mapping[key].items():
+                row.add(column, value)
+
+    def remove(self, key, column_family, column=None, consistency=None):
+        return self._respond(self._remove, key, column_family, column)
+
+    def remove_counter(self, key, column_family, column=None, consistency=None):
+        return self._respond(self._remove, key, column_family, column)
+
+    def _remove(self, key, column_family, column):
+        if column is None:
+            self.data[column_family].pop(key, None)
+            return
+        row = self._row(column_family, key)
+        if row is not None:
+            row.remove(column)
+
+    def batch_remove_rows(self, mapping, consistency=None):
+        return self._respond(self._batch_remove_rows, mapping)
+
+    def _batch_remove_rows(self, mapping):
+        for column_family in mapping:
+            for key in mapping[column_family]:
+                self.data[column_family].pop(key, None)
+
+
+def _time_out():
+    """
+    Injected failure.
+    """
+    raise TimedOutException()
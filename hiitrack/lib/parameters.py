@@ -5,7 +5,10 @@
 Checks for required parameters.
 """
 
-from ..exceptions import MissingParameterException
+from ..exceptions import MissingParameterException, \
+    InvalidParameterException
+from ..lib import cassandra
+from ..lib.b64encode import uri_b64decode
 from functools import wraps
 
 
@@ -32,3 +35,25 @@ def require(*required_parameters):
             return method(*args, **kwargs)
         return wraps(method)(wrapper)
     return decorator
+
+
+def page(request):
+    """
+    Return the (cursor, limit) paging parameters of a request. The limit
+    is None if the request did not ask for a page and is capped at
+    cassandra.PAGE_SIZE.
+    """
+    if "limit" not in request.args:
+        return None, None
+    try:
+        limit = int(request.args["limit"][0])
+        assert limit > 0
+        cursor = None
+        if request.args.get("cursor", [""])[0]:
+            cursor = uri_b64decode(request.args["cursor"][0])
+    except (ValueError, TypeError, AssertionError):
+        request.setResponseCode(400)
+        raise InvalidParameterException("Parameter 'limit' must be a "
+            "positive integer and 'cursor' a value returned by a previous "
+            "page.")
+    return cursor, min(limit, cassandra.PAGE_SIZE)
@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Persistent cache of hourly and daily counters for periods that have ended.
+"""
+
+import sqlite3
+import struct
+import time
+from twisted.internet.defer import inlineCallbacks, returnValue, \
+    gatherResults
+
+
+_TIMESTAMP = struct.Struct(">1i")
+
+
+class PeriodCache(object):
+    """
+    Keeps the columns of timed counter rows, named packed timestamp +
+    suffix after a prefix, for periods that can no longer change.
+
+    Counters are only incremented in the current hour or day, so a period
+    is closed once it ended more than grace seconds ago. The grace covers
+    increments that are still buffered when the period ends. Each
+    (row, prefix) has one covered interval of timestamps whose columns
+    are all stored locally; reads only go to the cluster for the open
+    periods and for closed periods outside that interval.
+
+    Increments replayed from a write-ahead log more than grace seconds
+    after their period ended are not seen by periods already stored.
+    """
+
+    def __init__(self, path, grace=300):
+        self.path = path
+        self.grace = grace
+        self.connection = sqlite3.connect(path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS period (key BLOB NOT NULL, "
+            "prefix BLOB NOT NULL, name BLOB NOT NULL, "
+            "value INTEGER NOT NULL, PRIMARY KEY (key, prefix, name)) "
+            "WITHOUT ROWID")
+        self.connection.execute(
+            "CREATE TABLE IF NOT EXISTS coverage (key BLOB NOT NULL, "
+            "prefix BLOB NOT NULL, start INTEGER NOT NULL, "
+            "finish INTEGER NOT NULL, PRIMARY KEY (key, prefix)) "
+            "WITHOUT ROWID")
+        self.generation = 0
+        self.hits = 0
+        self.misses = 0
+
+    def close(self):
+        """
+        Close the database.
+        """
+        self.connection.close()
+
+    def closed(self, period, now=None):
+        """
+        Start of the latest closed period of period seconds.
+        """
+        now = now or time.time()
+        return int(now - self.grace) // period * period - period
+
+    @inlineCallbacks
+    def get(self, key, prefix, start, finish, period, load):
+        """
+        Get the columns with timestamps from start to finish as a list of
+        names without the prefix and a list of values. load(start, finish,
+        closed) reads the columns from start to finish from the cluster.
+        """
+        if finish < start:
+            returnValue(([], []))
+        closed = self.closed(period)
+        generation = self.generation
+        fetch = []
+        coverage = None
+        if start <= closed:
+            covered = self._coverage(key, prefix)
+            last = min(finish, closed)
+            if covered is None:
+                fetch.append((start, last))
+                coverage = (start, last)
+            else:
+                if start < covered[0]:
+                    fetch.append((start, covered[0] - 1))
+                if last > covered[1]:
+                    fetch.append((covered[1] + 1, last))
+                coverage = (min(start, covered[0]), max(last, covered[1]))
+            if fetch:
+                self.misses += 1
+            else:
+                self.hits += 1
+        deferreds = [load(x[0], x[1], True) for x in fetch]
+        if finish > closed:
+            deferreds.append(load(max(start, closed + 1), finish, False))
+        results = yield gatherResults(deferreds)
+        if generation != self.generation:
+            # Rows were deleted while reading, start over.
+            result = yield self.get(key, prefix, start, finish, period, load)
+            returnValue(result)
+        if fetch:
+            self._store(key, prefix, results[0:len(fetch)], coverage)
+        names, values = [], []
+        if start <= closed:
+            names, values = self._read(key, prefix, start, min(finish, closed))
+        if finish > closed:
+            names.extend(results[-1][0])
+            values.extend(results[-1][1])
+        returnValue((names, values))
+
+    def _coverage(self, key, prefix):
+        """
+        Covered (start, finish) interval of a row and prefix, or None.
+        """
+        return self.connection.execute(
+            "SELECT start, finish FROM coverage "
+            "WHERE key = ? AND prefix = ?",
+            (buffer(key), buffer(prefix))).fetchone()
+
+    def _store(self, key, prefix, results, coverage):
+        """
+        Store (names, values) results of closed periods and extend the
+        covered interval.
+        """
+        with self.connection:
+            for names, values in results:
+                self.connection.executemany(
+                    "INSERT OR REPLACE INTO period (key, prefix, name, value) "
+                    "VALUES (?, ?, ?, ?)",
+                    [(buffer(key), buffer(prefix), buffer(x[0]), x[1])
+                        for x in zip(names, values)])
+            self.connection.execute(
+                "INSERT OR REPLACE INTO coverage (key, prefix, start, finish) "
+                "VALUES (?, ?, ?, ?)",
+                (buffer(key), buffer(prefix), coverage[0], coverage[1]))
+
+    def _read(self, key, prefix, start, finish):
+        """
+        Read stored columns with timestamps from start to finish.
+        """
+        rows = self.connection.execute(
+            "SELECT name, value FROM period WHERE key = ? AND prefix = ? "
+            "AND name >= ? AND name < ? ORDER BY name",
+            (buffer(key),
+                buffer(prefix),
+                buffer(_TIMESTAMP.pack(start)),
+                buffer(_TIMESTAMP.pack(finish + 1)))).fetchall()
+        return [str(x[0]) for x in rows], [x[1] for x in rows]
+
+    def invalidate(self, keys):
+        """
+        Drop stored columns of deleted rows.
+        """
+        self.generation += 1
+        with self.connection:
+            for table in ("period", "coverage"):
+                self.connection.executemany(
+                    "DELETE FROM %s WHERE key = ?" % table,
+                    [(buffer(key),) for key in keys])
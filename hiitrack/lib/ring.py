@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Client-side view of the Cassandra token ring for routing mutations to the
+replica that owns them.
+"""
+
+from bisect import bisect_left
+from hashlib import md5
+from collections import defaultdict
+from twisted.internet.defer import inlineCallbacks
+from twisted.internet.task import LoopingCall
+from twisted.python import log
+
+
+_TOKEN_SPACE = 1 << 128
+_SIGN_BIT = 1 << 127
+
+
+def token(key):
+    """
+    RandomPartitioner token of a row key, i.e. abs() of the MD5 digest read
+    as a signed 128 bit integer.
+    """
+    value = int(md5(key).hexdigest(), 16)
+    if value >= _SIGN_BIT:
+        value = _TOKEN_SPACE - value
+    return value
+
+
+class Ring(object):
+    """
+    Periodically refreshed token ring. Maps row keys to the endpoint of
+    their first replica and keeps a client connected to each endpoint.
+    """
+
+    def __init__(self, client, keyspace, connect, refresh_interval=60):
+        self.client = client
+        self.keyspace = keyspace
+        self.connect = connect
+        self.refresh_interval = refresh_interval
+        self.tokens = []
+        self.endpoints = []
+        self.clients = {}
+        self.loop = LoopingCall(self.refresh)
+
+    def start(self):
+        """
+        Fetch the ring now and then every refresh_interval seconds.
+        """
+        self.loop.start(self.refresh_interval)
+
+    def stop(self):
+        """
+        Stop refreshing and disconnect from the replicas.
+        """
+        if self.loop.running:
+            self.loop.stop()
+        for client in self.clients.values():
+            client.stopService()
+        self.clients = {}
+
+    @inlineCallbacks
+    def refresh(self):
+        """
+        Replace the ring with the cluster's current token ranges.
+        """
+        try:
+            token_ranges = yield self.client.describe_ring(self.keyspace)
+        except Exception:
+            log.err(None, "Could not refresh token ring.")
+            return
+        token_ranges = sorted(token_ranges, key=lambda x:int(x.end_token))
+        self.tokens = [int(x.end_token) for x in token_ranges]
+        self.endpoints = [x.endpoints[0] for x in token_ranges]
+        for endpoint in set(self.clients) - set(self.endpoints):
+            self.clients.pop(endpoint).stopService()
+
+    def replica(self, key):
+        """
+        Endpoint owning a row key, or None if the ring is unknown.
+        """
+        if not self.tokens:
+            return None
+        # Ranges are (start_token, end_token], wrapping past the last one.
+        index = bisect_left(self.tokens, token(key))
+        if index == len(self.tokens):
+            index = 0
+        return self.endpoints[index]
+
+    def group(self, mutations):
+        """
+        Split a {key: {column_id: value}} mapping by owning endpoint.
+        """
+        groups = defaultdict(dict)
+        for key in mutations:
+            groups[self.replica(key)][key] = mutations[key]
+        return groups
+
+    def client_for(self, endpoint):
+        """
+        Client connected directly to an endpoint.
+        """
+        if endpoint not in self.clients:
+            client = self.connect(endpoint)
+            client.startService()
+            self.clients[endpoint] = client
+        return self.clients[endpoint]
@@ -0,0 +1,220 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Embedded on-disk storage backend for single node deployments.
+"""
+
+import re
+import sqlite3
+from twisted.internet.defer import maybeDeferred
+from telephus.cassandra.c08.ttypes import NotFoundException
+from ..lib.backend import Backend, column_result
+
+
+_TABLE_NAME = re.compile(r"^\w+$")
+
+
+class SQLiteBackend(Backend):
+    """
+    Stores each column family in a SQLite table clustered on (key, name),
+    so row slices are index range scans. Counter adds and batches run in a
+    single transaction. Calls complete synchronously in the reactor thread.
+    """
+
+    def __init__(self, path, synchronous="NORMAL"):
+        self.path = path
+        self.synchronous = synchronous
+        self.connection = None
+        self.tables = set()
+        self.startService()
+
+    def startService(self):
+        if self.connection is not None:
+            return
+        self.connection = sqlite3.connect(self.path)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=%s" % self.synchronous)
+        self.tables = set()
+
+    def stopService(self):
+        if self.connection is not None:
+            self.connection.close()
+            self.connection = None
+
+    def _table(self, column_family):
+        """
+        Return the table name for a column family, creating the table.
+        """
+        if column_family not in self.tables:
+            if not _TABLE_NAME.match(column_family):
+                raise ValueError("Invalid column family %s" % column_family)
+            if column_family in self.counter_column_families:
+                value_type = "INTEGER NOT NULL"
+            else:
+                value_type = "BLOB"
+            self.connection.execute(
+                "CREATE TABLE IF NOT EXISTS %s (key BLOB NOT NULL, "
+                "name BLOB NOT NULL, value %s, PRIMARY KEY (key, name)) "
+                "WITHOUT ROWID" % (column_family, value_type))
+            self.tables.add(column_family)
+        return column_family
+
+    def _results(self, column_family, rows):
+        """
+        Convert (name, value) rows into column results.
+        """
+        if column_family in self.counter_column_families:
+            return [column_result(str(x[0]), x[1], True) for x in rows]
+        return [column_result(str(x[0]), str(x[1])) for x in rows]
+
+    def get(self, key, column_family, column, consistency=None):
+        return maybeDeferred(self._get, key, column_family, column)
+
+    def _get(self, key, column_family, column):
+        row = self.connection.execute(
+            "SELECT name, value FROM %s WHERE key = ? AND name = ?" % \
+                self._table(column_family),
+            (buffer(key), buffer(column))).fetchone()
+        if row is None:
+            raise NotFoundException()
+        return self._results(column_family, [row])[0]
+
+    def get_slice(
+            self,
+            key,
+            column_family,
+            names=None,
+            start='',
+            finish='',
+            count=100,
+            reverse=False,
+            consistency=None):
+        return maybeDeferred(
+            self._slice,
+            key,
+            column_family,
+            names,
+            start,
+            finish,
+            count,
+            reverse)
+
+    def _slice(self, key, column_family, names, start, finish, count, reverse):
+        """
+        Read named columns or a range of columns from a row.
+        """
+        table = self._table(column_family)
+        if reverse:
+            order = "DESC"
+            start, finish = finish, start
+        else:
+            order = "ASC"
+        if names is not None:
+            names = list(names)
+            if not names:
+                return []
+            rows = self.connection.execute(
+                "SELECT name, value FROM %s WHERE key = ? AND name IN (%s) "
+                "ORDER BY name %s" % (
+                    table,
+                    ", ".join(["?"] * len(names)),
+                    order),
+                [buffer(key)] + [buffer(x) for x in names])
+            return self._results(column_family, rows)
+        clauses = ["key = ?"]
+        parameters = [buffer(key)]
+        if start:
+            clauses.append("name >= ?")
+            parameters.append(buffer(start))
+        if finish:
+            clauses.append("name <= ?")
+            parameters.append(buffer(finish))
+        parameters.append(count)
+        rows = self.connection.execute(
+            "SELECT name, value FROM %s WHERE %s ORDER BY name %s "
+            "LIMIT ?" % (table, " AND ".join(clauses), order),
+            parameters)
+        return self._results(column_family, rows)
+
+    def multiget_slice(
+            self,
+            keys,
+            column_family,
+            names=None,
+            start='',
+            finish='',
+            count=100,
+            reverse=False,
+            consistency=None):
+        return maybeDeferred(lambda: dict([(key, self._slice(
+            key,
+            column_family,
+            names,
+            start,
+            finish,
+            count,
+            reverse)) for key in keys]))
+
+    def insert(self, key, column_family, value, column, consistency=None):
+        return self.batch_multikey_insert(column_family, {key: {column: value}})
+
+    def batch_multikey_insert(self, column_family, mapping, consistency=None):
+        return maybeDeferred(self._batch_multikey_insert, column_family, mapping)
+
+    def _batch_multikey_insert(self, column_family, mapping):
+        table = self._table(column_family)
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR REPLACE INTO %s (key, name, value) "
+                "VALUES (?, ?, ?)" % table,
+                [(buffer(key), buffer(column), buffer(value))
+                    for key in mapping
+                    for column, value in mapping[key].items()])
+
+    def batch_multikey_add(self, column_family, mapping, consistency=None):
+        return maybeDeferred(self._batch_multikey_add, column_family, mapping)
+
+    def _batch_multikey_add(self, column_family, mapping):
+        table = self._table(column_family)
+        parameters = [(value, buffer(key), buffer(column))
+            for key in mapping
+            for column, value in mapping[key].items()]
+        with self.connection:
+            self.connection.executemany(
+                "INSERT OR IGNORE INTO %s (value, key, name) "
+                "VALUES (0, ?, ?)" % table,
+                [x[1:] for x in parameters])
+            self.connection.executemany(
+                "UPDATE %s SET value = value + ? "
+                "WHERE key = ? AND name = ?" % table,
+                parameters)
+
+    def remove(self, key, column_family, column=None, consistency=None):
+        return maybeDeferred(self._remove, key, column_family, column)
+
+    def remove_counter(self, key, column_family, column=None, consistency=None):
+        return maybeDeferred(self._remove, key, column_family, column)
+
+    def _remove(self, key, column_family, column):
+        table = self._table(column_family)
+        with self.connection:
+            if column is None:
+                self.connection.execute(
+                    "DELETE FROM %s WHERE key = ?" % table,
+                    (buffer(key),))
+            else:
+                self.connection.execute(
+                    "DELETE FROM %s WHERE key = ? AND name = ?" % table,
+                    (buffer(key), buffer(column)))
+
+    def batch_remove_rows(self, mapping, consistency=None):
+        return maybeDeferred(self._batch_remove_rows, mapping)
+
+    def _batch_remove_rows(self, mapping):
+        with self.connection:
+            for column_family in mapping:
+                self.connection.executemany(
+                    "DELETE FROM %s WHERE key = ?" % \
+                        self._table(column_family),
+                    [(buffer(key),) for key in mapping[column_family]])
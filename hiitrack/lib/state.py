@@ -0,0 +1,68 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Compact encoding of a visitor's events, path, and properties.
+"""
+
+import struct
+from collections import defaultdict
+
+
+VERSION = 1
+_HEADER = struct.Struct(">BHIH")
+_PATH = struct.Struct(">HHI")
+
+
+def pack_state(total, path, property_ids):
+    """
+    Pack visitor metadata as returned by VisitorModel.get_metadata().
+
+    The blob is a header of version, event, path and property counts,
+    then the sorted 16 byte event IDs, their counts as 32 bit integers,
+    the path as (new event index, event index, count) entries sorted by
+    index, and the 32 byte property IDs.
+    """
+    event_ids = sorted([x for x in total if total[x]])
+    if len(event_ids) > 0xFFFF:
+        raise ValueError("Visitor has too many events to pack.")
+    index = dict([(x, i) for i, x in enumerate(event_ids)])
+    paths = sorted([(index[x], index[y], path[x][y])
+        for x in path for y in path[x] if path[x][y]])
+    parts = [_HEADER.pack(
+        VERSION,
+        len(event_ids),
+        len(paths),
+        len(property_ids))]
+    parts.extend(event_ids)
+    parts.append(struct.pack(
+        ">%sI" % len(event_ids),
+        *[total[x] for x in event_ids]))
+    parts.extend([_PATH.pack(*x) for x in paths])
+    parts.extend(property_ids)
+    return "".join(parts)
+
+
+def unpack_state(data):
+    """
+    Unpack a blob written by pack_state() into metadata.
+    """
+    version, events, paths, properties = _HEADER.unpack_from(data)
+    if version != VERSION:
+        raise ValueError("Unknown visitor state version %s." % version)
+    offset = _HEADER.size
+    event_ids = [data[offset + i * 16:offset + i * 16 + 16]
+        for i in range(events)]
+    offset += events * 16
+    counts = struct.unpack_from(">%sI" % events, data, offset)
+    offset += events * 4
+    total = defaultdict(lambda:0)
+    total.update(zip(event_ids, counts))
+    path = defaultdict(lambda:defaultdict(lambda:0))
+    for i in range(paths):
+        new, old, count = _PATH.unpack_from(data, offset)
+        path[event_ids[new]][event_ids[old]] = count
+        offset += _PATH.size
+    property_ids = [data[offset + i * 32:offset + i * 32 + 32]
+        for i in range(properties)]
+    return total, path, property_ids
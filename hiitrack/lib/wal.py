@@ -0,0 +1,155 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Append-only local write-ahead log for buffered mutations.
+"""
+
+import os
+import struct
+from twisted.internet import reactor
+from twisted.internet.defer import Deferred
+
+
+RELATION = "r"
+COUNTER = "c"
+_HEADER = struct.Struct(">cHHI")
+_COUNTER_VALUE = struct.Struct(">q")
+_SEGMENT_SUFFIX = ".wal"
+
+
+class WriteAheadLog(object):
+    """
+    Segmented, fsync-batched log of relation inserts and counter adds.
+
+    Each Buffer flush rotates to a new segment; the rotated segment is
+    removed once the flush has succeeded. Segments left over from a
+    previous process are replayed on startup.
+    """
+
+    def __init__(self, path, sync_interval=0.01):
+        self.path = path
+        self.sync_interval = sync_interval
+        self.waiting = []
+        self.delayed_sync = None
+        if not os.path.isdir(path):
+            os.makedirs(path)
+        existing = self.segments()
+        self.segment_id = existing[-1] + 1 if existing else 0
+        self.file = open(self._segment_path(self.segment_id), "ab")
+
+    def _segment_path(self, segment_id):
+        """
+        Path of a segment file.
+        """
+        return os.path.join(self.path, "%016d%s" % (
+            segment_id,
+            _SEGMENT_SUFFIX))
+
+    def segments(self):
+        """
+        Sorted ids of all segments on disk.
+        """
+        return sorted([int(x[:-len(_SEGMENT_SUFFIX)])
+            for x in os.listdir(self.path) if x.endswith(_SEGMENT_SUFFIX)])
+
+    def closed_segments(self):
+        """
+        Sorted ids of segments that are no longer being appended to.
+        """
+        return [x for x in self.segments() if x != self.segment_id]
+
+    def append_relation(self, key, column_id, value):
+        """
+        Log a relation insert.
+        """
+        self.file.write(_HEADER.pack(
+            RELATION,
+            len(key),
+            len(column_id),
+            len(value)))
+        self.file.write("".join([key, column_id, value]))
+
+    def append_counter(self, key, column_id, value):
+        """
+        Log a counter add.
+        """
+        self.file.write(_HEADER.pack(
+            COUNTER,
+            len(key),
+            len(column_id),
+            _COUNTER_VALUE.size))
+        self.file.write("".join([key, column_id, _COUNTER_VALUE.pack(value)]))
+
+    def sync(self):
+        """
+        Return a deferred that fires once everything appended so far is on
+        disk. Concurrent callers share a single fsync.
+        """
+        deferred = Deferred()
+        self.waiting.append(deferred)
+        if self.delayed_sync is None:
+            self.delayed_sync = reactor.callLater(
+                self.sync_interval,
+                self._sync)
+        return deferred
+
+    def _sync(self):
+        """
+        Fsync the current segment and release waiting callers.
+        """
+        self.delayed_sync = None
+        waiting, self.waiting = self.waiting, []
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        for deferred in waiting:
+            deferred.callback(None)
+
+    def rotate(self):
+        """
+        Close the current segment, start a new one and return the id of the
+        closed segment.
+        """
+        self.file.flush()
+        os.fsync(self.file.fileno())
+        self.file.close()
+        segment_id = self.segment_id
+        self.segment_id += 1
+        self.file = open(self._segment_path(self.segment_id), "ab")
+        return segment_id
+
+    def remove(self, segment_ids):
+        """
+        Delete segments whose mutations have been acknowledged.
+        """
+        for segment_id in segment_ids:
+            try:
+                os.remove(self._segment_path(segment_id))
+            except OSError:
+                pass
+
+    def read(self, segment_ids):
+        """
+        Yield (kind, key, column_id, value) records from segments. A record
+        truncated by a crash ends its segment.
+        """
+        for segment_id in segment_ids:
+            with open(self._segment_path(segment_id), "rb") as segment:
+                data = segment.read()
+            offset = 0
+            while offset + _HEADER.size <= len(data):
+                kind, key_length, column_length, value_length = \
+                    _HEADER.unpack_from(data, offset)
+                offset += _HEADER.size
+                end = offset + key_length + column_length + value_length
+                if end > len(data):
+                    break
+                key = data[offset:offset + key_length]
+                offset += key_length
+                column_id = data[offset:offset + column_length]
+                offset += column_length
+                value = data[offset:end]
+                offset = end
+                if kind == COUNTER:
+                    value = _COUNTER_VALUE.unpack(value)[0]
+                yield kind, key, column_id, value
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""Data migrations between storage layouts."""
+
+from optparse import OptionParser
+from telephus.pool import CassandraClusterPool
+from twisted.internet import reactor
+from twisted.internet.defer import inlineCallbacks
+from ..lib import cassandra
+
+
+def option_parser():
+    """
+    Parser of the options every migration takes.
+    """
+    parser = OptionParser(
+        usage="%prog [options] user_name bucket_name [bucket_name ...]")
+    parser.add_option("--servers", default="127.0.0.1",
+        help="Comma separated list of Cassandra servers.")
+    parser.add_option("--keyspace", default="HiiTrack")
+    return parser
+
+
+@inlineCallbacks
+def _run(options, migrate, buckets):
+    """
+    Migrate (user_name, bucket_name) pairs.
+    """
+    cassandra.CLIENT = CassandraClusterPool(
+        options.servers.split(","),
+        keyspace=options.keyspace)
+    cassandra.CLIENT.startService()
+    try:
+        for user_name, bucket_name in buckets:
+            migrated = yield migrate(options, user_name, bucket_name)
+            print "%s/%s: %s migrated" % (
+                user_name,
+                bucket_name,
+                migrated)
+    finally:
+        cassandra.CLIENT.stopService()
+
+
+def run(parser, migrate):
+    """
+    Parse the command line and call migrate(options, user_name,
+    bucket_name) for each bucket, printing the number of visitors or
+    values it migrated.
+    """
+    options, args = parser.parse_args()
+    if len(args) < 2:
+        parser.error("A user name and at least one bucket name are required.")
+    buckets = [(args[0], x) for x in args[1:]]
+
+    def finish(result):
+        reactor.stop()
+        return result
+    reactor.callWhenRunning(
+        lambda: _run(options, migrate, buckets).addBoth(finish))
+    reactor.run()
@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Rolls the hourly counters of closed days up into the daily counters of
+buckets whose service runs with daily_rollup_since set:
+
+    python -m hiitrack.migrations.daily_rollup \\
+        --since 1350000000 user_name bucket_name
+
+--since must be the service's daily_rollup_since. Run it periodically,
+one job per bucket at a time. Each run scans the bucket's hourly rows
+once and rolls up every closed day since the last run.
+"""
+
+from ..lib.keys import bucket_keys
+from ..models.rollup import DailyRollup
+from . import option_parser, run
+
+
+def main():
+    parser = option_parser()
+    parser.add_option("--since", type="int",
+        help="Hour the service stopped writing daily counters.")
+    parser.add_option("--grace", type="int", default=300,
+        help="Seconds after its end a day is rolled up.")
+    options, _ = parser.parse_args()
+    if options.since is None:
+        parser.error("--since is required.")
+    rollup = DailyRollup(options.since, options.grace)
+    run(parser, lambda options, user_name, bucket_name: rollup.rollup_bucket(
+        bucket_keys(user_name, bucket_name)))
+
+
+if __name__ == "__main__":
+    main()
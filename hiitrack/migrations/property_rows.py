@@ -0,0 +1,62 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Moves the property values of buckets from the bucket's property relation
+row to a relation row per property.
+
+1. Run the service with property_rows "migrating". New values are written
+   to both layouts and values are read from the bucket row.
+2. Copy every bucket:
+
+       python -m hiitrack.migrations.property_rows user_name bucket_name
+
+3. Run the service with property_rows "property".
+4. Migrate again with --delete to drop the bucket rows.
+
+Values are copied unchanged, so copying a value the service has already
+written, or copying a bucket twice, is harmless.
+"""
+
+from twisted.internet.defer import inlineCallbacks, returnValue
+from ..lib.cassandra import scan, delete_relation, BUFFER
+from ..lib.keys import bucket_keys
+from . import option_parser, run
+
+
+@inlineCallbacks
+def migrate_bucket(user_name, bucket_name, delete=False):
+    """
+    Copy the values in a bucket's property relation row to the row of
+    their property, optionally deleting the bucket row afterwards. Returns
+    the number of values copied.
+    """
+    keys = bucket_keys(user_name, bucket_name)
+    key = keys.relation("property")
+    def consumer(columns):
+        for column in columns:
+            BUFFER.insert_relation(
+                keys.property(column.column.name[0:16]),
+                column.column.name[16:32],
+                column.column.value)
+        # Unlike commit(), fails if any copy does, stopping the scan before
+        # the bucket row is deleted.
+        return BUFFER.flush_relation()
+    migrated = yield scan(key, "relation", consumer)
+    if delete:
+        yield delete_relation(key)
+    returnValue(migrated)
+
+
+def main():
+    parser = option_parser()
+    parser.add_option("--delete", action="store_true", default=False,
+        help="Delete the bucket rows after copying them.")
+    run(parser, lambda options, user_name, bucket_name: migrate_bucket(
+        user_name,
+        bucket_name,
+        options.delete))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Moves the hourly and daily counter rows of buckets into time partitions,
+and drops old partitions.
+
+1. Run the service with time_partitions set to "month" or a number of
+   seconds and time_partitions_migrating set. New counts go to the rows
+   of their partition. Reads add the unpartitioned row of a kind and
+   shard until it is marked as copied, bypassing the period cache.
+2. Copy the counts of every bucket's unpartitioned rows:
+
+       python -m hiitrack.migrations.time_partitions \\
+           --period month user_name bucket_name
+
+   Each row is marked as copied in the bucket's time_partition relation
+   row once its counts are committed, and a rerun skips marked rows. A
+   run that fails while committing a row may have copied part of it.
+3. Run the service without time_partitions_migrating. With --delete a
+   rerun drops each unpartitioned row that is marked as copied.
+
+Partitions that ended before a date are dropped whole with:
+
+       python -m hiitrack.migrations.time_partitions \\
+           --drop-before 2012-01-01 user_name bucket_name
+"""
+
+import calendar
+import struct
+import time
+from twisted.internet.defer import inlineCallbacks, returnValue
+from ..lib.cassandra import scan, delete_counters, delete_relation, \
+    get_relation, BUFFER
+from ..lib.keys import bucket_keys, TimePartitions, TIMED_KINDS, SHARDS
+from ..models.event import get_time_partitions, migrated_column
+from . import option_parser, run
+
+
+_TIMESTAMP = struct.Struct(">1i")
+
+
+@inlineCallbacks
+def migrate_bucket(user_name, bucket_name, partitions, delete=False):
+    """
+    Copy the columns of a bucket's unpartitioned hourly and daily rows to
+    the rows of their TimePartitions partition, registering the
+    partitions and marking each row as copied, and optionally delete the
+    unpartitioned rows. Rows already marked are not copied again.
+    Returns the number of columns copied.
+    """
+    keys = bucket_keys(user_name, bucket_name)
+    data = yield get_relation(keys.relation("time_partition"))
+    migrated = 0
+    for kind in TIMED_KINDS:
+        for i in range(SHARDS):
+            shard = chr(i)
+            row = keys.counter(kind, shard)
+            if migrated_column(kind, shard) in data:
+                if delete:
+                    yield delete_counters([row])
+                continue
+            registered = set()
+            def consumer(columns):
+                for column in columns:
+                    name = column.counter_column.name
+                    # Timestamps follow the event and property[0:16].
+                    partition = partitions.partition(
+                        _TIMESTAMP.unpack(name[32:36])[0])
+                    BUFFER.increment_counter(
+                        partitions.row(keys, kind, shard, partition),
+                        name,
+                        column.counter_column.value)
+                    registered.add(partition)
+            copied = yield scan(row, "counter", consumer)
+            for partition in registered:
+                BUFFER.insert_relation(
+                    keys.relation("time_partition"),
+                    _TIMESTAMP.pack(partition),
+                    partitions.period)
+            # Unlike commit(), these fail if any mutation does, and the row
+            # is only marked once its counts are stored.
+            yield BUFFER.flush_relation()
+            yield BUFFER.flush_counter()
+            BUFFER.insert_relation(
+                keys.relation("time_partition"),
+                migrated_column(kind, shard),
+                str(copied))
+            yield BUFFER.flush_relation()
+            if delete:
+                yield delete_counters([row])
+            migrated += copied
+    returnValue(migrated)
+
+
+@inlineCallbacks
+def drop_partitions(user_name, bucket_name, before):
+    """
+    Delete the rows of a bucket's partitions that ended by the timestamp
+    before and unregister them. Returns the number of partitions dropped.
+    """
+    keys = bucket_keys(user_name, bucket_name)
+    time_partitions = yield get_time_partitions(keys)
+    dropped = 0
+    for partitions, partition in time_partitions:
+        if partitions.next(partition) > before:
+            continue
+        yield delete_counters(partitions.rows(keys, partition))
+        yield delete_relation(
+            keys.relation("time_partition"),
+            column_id=_TIMESTAMP.pack(partition))
+        dropped += 1
+    returnValue(dropped)
+
+
+def main():
+    parser = option_parser()
+    parser.add_option("--period", default="month",
+        help="\"month\" or the length of the partitions in seconds.")
+    parser.add_option("--delete", action="store_true", default=False,
+        help="Delete the unpartitioned rows after copying them.")
+    parser.add_option("--drop-before",
+        help="Drop the partitions that ended by this YYYY-MM-DD date "
+            "instead of copying.")
+    def migrate(options, user_name, bucket_name):
+        if options.drop_before:
+            before = time.strptime(options.drop_before, "%Y-%m-%d")
+            return drop_partitions(
+                user_name,
+                bucket_name,
+                calendar.timegm(before))
+        return migrate_bucket(
+            user_name,
+            bucket_name,
+            TimePartitions(options.period),
+            options.delete)
+    run(parser, migrate)
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,113 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Moves the visitor rows of buckets from one partition scheme to another.
+
+1. Run the service with visitor_partitions set to the new scheme and
+   previous_visitor_partitions to the old one. Visitors with no rows under
+   the new scheme are read from the old rows and copied by their next
+   ingest.
+2. Copy every other visitor:
+
+       python -m hiitrack.migrations.visitor_partitions \\
+           --source 256 --target 4096 user_name bucket_name
+
+3. Run the service without previous_visitor_partitions.
+4. Migrate again with --delete to drop the old rows.
+
+A visitor copied by its own ingest while the tool copies it has its
+counters copied twice. Migrate buckets while they are quiet.
+"""
+
+from collections import defaultdict
+from twisted.internet.defer import inlineCallbacks, returnValue
+from ..lib.cassandra import scan, get_counters, get_relation, \
+    delete_counters, delete_relations, BUFFER
+from ..lib.keys import bucket_keys, VisitorPartitions
+from . import option_parser, run
+
+
+COUNTER_KINDS = ("visitor_event", "visitor_path", "visitor_property")
+KINDS = COUNTER_KINDS + ("visitor_state",)
+
+
+@inlineCallbacks
+def _stored(keys, partitions, visitor_id):
+    """
+    True if a visitor has columns in the rows of a partition scheme.
+    """
+    rows = [partitions.row(keys, x, visitor_id) for x in COUNTER_KINDS]
+    counters = yield get_counters(rows, prefix=visitor_id)
+    if any(counters):
+        returnValue(True)
+    state = yield get_relation(
+        partitions.row(keys, "visitor_state", visitor_id),
+        column_ids=[visitor_id])
+    returnValue(bool(state))
+
+
+@inlineCallbacks
+def repartition_bucket(user_name, bucket_name, source, target, delete=False):
+    """
+    Copy the visitor columns of a bucket from the rows of the source
+    VisitorPartitions to those of the target, skipping visitors that
+    already have target rows, and optionally delete the source rows.
+    Returns the number of visitors copied.
+    """
+    if source.partitions == target.partitions:
+        raise ValueError("Source and target schemes are the same.")
+    keys = bucket_keys(user_name, bucket_name)
+    migrated = 0
+    for source_rows in zip(*[source.rows(keys, x) for x in KINDS]):
+        columns = defaultdict(lambda:defaultdict(list))
+        for kind, row in zip(KINDS, source_rows):
+            def consumer(result, kind=kind):
+                for column in result:
+                    column = column.counter_column or column.column
+                    columns[column.name[0:16]][kind].append(
+                        (column.name, column.value))
+            if kind == "visitor_state":
+                yield scan(row, "relation", consumer)
+            else:
+                yield scan(row, "counter", consumer)
+        for visitor_id, kinds in columns.items():
+            stored = yield _stored(keys, target, visitor_id)
+            if stored:
+                continue
+            for kind, values in kinds.items():
+                row = target.row(keys, kind, visitor_id)
+                for name, value in values:
+                    if kind == "visitor_state":
+                        BUFFER.insert_relation(row, name, value)
+                    else:
+                        BUFFER.increment_counter(row, name, value)
+            migrated += 1
+        # Unlike commit(), these fail if any copy does, before the source
+        # rows are deleted.
+        yield BUFFER.flush_counter()
+        yield BUFFER.flush_relation()
+        if delete and columns:
+            yield delete_counters(list(source_rows[0:3]))
+            yield delete_relations([source_rows[3]])
+    returnValue(migrated)
+
+
+def main():
+    parser = option_parser()
+    parser.add_option("--source", type="int", default=256,
+        help="Visitor partitions the rows are in.")
+    parser.add_option("--target", type="int",
+        help="Visitor partitions to move the rows to.")
+    parser.add_option("--delete", action="store_true", default=False,
+        help="Delete the source rows after copying them.")
+    run(parser, lambda options, user_name, bucket_name: repartition_bucket(
+        user_name,
+        bucket_name,
+        VisitorPartitions(options.source),
+        VisitorPartitions(options.target),
+        options.delete))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,103 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Migrates visitor metadata from visitor counter rows to visitor state blobs.
+
+1. Run the service with visitor_state "migrating". Visitors are written in
+   both layouts and read from their blob, falling back to counter rows.
+2. Migrate every bucket:
+
+       python -m hiitrack.migrations.visitor_state user_name bucket_name
+
+   Pass --partitions when the service sets visitor_partitions.
+
+3. Run the service with visitor_state "blob".
+4. Migrate again with --delete to drop the visitor counter rows.
+
+A visitor first written by the service between the tool's check for its
+blob and the tool's write can have its blob replaced by the counter rows
+read just before, losing that write from its metadata. Migrate buckets
+while they are quiet.
+"""
+
+from collections import defaultdict
+from twisted.internet.defer import inlineCallbacks, returnValue
+from ..lib.cassandra import scan, delete_counters, BUFFER
+from ..lib.keys import bucket_keys, VisitorPartitions, SHARDS
+from ..lib.state import pack_state
+from ..models import visitor
+from ..models.visitor import _empty_metadata
+from . import option_parser, run
+
+
+VISITOR_KINDS = ("visitor_event", "visitor_path", "visitor_property")
+
+
+@inlineCallbacks
+def migrate_bucket(user_name, bucket_name, delete=False, partitions=None):
+    """
+    Write a state blob for every visitor of a bucket that has counter rows
+    and no blob, optionally deleting the counter rows afterwards. Rows are
+    those of a partition scheme, by default visitor.PARTITIONS. Returns
+    the number of blobs written.
+    """
+    keys = bucket_keys(user_name, bucket_name)
+    partitions = partitions or visitor.PARTITIONS
+    rows = zip(*[partitions.rows(keys, x) for x in VISITOR_KINDS])
+    state_rows = partitions.rows(keys, "visitor_state")
+    migrated = 0
+    for counter_rows, state_row in zip(rows, state_rows):
+        states = defaultdict(_empty_metadata)
+        def events(columns):
+            for column in columns:
+                name = column.counter_column.name
+                states[name[0:16]][0][name[16:32]] += \
+                    column.counter_column.value
+        def paths(columns):
+            for column in columns:
+                name = column.counter_column.name
+                states[name[0:16]][1][name[16:32]][name[32:48]] += \
+                    column.counter_column.value
+        def properties(columns):
+            for column in columns:
+                name = column.counter_column.name
+                states[name[0:16]][2].append(name[16:48])
+        for row, consumer in zip(counter_rows, (events, paths, properties)):
+            yield scan(row, "counter", consumer)
+        if not states:
+            continue
+        stored = set()
+        def blobs(columns):
+            stored.update([x.column.name for x in columns])
+        yield scan(state_row, "relation", blobs)
+        for visitor_id, metadata in states.items():
+            if visitor_id not in stored:
+                BUFFER.insert_relation(
+                    state_row,
+                    visitor_id,
+                    pack_state(*metadata))
+                migrated += 1
+        # Unlike commit(), fails if any blob does, before the counter rows
+        # are deleted.
+        yield BUFFER.flush_relation()
+        if delete:
+            yield delete_counters(list(counter_rows))
+    returnValue(migrated)
+
+
+def main():
+    parser = option_parser()
+    parser.add_option("--delete", action="store_true", default=False,
+        help="Delete visitor counter rows after migrating them.")
+    parser.add_option("--partitions", type="int", default=SHARDS,
+        help="Visitor partitions the rows are in, as visitor_partitions.")
+    run(parser, lambda options, user_name, bucket_name: migrate_bucket(
+        user_name,
+        bucket_name,
+        options.delete,
+        VisitorPartitions(options.partitions)))
+
+
+if __name__ == "__main__":
+    main()
@@ -11,9 +11,16 @@ from twisted.internet.defer import inlineCallbacks, returnValue, DeferredList
 from telephus.cassandra.c08.ttypes import NotFoundException
 from pylru import lrucache
 from ..lib.cassandra import get_relation, delete_relation, get_user, \
-    insert_relation_by_id, delete_relations, delete_counters
+    insert_relation_by_id, delete_relations, delete_counters, \
+    get_relation_page
 from ..exceptions import BucketException, UserException
 from ..lib.profiler import profile
+from ..lib.keys import bucket_keys, RELATION_KINDS
+from ..lib.hot import hot_event_rows, HOT_EVENT_KINDS
+from ..lib.families import get_disabled, forget_disabled, DISABLED_CACHE
+from .visitor import reset_bucket_visitors, visitor_rows
+from . import event as event_model
+from .event import get_time_partitions
 from ..lib.hash import password_hash
 from base64 import b64encode
 
@@ -80,6 +87,7 @@ class BucketModel(object):
     def __init__(self, user_name, bucket_name):
         self.user_name = user_name
         self.bucket_name = bucket_name
+        self.keys = bucket_keys(user_name, bucket_name)
         self.cache_key = "|".join((user_name, bucket_name))
 
     @profile
@@ -126,14 +134,21 @@ class BucketModel(object):
         returnValue(True)
 
     @profile
-    def create(self, description):
+    def create(self, description, disabled=()):
         """
-        Create bucket for username.
+        Create bucket for username, without the counters of the disabled
+        families.
         """
         LRU_CACHE[self.cache_key] = None
+        reset_bucket_visitors(self.user_name, self.bucket_name)
+        DISABLED_CACHE[(self.user_name, self.bucket_name)] = \
+            frozenset(disabled)
         key = (self.user_name, "bucket")
         column_id = self.bucket_name
-        value = ujson.dumps({"description":description})
+        data = {"description":description}
+        if disabled:
+            data["disabled"] = sorted(disabled)
+        value = ujson.dumps(data)
         return insert_relation_by_id(key, column_id, value, commit=True)
 
     @profile
@@ -143,7 +158,7 @@ class BucketModel(object):
         Return nested dictionary of
         property_name -> property_value -> property_id in bucket.
         """
-        key = (self.user_name, self.bucket_name, "property_name")
+        key = self.keys.relation("property_name")
         data = yield get_relation(key)
         returnValue(dict([(x, ujson.loads(data[x])) for x in data]))
 
@@ -153,10 +168,37 @@ class BucketModel(object):
         """
         Return event_name/event_id pairs for the bucket.
         """
-        key = (self.user_name, self.bucket_name, "event")
+        key = self.keys.relation("event")
         data = yield get_relation(key)
         returnValue(dict([(data[i], {"id":i}) for i in data]))
 
+    @profile
+    @inlineCallbacks
+    def get_events_page(self, cursor=None, limit=100):
+        """
+        Return up to limit event_name/event_id pairs after the cursor and
+        the cursor of the next page.
+        """
+        key = self.keys.relation("event")
+        data, cursor = yield get_relation_page(key, cursor=cursor, limit=limit)
+        returnValue((dict([(data[i], {"id":i}) for i in data]), cursor))
+
+    @profile
+    @inlineCallbacks
+    def get_hot_events(self):
+        """
+        Return event_name/{event_id, subrows} pairs for the events whose
+        counters are spread over sub-rows.
+        """
+        hot_events = yield get_relation(self.keys.relation("hot_event"))
+        if not hot_events:
+            returnValue({})
+        key = self.keys.relation("event")
+        names = yield get_relation(key, column_ids=hot_events.keys())
+        returnValue(dict([(names[i], {
+            "id":i,
+            "subrows":ujson.loads(hot_events[i])}) for i in names]))
+
     @profile
     @inlineCallbacks
     def get_description(self):
@@ -168,6 +210,12 @@ class BucketModel(object):
         data = yield get_relation(key, column_id=column_id)
         returnValue(ujson.loads(data)["description"])
 
+    def get_disabled(self):
+        """
+        Return the counter families the bucket was created without.
+        """
+        return get_disabled(self.user_name, self.bucket_name)
+
     @profile
     @inlineCallbacks
     def delete(self):
@@ -175,27 +223,37 @@ class BucketModel(object):
         Delete the bucket.
         """
         del LRU_CACHE[self.cache_key]
+        reset_bucket_visitors(self.user_name, self.bucket_name)
+        forget_disabled(self.user_name, self.bucket_name)
+        property_ids = yield get_relation(self.keys.relation("property_name"))
+        time_partitions = yield get_time_partitions(self.keys)
+        hot_events = yield get_relation(self.keys.relation("hot_event"))
+        if event_model.HOT_EVENTS is not None:
+            event_model.HOT_EVENTS.forget(self.keys)
         key = (self.user_name, "bucket")
         column_id = self.bucket_name
         deferreds = []
         deferreds.append(delete_relation(key, column_id=column_id))
-        keys = [
-                (self.user_name, self.bucket_name, "event"),
-                (self.user_name, self.bucket_name, "funnel"),
-                (self.user_name, self.bucket_name, "property"),
-                (self.user_name, self.bucket_name, "property_name")]
+        keys = [self.keys.relation(x) for x in RELATION_KINDS]
+        keys.extend([self.keys.property(x) for x in property_ids])
         for i in range(0, 256):
             shard = chr(i)
             keys.extend([(self.user_name, self.bucket_name, "visitor_property", shard)])
+        keys.extend(visitor_rows(self.keys, "visitor_state"))
         deferreds.append(delete_relations(keys))
-        keys = []
-        hash_keys = ["property", "event", "hourly_event", "daily_event", 
-                     "unique_event", "hourly_unique_event", 
-                     "daily_unique_event", "path", "hourly_path", 
-                     "daily_path", "unique_path", "hourly_unique_path", 
-                     "daily_unique_path", "visitor_event", "visitor_path"]
-        for i in range(0, 256):
-            keys.extend([(self.user_name, self.bucket_name, x, chr(i)) 
-                for x in hash_keys])
+        keys = self.keys.counters()
+        shard_keys = set(keys)
+        for partitions, partition in time_partitions:
+            keys.extend(partitions.rows(self.keys, partition))
+        for event_id, subrows in hot_events.items():
+            for kind in HOT_EVENT_KINDS:
+                keys.extend(hot_event_rows(
+                    self.keys,
+                    kind,
+                    event_id,
+                    ujson.loads(subrows)))
+        for kind in ("visitor_event", "visitor_path", "visitor_property"):
+            keys.extend([x for x in visitor_rows(self.keys, kind)
+                if x not in shard_keys])
         deferreds.append(delete_counters(keys))
         yield DeferredList(deferreds)
\ No newline at end of file
@@ -5,28 +5,114 @@
 Events are name/timestamp pairs linked to a visitor and stored in buckets.
 """
 
+import struct
+import time
 from ..lib.hash import pack_hash
-from twisted.internet.defer import inlineCallbacks, returnValue
-from ..lib.cassandra import insert_relation_by_id, increment_counter, \
-    get_counter, BUFFER, get_relation, pack_hour, pack_day, pack_timestamp, \
-    unpack_timestamp
+from twisted.internet.defer import inlineCallbacks, returnValue, \
+    gatherResults
+from ..lib.cassandra import get_counter, get_relation, get_timed_counter, \
+    get_counter_arrays, pack_timestamp
+from ..lib.columnar import decode_timed
 from collections import defaultdict
 from ..lib.profiler import profile
+from ..lib.keys import bucket_keys, TimePartitions
 import ujson
 
 
 _16_BYTE_FILLER = chr(0)*16
 _32_BYTE_FILLER = chr(0)*32
+_TIMESTAMP = struct.Struct(">1i")
+# TimePartitions splitting the hourly and daily rows, or None for rows
+# holding every period.
+TIME_PARTITIONS = None
+# True while migrations.time_partitions copies the unpartitioned rows,
+# which are then read as well until each is marked as copied.
+TIME_PARTITIONS_MIGRATING = False
+# HotEvents spreading the increments of popular events over sub-rows.
+HOT_EVENTS = None
+# DailyRollup deriving daily counters from hourly ones, or None to write
+# both.
+DAILY_ROLLUP = None
+
+
+def _period(hash_value):
+    """
+    Length in seconds of the periods of an hourly or daily counter kind.
+    """
+    if hash_value.startswith("daily"):
+        return 60*60*24
+    return 60*60
+
+
+def time_partition_relations(keys, timestamps):
+    """
+    Relation columns registering the TIME_PARTITIONS partitions of packed
+    hour or day timestamps in the bucket, as (row key, column id, value)
+    tuples. Columns are named by the packed partition start and hold the
+    period.
+    """
+    if TIME_PARTITIONS is None:
+        return []
+    partitions = set([TIME_PARTITIONS.partition(_TIMESTAMP.unpack(x)[0])
+        for x in timestamps])
+    return [(
+        keys.relation("time_partition"),
+        _TIMESTAMP.pack(x),
+        TIME_PARTITIONS.period) for x in partitions]
 
 
-def sort_nested_dict(d):
+def migrated_column(hash_value, shard):
+    """
+    Name of the time_partition relation column marking the unpartitioned
+    row of a timed counter kind and shard as copied into its partitions.
+    """
+    return "migrated/%s/%s" % (hash_value, ord(shard))
+
+
+def granularities(disabled, now):
+    """
+    Indexes of the lifetime (0), hourly (1), and daily (2) totals and paths
+    written at now for a bucket without the disabled families. Hourly
+    counters are kept while daily ones are rolled up from them.
+    """
+    rolled_up = DAILY_ROLLUP is not None and \
+        not DAILY_ROLLUP.writes_daily(now)
+    totals = [0]
+    paths = [] if "path" in disabled else [0]
+    for suffix, written in (("event", totals), ("path", paths)):
+        hourly = "hourly_" + suffix not in disabled
+        daily = "daily_" + suffix not in disabled
+        if hourly or (rolled_up and daily):
+            written.append(1)
+        if daily and not rolled_up:
+            written.append(2)
+    return tuple(totals), tuple(paths)
+
+
+def timed_key(keys, hash_value, shard, timestamp):
     """
-    Sorts nested dictionary d[x][y] = sorted([])
+    Key of the row of a timed counter kind and shard holding the packed
+    timestamp's period.
     """
-    for x in d:
-        for y in d[x]:
-            d[x][y] = sorted(d[x][y].items(), key=lambda z:z[0])
-    return d
+    if TIME_PARTITIONS is None:
+        return keys.counter(hash_value, shard)
+    return TIME_PARTITIONS.row(
+        keys,
+        hash_value,
+        shard,
+        TIME_PARTITIONS.partition(_TIMESTAMP.unpack(timestamp)[0]))
+
+
+@inlineCallbacks
+def get_time_partitions(keys):
+    """
+    Partitions registered in a bucket, as a list of (TimePartitions,
+    partition start) pairs sorted by start. Migration marks are left out.
+    """
+    data = yield get_relation(keys.relation("time_partition"))
+    returnValue(sorted([(TimePartitions(y), _TIMESTAMP.unpack(x)[0])
+        for x, y in data.items() if len(x) == _TIMESTAMP.size],
+        key=lambda x:x[1]))
 
 
 class EventModel(object):
@@ -37,6 +123,7 @@ class EventModel(object):
     def __init__(self, user_name, bucket_name, event_name=None, event_id=None):
         self.user_name = user_name
         self.bucket_name = bucket_name
+        self.keys = bucket_keys(user_name, bucket_name)
         self.event_name = event_name
         if event_name:
             self.id = pack_hash((event_name,))
@@ -46,16 +133,6 @@ class EventModel(object):
             raise ValueError("EventModel requires 'event_name' or 'event_id'.")
         self.shard = self.id[0]
 
-    @profile
-    def create(self):
-        """
-        Bucket event.
-        """
-        key = (self.user_name, self.bucket_name, "event")
-        column_id = self.id
-        value = self.event_name
-        insert_relation_by_id(key, column_id, value)
-
     @profile
     @inlineCallbacks
     def get_properties(self):
@@ -63,10 +140,9 @@ class EventModel(object):
         Returns dictionary of id:name pairs for properties associated with the
         event.
         """
-        key = (self.user_name, self.bucket_name, "event", self.shard)
-        data = yield get_counter(key, prefix=self.id)
+        data = yield self._get_counter("event", self.id)
         property_prefix_ids = set([column_id[0:16] for column_id in data])
-        key = (self.user_name, self.bucket_name, "property_name")
+        key = self.keys.relation("property_name")
         column_ids = property_prefix_ids
         data = yield get_relation(key, column_ids=column_ids)
         returnValue(dict([(x, ujson.loads(data[x])) for x in data]))
@@ -77,77 +153,134 @@ class EventModel(object):
         """
         Gets event name.
         """
-        key = (self.user_name, self.bucket_name, "event")
+        key = self.keys.relation("event")
         column_id = self.id
         name = yield get_relation(key, column_id=column_id)
         self.event_name = name
         returnValue(name)
 
-    @profile
-    def increment_total(self, unique, property_id=None, value=1):
-        """
-        Increment the total count of event_id.
-        """
-        key = (self.user_name, self.bucket_name, "event", self.shard)
-        column_id = "".join([self.id, property_id or _32_BYTE_FILLER])
-        increment_counter(key, column_id=column_id, value=value)
-        if unique:
-            key = (
-                self.user_name, 
-                self.bucket_name, 
-                "unique_event", 
-                self.shard)
-            increment_counter(key, column_id=column_id)
-            if property_id:
-                key = (
-                    self.user_name, 
-                    self.bucket_name, 
-                    "property", 
-                    property_id[0])
-                column_id = "".join([property_id, self.id])
-                increment_counter(key, column_id=column_id)
+    @inlineCallbacks
+    def _get_counter(self, hash_value, prefix):
+        """
+        Read the columns after prefix from the row of an event counter
+        kind, summed with the event's sub-rows if it is hot.
+        """
+        if HOT_EVENTS is None:
+            keys = [self.keys.counter(hash_value, self.shard)]
+        else:
+            keys = yield HOT_EVENTS.rows(self.keys, hash_value, self.id)
+        if len(keys) == 1:
+            data = yield get_counter(keys[0], prefix=prefix, cached=True)
+            returnValue(data)
+        results = yield gatherResults([
+            get_counter(x, prefix=prefix, cached=True) for x in keys])
+        data = defaultdict(lambda:0)
+        for result in results:
+            for column_id, value in result.items():
+                data[column_id] += value
+        returnValue(data)
 
-    @profile
-    def increment_hourly_total(self, unique, property_id=None, value=1):
-        """
-        Increment the total hourly count of event_id.
-        """
-        key = (self.user_name, self.bucket_name, "hourly_event", self.shard)
-        property_id = property_id or _32_BYTE_FILLER
-        column_id = "".join([
-            self.id,
-            property_id[0:16],
-            pack_hour(),
-            property_id[16:32]])
-        increment_counter(key, column_id=column_id, value=value)
-        if unique:
-            key = (
-                self.user_name, 
-                self.bucket_name, 
-                "hourly_unique_event", 
-                self.shard)
-            increment_counter(key, column_id=column_id)
+    @inlineCallbacks
+    def _get_timed_counter(self, hash_value, prefix, start, finish):
+        """
+        Read the timed columns after prefix from start to finish. Daily
+        columns of days DAILY_ROLLUP has not rolled up are summed from the
+        hourly columns.
+        """
+        if DAILY_ROLLUP is None or not hash_value.startswith("daily"):
+            result = yield self._read_timed_counter(
+                hash_value,
+                prefix,
+                start,
+                finish)
+            returnValue(result)
+        start = int(start or time.time())
+        finish = int(finish or time.time())
+        watermark = yield DAILY_ROLLUP.watermark(self.keys)
+        names, values = [], []
+        if start < watermark:
+            names, values = yield self._read_timed_counter(
+                hash_value,
+                prefix,
+                start,
+                min(finish, watermark - 1))
+        day = 60*60*24
+        first = max(watermark, start + -start % day)
+        if first > finish:
+            returnValue((names, values))
+        hourly_names, hourly_values = yield self._read_timed_counter(
+            "hourly" + hash_value[len("daily"):],
+            prefix,
+            first,
+            finish - finish % day + day - 1)
+        columns = defaultdict(lambda:0)
+        for name, value in zip(hourly_names, hourly_values):
+            hour = _TIMESTAMP.unpack(name[0:4])[0]
+            columns[_TIMESTAMP.pack(hour - hour % day) + name[4:]] += value
+        names.extend(columns.keys())
+        values.extend(columns.values())
+        returnValue((names, values))
 
-    @profile
-    def increment_daily_total(self, unique, property_id=None, value=1):
-        """
-        Increment the total daily count of event_id.
-        """
-        key = (self.user_name, self.bucket_name, "daily_event", self.shard)
-        property_id = property_id or _32_BYTE_FILLER
-        column_id = "".join([
-            self.id,
-            property_id[0:16],
-            pack_day(),
-            property_id[16:32]])
-        increment_counter(key, column_id=column_id, value=value)
-        if unique:
-            key = (
-                self.user_name, 
-                self.bucket_name, 
-                "daily_unique_event", 
-                self.shard)
-            increment_counter(key, column_id=column_id)
+    @inlineCallbacks
+    def _read_timed_counter(self, hash_value, prefix, start, finish):
+        """
+        Read the timed columns after prefix from start to finish from the
+        row of a timed counter kind, or from the rows of every partition
+        covering them in parallel. While TIME_PARTITIONS_MIGRATING, a row
+        that is not marked as copied is read as well, and neither is read
+        through PERIODS, which would keep the partitions' closed periods
+        from before the copy.
+        """
+        if TIME_PARTITIONS is None:
+            result = yield get_timed_counter(
+                self.keys.counter(hash_value, self.shard),
+                prefix,
+                start,
+                finish,
+                _period(hash_value))
+            returnValue(result)
+        start = int(start or time.time())
+        finish = int(finish or time.time())
+        ranges = [(
+            TIME_PARTITIONS.row(self.keys, hash_value, self.shard, x[0]),
+            x[1],
+            x[2]) for x in TIME_PARTITIONS.ranges(start, finish)]
+        copied = True
+        if TIME_PARTITIONS_MIGRATING:
+            column_id = migrated_column(hash_value, self.shard)
+            data = yield get_relation(
+                self.keys.relation("time_partition"),
+                column_ids=[column_id])
+            copied = column_id in data
+        if copied:
+            results = yield gatherResults([get_timed_counter(
+                key,
+                prefix,
+                _start,
+                _finish,
+                _period(hash_value)) for key, _start, _finish in ranges])
+        else:
+            ranges.append((
+                self.keys.counter(hash_value, self.shard),
+                start,
+                finish))
+            results = yield gatherResults([get_counter_arrays(
+                key,
+                prefix=prefix,
+                start=pack_timestamp(_start),
+                finish=pack_timestamp(_finish),
+                cached=True) for key, _start, _finish in ranges])
+            # The period of the switch has columns in both rows.
+            columns = defaultdict(lambda:0)
+            for _names, _values in results:
+                for name, value in zip(_names, _values):
+                    columns[name] += value
+            returnValue((columns.keys(), columns.values()))
+        names, values = [], []
+        for _names, _values in results:
+            names.extend(_names)
+            values.extend(_values)
+        returnValue((names, values))
 
     @profile
     def get_total(self, _property=None):
@@ -168,13 +301,12 @@ class EventModel(object):
         """
         Get the count of event_id.
         """
-        key = (self.user_name, self.bucket_name, hash_value, self.shard)
         if _property:
             property_prefix_id = _property.id
         else:
             property_prefix_id = _16_BYTE_FILLER
         prefix = self.id + property_prefix_id
-        data = yield get_counter(key, prefix=prefix)
+        data = yield self._get_counter(hash_value, prefix)
         result = defaultdict(lambda:defaultdict(lambda:0))
         for column_id in data:
             property_id = property_prefix_id + column_id[0:16]
@@ -215,90 +347,24 @@ class EventModel(object):
         """
         Get the regular or unique timed counts.
         """
-        start = pack_timestamp(start)
-        finish = pack_timestamp(finish)
-        key = (self.user_name, self.bucket_name, hash_value, self.shard)
         if _property:
             property_prefix_id = _property.id
         else:
             property_prefix_id = _16_BYTE_FILLER
         prefix = self.id + property_prefix_id
-        data = yield get_counter(key, prefix=prefix, start=start, finish=finish)
+        names, values = yield self._get_timed_counter(
+            hash_value,
+            prefix,
+            start,
+            finish)
         result = defaultdict(list)
-        for column_id in data:
-            timestamp = unpack_timestamp(column_id[0:4])
-            property_id = property_prefix_id + column_id[4:20]
+        for suffix, timestamps, counts in decode_timed(names, values):
+            property_id = property_prefix_id + suffix
             if property_id == _32_BYTE_FILLER:
                 property_id = self.id
-            result[property_id].append((timestamp, data[column_id]))
-        for property_id in result:
-            result[property_id] = sorted(result[property_id], key=lambda x:x[0])
+            result[property_id] = zip(timestamps, counts)
         returnValue(result)
 
-    @profile
-    def increment_hourly_path(
-            self, 
-            event_id, 
-            unique, 
-            property_id=None, 
-            value=1):
-        """
-        Increments the path by hour.
-        """
-        key = (self.user_name, self.bucket_name, "hourly_path", self.shard)
-        property_id = property_id or _32_BYTE_FILLER
-        column_id = "".join([
-            self.id,
-            property_id[0:16],
-            pack_hour(),
-            property_id[16:32],
-            event_id])
-        increment_counter(key, column_id=column_id, value=value)
-        if unique:
-            key = (
-                self.user_name, 
-                self.bucket_name, 
-                "hourly_unique_path", 
-                self.shard)
-            increment_counter(key, column_id=column_id)
-
-    @profile
-    def increment_daily_path(self, event_id, unique, property_id=None, value=1):
-        """
-        Increments the path by day.
-        """
-        key = (self.user_name, self.bucket_name, "daily_path", self.shard)
-        property_id = property_id or _32_BYTE_FILLER
-        column_id = "".join([
-            self.id,
-            property_id[0:16],
-            pack_day(),
-            property_id[16:32],
-            event_id])
-        increment_counter(key, column_id=column_id, value=value)
-        if unique:
-            key = (
-                self.user_name, 
-                self.bucket_name, 
-                "daily_unique_path", 
-                self.shard)
-            increment_counter(key, column_id=column_id)
-
-    @profile
-    def increment_path(self, event_id, unique, property_id=None, value=1):
-        """
-        Increment the path of events from self.id -> event_id.
-        """
-        key = (self.user_name, self.bucket_name, "path", self.shard)
-        column_id = "".join([
-            self.id,
-            property_id or _32_BYTE_FILLER,
-            event_id])
-        increment_counter(key, column_id=column_id, value=value)
-        if unique:
-            key = (self.user_name, self.bucket_name, "unique_path", self.shard)
-            increment_counter(key, column_id=column_id)
-
     @profile
     def get_path(self, _property=None):
         """
@@ -318,13 +384,12 @@ class EventModel(object):
         """
         Get the regular or unique path of visitor events.
         """
-        key = (self.user_name, self.bucket_name, hash_value, self.shard)
         if _property:
             property_prefix_id = _property.id
         else:
             property_prefix_id = _16_BYTE_FILLER
         prefix = self.id + property_prefix_id
-        data = yield get_counter(key, prefix=prefix)
+        data = yield self._get_counter(hash_value, prefix)
         result = defaultdict(lambda:defaultdict(lambda:0))
         for column_id in data:
             property_id = property_prefix_id + column_id[0:16]
@@ -366,64 +431,28 @@ class EventModel(object):
         """
         Get the regular or unique path of timed visitor events.
         """
-        key = (self.user_name, self.bucket_name, hash_value, self.shard)
         if _property:
             property_prefix_id = _property.id
         else:
             property_prefix_id = _16_BYTE_FILLER
-        start = pack_timestamp(start)
-        finish = pack_timestamp(finish)
         prefix = self.id + property_prefix_id
-        data = yield get_counter(
-            key, 
-            prefix=prefix, 
-            start=start, 
-            finish=finish)
-        result = defaultdict(lambda:defaultdict(lambda:defaultdict(lambda:0)))
-        for column_id in data:
-            property_id = property_prefix_id + column_id[4:20]
-            timestamp = unpack_timestamp(column_id[0:4])
-            event_id = column_id[20:36]
+        names, values = yield self._get_timed_counter(
+            hash_value,
+            prefix,
+            start,
+            finish)
+        result = defaultdict(lambda:defaultdict(list))
+        for suffix, timestamps, counts in decode_timed(names, values):
+            property_id = property_prefix_id + suffix[0:16]
+            event_id = suffix[16:32]
             if property_id == _32_BYTE_FILLER:
                 property_id = self.id
-            result[property_id][event_id][timestamp] += data[column_id]
-        returnValue(sort_nested_dict(result))
-
-    @profile
-    def batch_add(self, visitor, total, path, property_ids):
-        """
-        Add the event to the visitor, increment global counters, and return
-        a list of deferreds.
-        """
-        unique = self.id not in total
-        self.create()
-        self.increment_total(unique)
-        self.increment_hourly_total(unique)
-        self.increment_daily_total(unique)
-        visitor.increment_total(self.id)
-        for property_id in property_ids:
-            self.increment_total(unique, property_id)
-            self.increment_hourly_total(unique, property_id)
-            self.increment_daily_total(unique, property_id)
-        for event_id in total:
-            _unique = unique or event_id not in path[self.id]
-            self.increment_path(event_id, _unique)
-            self.increment_hourly_path(event_id, _unique)
-            self.increment_daily_path(event_id, _unique)
-            visitor.increment_path(event_id, self.id)
-            for property_id in property_ids:
-                self.increment_path(event_id, _unique, property_id)
-                self.increment_hourly_path(event_id, _unique, property_id)
-                self.increment_daily_path(event_id, _unique, property_id)
-            path[event_id][self.id] += 1 # Update the visitor path for batch
-        total[self.id] += 1 # Update the visitor total for batch
+            result[property_id][event_id] = zip(timestamps, counts)
+        returnValue(result)
 
     @profile
-    @inlineCallbacks
     def add(self, visitor):
         """
         Add the event to the visitor and increment global counters.
         """
-        total, path, property_ids = yield visitor.get_metadata()
-        self.batch_add(visitor, total, path, property_ids)
-        yield BUFFER.flush()
+        return visitor.ingest([self])
@@ -10,6 +10,7 @@ from twisted.internet.defer import inlineCallbacks
 from ..lib.cassandra import get_relation, insert_relation, delete_relation
 from ..lib.b64encode import uri_b64encode, uri_b64decode
 from ..lib.profiler import profile
+from ..lib.keys import bucket_keys
 from .property import PropertyModel
 
 class FunnelModel(object):
@@ -22,6 +23,7 @@ class FunnelModel(object):
     def __init__(self, user_name, bucket_name, funnel_name):
         self.user_name = user_name
         self.bucket_name = bucket_name
+        self.keys = bucket_keys(user_name, bucket_name)
         self.funnel_name = funnel_name
         self.description = None
         self.property = None
@@ -32,7 +34,7 @@ class FunnelModel(object):
         """
         Create funnel.
         """
-        key = (self.user_name, self.bucket_name, "funnel")
+        key = self.keys.relation("funnel")
         column = (self.funnel_name,)
         self.description = description
         if property_name:
@@ -55,7 +57,7 @@ class FunnelModel(object):
         """
         Get a saved funnel.
         """
-        key = (self.user_name, self.bucket_name, "funnel")
+        key = self.keys.relation("funnel")
         column = (self.funnel_name,)
         value = yield get_relation(key, column)
         description, property_name, encoded_event_ids = ujson.loads(value)
@@ -74,6 +76,6 @@ class FunnelModel(object):
         """
         Delete the funnel.
         """
-        key = (self.user_name, self.bucket_name, "funnel")
+        key = self.keys.relation("funnel")
         column = (self.funnel_name,)
         return delete_relation(key, column)
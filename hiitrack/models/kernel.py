@@ -0,0 +1,253 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Relation and counter mutations of a visitor's ingest, computed in one pass.
+"""
+
+import struct
+import time
+from .property import PropertyValueModel
+from . import event as event_model
+
+
+_16_BYTE_FILLER = chr(0)*16
+_32_BYTE_FILLER = chr(0)*32
+_TIMESTAMP = struct.Struct(">1i")
+
+
+class MutationKernel(object):
+    """
+    Computes the relation and counter mutations of adding events and
+    property values to a visitor, and is the only place ingest writes
+    counters. An event counts towards the event, unique_event, path, and
+    unique_path rows and their hourly and daily kinds, alone and with
+    each of the visitor's properties. A new property value adds the
+    visitor's earlier totals and paths to its columns once. The visitor's
+    own event, path, and property counters hold its metadata.
+
+    Row keys come from the bucket's key table, hot event sub-rows, time
+    partitions and the visitor's partition rows, the hour and day are
+    packed once per kernel, and each event's column prefixes are joined
+    once and shared by its totals and paths.
+    Relation inserts are emitted as (row key, column id, value) and
+    counter increments as (row key, column id, delta) tuples. Without
+    visitor_counters the visitor's own event, path, and property counters
+    are left out, for visitors whose state is stored as a blob. Counters
+    of the bucket's disabled families are left out as well.
+    """
+
+    def __init__(self, visitor, now=None, visitor_counters=True, disabled=()):
+        now = int(now or time.time())
+        self.keys = visitor.keys
+        self.visitor_id = visitor.id
+        self.visitor_counters = visitor_counters
+        self.hour = _TIMESTAMP.pack(now - now % (60*60))
+        self.day = _TIMESTAMP.pack(now - now % (60*60*24))
+        self.time_partitions = event_model.TIME_PARTITIONS
+        if self.time_partitions is not None:
+            self.hour_partition = self.time_partitions.partition(
+                now - now % (60*60))
+            self.day_partition = self.time_partitions.partition(
+                now - now % (60*60*24))
+        self.time_partition_relations = \
+            event_model.time_partition_relations(
+                self.keys,
+                (self.hour, self.day))
+        # Total, hourly, and daily columns are written, leaving out the
+        # disabled ones and the daily ones while they are rolled up from
+        # the hourly ones.
+        self.total_granularities, self.path_granularities = \
+            event_model.granularities(disabled, now)
+        self.property_totals = "property_event" not in disabled
+        self.property_paths = "property_path" not in disabled
+        self.paths = "path" not in disabled
+        self.visitor_event = visitor.row("visitor_event")
+        self.visitor_path = visitor.row("visitor_path")
+        self.visitor_property = visitor.row("visitor_property")
+        self.relations = []
+        self.counters = []
+
+    def run(self, models, total, path, property_ids):
+        """
+        Add [model, count] pairs of events and property values in order,
+        updating the visitor's total, path, and property_ids as their
+        counters are. Returns the relation and counter mutations.
+        """
+        for model, count in models:
+            if isinstance(model, PropertyValueModel):
+                self.add_property(model, total, path, property_ids)
+            else:
+                self.add_event(model, count, total, path, property_ids)
+        return self.relations, self.counters
+
+    def copy_visitor(self, total, path, property_ids):
+        """
+        Visitor counters holding the visitor's current metadata, for a
+        visitor read from a previous partition scheme.
+        """
+        if not self.visitor_counters:
+            return
+        counter = self.counters.append
+        for event_id in total:
+            counter((
+                self.visitor_event,
+                self.visitor_id + event_id,
+                total[event_id]))
+        for new_event_id in path:
+            for event_id in path[new_event_id]:
+                counter((
+                    self.visitor_path,
+                    self.visitor_id + new_event_id + event_id,
+                    path[new_event_id][event_id]))
+        for property_id in property_ids:
+            counter((self.visitor_property, self.visitor_id + property_id, 1))
+
+    def row(self, kind, event_id):
+        """
+        Key of the row taking increments of an event counter kind.
+        """
+        if event_model.HOT_EVENTS is None:
+            return self.keys.counter(kind, event_id[0])
+        return event_model.HOT_EVENTS.row(self.keys, kind, event_id)
+
+    def hourly(self, kind, shard):
+        """
+        Key of the row of an hourly counter kind holding the hour.
+        """
+        if self.time_partitions is None:
+            return self.keys.counter(kind, shard)
+        return self.time_partitions.row(
+            self.keys,
+            kind,
+            shard,
+            self.hour_partition)
+
+    def daily(self, kind, shard):
+        """
+        Key of the row of a daily counter kind holding the day.
+        """
+        if self.time_partitions is None:
+            return self.keys.counter(kind, shard)
+        return self.time_partitions.row(
+            self.keys,
+            kind,
+            shard,
+            self.day_partition)
+
+    def add_event(self, event, count, total, path, property_ids):
+        """
+        Mutations of adding an event count times in a row.
+        """
+        keys = self.keys
+        counter = self.counters.append
+        event_id = event.id
+        shard = event_id[0]
+        unique = event_id not in total
+        self.relations.append(
+            (keys.relation("event"), event_id, event.event_name))
+        if self.time_partition_relations:
+            self.relations.extend(self.time_partition_relations)
+            self.time_partition_relations = []
+        if event_model.HOT_EVENTS is not None:
+            event_model.HOT_EVENTS.record(keys, event_id, count)
+        # Columns of the event alone and with each property are named
+        # event + property for totals, event + property[0:16] + hour or day
+        # + property[16:32] for timed totals, and either + predecessor for
+        # paths.
+        prefixes = [(
+            event_id + _32_BYTE_FILLER,
+            event_id + _16_BYTE_FILLER + self.hour + _16_BYTE_FILLER,
+            event_id + _16_BYTE_FILLER + self.day + _16_BYTE_FILLER)]
+        for property_id in property_ids:
+            prefixes.append((
+                event_id + property_id,
+                event_id + property_id[0:16] + self.hour + property_id[16:32],
+                event_id + property_id[0:16] + self.day + property_id[16:32]))
+        total_prefixes = prefixes if self.property_totals else prefixes[0:1]
+        path_prefixes = prefixes if self.property_paths else prefixes[0:1]
+        granularities = self.total_granularities
+        rows = (
+            self.row("event", event_id),
+            self.hourly("hourly_event", shard),
+            self.daily("daily_event", shard))
+        for prefix in total_prefixes:
+            for i in granularities:
+                counter((rows[i], prefix[i], count))
+        if unique:
+            rows = (
+                self.row("unique_event", event_id),
+                self.hourly("hourly_unique_event", shard),
+                self.daily("daily_unique_event", shard))
+            for prefix in total_prefixes:
+                for i in granularities:
+                    counter((rows[i], prefix[i], 1))
+            if self.property_totals:
+                for property_id in property_ids:
+                    counter((
+                        keys.counter("property", property_id[0]),
+                        property_id + event_id,
+                        1))
+        if self.visitor_counters:
+            counter((self.visitor_event, self.visitor_id + event_id, count))
+        paths = [(x, unique or x not in path[event_id], count) for x in total]
+        if unique and count > 1:
+            # Repeats of a new event follow the event itself.
+            paths.append((event_id, True, count - 1))
+        rows = (
+            self.row("path", event_id),
+            self.hourly("hourly_path", shard),
+            self.daily("daily_path", shard))
+        unique_rows = (
+            self.row("unique_path", event_id),
+            self.hourly("hourly_unique_path", shard),
+            self.daily("daily_unique_path", shard))
+        visitor_prefix = self.visitor_id + event_id
+        granularities = self.path_granularities
+        for predecessor_id, _unique, value in paths:
+            for prefix in path_prefixes:
+                for i in granularities:
+                    column_id = prefix[i] + predecessor_id
+                    counter((rows[i], column_id, value))
+                    if _unique:
+                        counter((unique_rows[i], column_id, 1))
+            if self.visitor_counters:
+                counter((
+                    self.visitor_path,
+                    visitor_prefix + predecessor_id,
+                    value))
+            path[event_id][predecessor_id] += value
+        total[event_id] += count
+
+    def add_property(self, property_value, total, path, property_ids):
+        """
+        Mutations of adding a property value, which only counts once.
+        """
+        property_id = property_value.id
+        if property_id in property_ids:
+            return
+        keys = self.keys
+        counter = self.counters.append
+        property_row = keys.counter("property", property_id[0])
+        for event_id in total if self.property_totals else ():
+            column_id = event_id + property_id
+            counter((self.row("event", event_id), column_id, total[event_id]))
+            counter((self.row("unique_event", event_id), column_id, 1))
+            counter((property_row, property_id + event_id, 1))
+        if not (self.paths and self.property_paths):
+            path = {}
+        for new_event_id in path:
+            row = self.row("path", new_event_id)
+            unique_row = self.row("unique_path", new_event_id)
+            prefix = new_event_id + property_id
+            for event_id in path[new_event_id]:
+                column_id = prefix + event_id
+                counter((row, column_id, path[new_event_id][event_id]))
+                counter((unique_row, column_id, 1))
+        self.relations.extend(property_value.relations())
+        if self.visitor_counters:
+            counter((
+                self.visitor_property,
+                self.visitor_id + property_id,
+                1))
+        property_ids.append(property_id)
@@ -10,10 +10,14 @@ from itertools import chain
 from twisted.internet.defer import inlineCallbacks, returnValue
 from collections import defaultdict
 from ..lib.hash import pack_hash
-from ..lib.cassandra import get_counter, insert_relation_by_id, BUFFER, \
-    get_relation
-from .event import EventModel
+from ..lib.cassandra import get_counter, get_relation, get_relation_page
 from ..lib.profiler import profile
+from ..lib.keys import bucket_keys
+
+
+# Layout of property values: one "bucket" relation row, a row per
+# "property", or "migrating", which writes both and reads the bucket row.
+PROPERTY_ROWS = "bucket"
 
 
 class PropertyModel(object):
@@ -28,6 +32,7 @@ class PropertyModel(object):
             property_prefix_id=None):
         self.user_name = user_name
         self.bucket_name = bucket_name
+        self.keys = bucket_keys(user_name, bucket_name)
         self.property_name = property_name
         if property_name:
             self.id = pack_hash((property_name,))
@@ -42,7 +47,7 @@ class PropertyModel(object):
         """
         Return the name of the property.
         """
-        key = (self.user_name, self.bucket_name, "property_name")
+        key = self.keys.relation("property_name")
         column_id = self.id
         data = yield get_relation(key, column_id=column_id)
         returnValue(ujson.loads(data))
@@ -52,20 +57,50 @@ class PropertyModel(object):
         """
         Get the values associated with the property.
         """
-        key = (self.user_name, self.bucket_name, "property")
-        prefix = self.id
-        data = yield get_relation(key, prefix=prefix)
+        if PROPERTY_ROWS == "property":
+            key = self.keys.property(self.id)
+            data = yield get_relation(key)
+        else:
+            key = self.keys.relation("property")
+            prefix = self.id
+            data = yield get_relation(key, prefix=prefix)
         returnValue(dict([(self.id + x[0], ujson.loads(x[1])[1]) 
             for x in data.items()]))
 
     @inlineCallbacks
-    def get_totals(self):
+    def get_values_page(self, cursor=None, limit=100):
+        """
+        Get up to limit values associated with the property, after the
+        cursor. Returns the values and the cursor of the next page.
+        """
+        if PROPERTY_ROWS == "property":
+            key = self.keys.property(self.id)
+            prefix = None
+        else:
+            key = self.keys.relation("property")
+            prefix = self.id
+        data, cursor = yield get_relation_page(
+            key,
+            prefix=prefix,
+            cursor=cursor,
+            limit=limit)
+        returnValue((dict([(self.id + x[0], ujson.loads(x[1])[1])
+            for x in data.items()]), cursor))
+
+    @inlineCallbacks
+    def get_totals(self, start='', finish=''):
         """
-        Get the counts associated with the property values.
+        Get the counts associated with the property values, optionally
+        between the start and finish value IDs.
         """
-        key = (self.user_name, self.bucket_name, "property", self.id[0])
+        key = self.keys.counter("property", self.id[0])
         prefix = self.id
-        data = yield get_counter(key, prefix=prefix)
+        data = yield get_counter(
+            key,
+            prefix=prefix,
+            start=start,
+            finish=finish,
+            cached=True)
         response = defaultdict(lambda:defaultdict(lambda:0))
         for column_id in data:
             property_id = self.id + column_id[0:16]
@@ -74,12 +109,21 @@ class PropertyModel(object):
         returnValue(response)
 
     @inlineCallbacks
-    def get_events(self):
-        key = (self.user_name, self.bucket_name, "property", self.id[0])
-        prefix = self.id
-        data = yield get_counter(key, prefix=prefix)
-        column_ids = set([column_id[16:] for column_id in data])
-        key = (self.user_name, self.bucket_name, "event")
+    def get_events(self, totals=None):
+        """
+        Get the events recorded with the property, or with the values in
+        totals as returned by get_totals().
+        """
+        if totals is not None:
+            column_ids = set(chain(*totals.values()))
+            if not column_ids:
+                returnValue({})
+        else:
+            key = self.keys.counter("property", self.id[0])
+            prefix = self.id
+            data = yield get_counter(key, prefix=prefix, cached=True)
+            column_ids = set([column_id[16:] for column_id in data])
+        key = self.keys.relation("event")
         events = yield get_relation(key, column_ids=column_ids)
         returnValue(events)
 
@@ -92,25 +136,32 @@ class PropertyValueModel(object):
     def __init__(self, user_name, bucket_name, property_name, property_value):
         self.user_name = user_name
         self.bucket_name = bucket_name
+        self.keys = bucket_keys(user_name, bucket_name)
         self.property_name = property_name
         self.property_value = property_value
         self.id = "".join([
             pack_hash((property_name,)),
             pack_hash((ujson.dumps(self.property_value),))])
 
-    @profile
-    def create(self):
+    def relations(self):
         """
-        Create property in a bucket.
+        Relation columns naming the property and its value in the
+        PROPERTY_ROWS layout, as (row key, column id, value) tuples.
         """
-        key = (self.user_name, self.bucket_name, "property")
-        column_id = self.id
         value = ujson.dumps((self.property_name, self.property_value))
-        insert_relation_by_id(key, column_id, value)
-        key = (self.user_name, self.bucket_name, "property_name")
-        column_id = self.id[0:16]
-        value = ujson.dumps(self.property_name)
-        insert_relation_by_id(key, column_id, value)
+        relations = []
+        if PROPERTY_ROWS != "property":
+            relations.append((self.keys.relation("property"), self.id, value))
+        if PROPERTY_ROWS != "bucket":
+            relations.append((
+                self.keys.property(self.id[0:16]),
+                self.id[16:32],
+                value))
+        relations.append((
+            self.keys.relation("property_name"),
+            self.id[0:16],
+            ujson.dumps(self.property_name)))
+        return relations
 
     def get_name_and_value(self):
         """
@@ -123,44 +174,13 @@ class PropertyValueModel(object):
         """
         Get the events associated with this property.
         """
-        key = (self.user_name, self.bucket_name, "property", self.id[0])
+        key = self.keys.counter("property", self.id[0])
         prefix = self.id
         return get_counter(key, prefix=prefix)
 
-    def batch_add(self, visitor, total, path, property_ids):
-        """
-        Add property/value to the visitor and return a list of deferreds.
-        """
-        if self.id in property_ids:
-            return []
-        for event_id in total:
-            event = EventModel(
-                self.user_name,
-                self.bucket_name,
-                event_id=event_id)
-            event.increment_total(
-                True,
-                property_id=self.id,
-                value=total[event_id])
-        for new_event_id in path:
-            event = EventModel(
-                self.user_name,
-                self.bucket_name,
-                event_id=new_event_id)
-            for event_id in path[new_event_id]:
-                event.increment_path(event_id,
-                    True,  # Unique
-                    property_id=self.id,
-                    value=path[event.id][event_id])
-        self.create()
-        visitor.add_property(self)
-
     @profile
-    @inlineCallbacks
     def add(self, visitor):
         """
         Add the property/value to the visitor and increment global counters.
         """
-        total, path, property_ids = yield visitor.get_metadata()
-        self.batch_add(visitor, total, path, property_ids)
-        yield BUFFER.flush()
+        return visitor.ingest([self])
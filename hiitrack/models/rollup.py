@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+"""
+Daily counters rolled up from hourly ones.
+"""
+
+import struct
+import time
+import ujson
+from twisted.internet.defer import inlineCallbacks, returnValue
+from ..lib.cassandra import scan, get_relation, Buffer
+from ..lib.families import get_disabled
+from ..lib.keys import SHARDS
+from . import event as event_model
+
+
+_TIMESTAMP = struct.Struct(">1i")
+_HOUR = 60*60
+_DAY = 60*60*24
+HOURLY_KINDS = (
+    "hourly_event",
+    "hourly_unique_event",
+    "hourly_path",
+    "hourly_unique_path")
+
+
+class DailyRollup(object):
+    """
+    Stops writing daily counters from the hour since on, deriving them
+    from the hourly counters instead.
+
+    Every daily column is the sum of the hourly columns of its day with
+    the same name, as both are incremented together. A rollup job adds
+    the hourly columns of closed days to the daily rows and then moves
+    the bucket's watermark, the first day it has not rolled up, to the
+    first open day. Reads take the days before the watermark from the
+    daily rows and sum the rest from the hourly rows, so a day switches
+    from one to the other at once. The day of since keeps the daily
+    increments written before it and gets the hourly columns from since
+    on.
+
+    Watermarks are cached for ttl seconds. An old watermark only reads
+    more days from the hourly rows. A day is closed grace seconds after it
+    ends, leaving time for buffered increments to be flushed. A job
+    records the day each hourly kind and shard is rolled up to as it
+    goes, so a rerun after a failure carries on from there. A shard whose
+    increments were only partly stored when the job failed is added
+    again in full and double counted.
+    """
+
+    def __init__(self, since, grace=300, ttl=60):
+        if since % _HOUR:
+            raise ValueError("Daily rollup must start on the hour.")
+        self.since = since
+        self.grace = grace
+        self.ttl = ttl
+        self.watermarks = {}
+
+    def writes_daily(self, now):
+        """
+        True if increments at now are written to the daily rows.
+        """
+        return now < self.since
+
+    @inlineCallbacks
+    def watermark(self, keys, cached=True):
+        """
+        First day of a bucket that is not rolled up.
+        """
+        bucket = (keys.user_name, keys.bucket_name)
+        now = time.time()
+        if cached and bucket in self.watermarks:
+            watermark, loaded = self.watermarks[bucket]
+            if now - loaded < self.ttl:
+                returnValue(watermark)
+        data = yield get_relation(
+            keys.relation("rollup"),
+            column_ids=["daily"])
+        if "daily" in data:
+            watermark = ujson.loads(data["daily"])
+        else:
+            watermark = self.since - self.since % _DAY
+        self.watermarks[bucket] = (watermark, now)
+        returnValue(watermark)
+
+    @inlineCallbacks
+    def rollup_bucket(self, keys, now=None):
+        """
+        Add the hourly columns of a bucket's closed days from the
+        watermark on to the daily rows and move the watermark. Each kind
+        and shard is marked in the rollup relation row once its days are
+        committed, and days it is marked for are skipped. Kinds whose
+        daily family the bucket was created without are skipped. Returns
+        the number of hourly columns added.
+        """
+        now = int(now or time.time())
+        watermark = yield self.watermark(keys, cached=False)
+        closed = (now - self.grace) // _DAY * _DAY
+        if closed <= watermark:
+            returnValue(0)
+        progress = yield get_relation(keys.relation("rollup"))
+        disabled = yield get_disabled(keys.user_name, keys.bucket_name)
+        # The job's own buffer, so its flushes fail only with its own
+        # increments and carry no live traffic.
+        buffer = Buffer()
+        rolled = [0]
+        for kind in HOURLY_KINDS:
+            daily_kind = "daily" + kind[len("hourly"):]
+            family = "daily_path" if kind.endswith("path") else "daily_event"
+            if family in disabled:
+                continue
+            for i in range(SHARDS):
+                shard = chr(i)
+                column_id = "%s/%s" % (kind, i)
+                start = max(watermark, self.since)
+                if column_id in progress:
+                    start = max(start, ujson.loads(progress[column_id]))
+                if start >= closed:
+                    continue
+                def consumer(columns):
+                    for column in columns:
+                        name = column.counter_column.name
+                        # Timestamps follow the event and property[0:16].
+                        hour = _TIMESTAMP.unpack(name[32:36])[0]
+                        if not start <= hour < closed:
+                            continue
+                        day = _TIMESTAMP.pack(hour - hour % _DAY)
+                        row = event_model.timed_key(
+                            keys,
+                            daily_kind,
+                            shard,
+                            day)
+                        buffer.increment_counter(
+                            row,
+                            name[0:32] + day + name[36:],
+                            column.counter_column.value)
+                        rolled[0] += 1
+                for row in _rows(keys, kind, shard, start, closed - 1):
+                    yield scan(row, "counter", consumer)
+                # Unlike commit(), fails if any increment does, and only
+                # then is the shard left unmarked.
+                yield buffer.flush_counter()
+                buffer.insert_relation(
+                    keys.relation("rollup"),
+                    column_id,
+                    ujson.dumps(closed))
+                yield buffer.flush_relation()
+        timestamps = [_TIMESTAMP.pack(x) for x in range(
+            watermark,
+            closed,
+            _DAY)]
+        for key, column_id, value in event_model.time_partition_relations(
+                keys,
+                timestamps):
+            buffer.insert_relation(key, column_id, value)
+        buffer.insert_relation(
+            keys.relation("rollup"),
+            "daily",
+            ujson.dumps(closed))
+        yield buffer.flush_relation()
+        self.watermarks[(keys.user_name, keys.bucket_name)] = (closed, now)
+        returnValue(rolled[0])
+
+
+def _rows(keys, kind, shard, start, finish):
+    """
+    Keys of the rows of a timed counter kind and shard holding start to
+    finish.
+    """
+    partitions = event_model.TIME_PARTITIONS
+    if partitions is None:
+        return [keys.counter(kind, shard)]
+    return [partitions.row(keys, kind, shard, x[0])
+        for x in partitions.ranges(start, finish)]
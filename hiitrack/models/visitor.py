@@ -5,11 +5,292 @@
 Visitors are stored in buckets and can have properties and events.
 """
 
-from twisted.internet.defer import inlineCallbacks, returnValue
+import os
+import sys
+import time
+from pylru import lrucache
+from twisted.internet.defer import inlineCallbacks, returnValue, Deferred
+from twisted.python import log
+from twisted.python.failure import Failure
 from ..lib.hash import pack_hash
-from ..lib.cassandra import get_counter, increment_counter, get_counters
+from ..lib.cassandra import get_counter, increment_counter, get_counters, \
+    scan, insert_relation_once, get_relation, BUFFER
+from ..lib.bloom import BloomFilter
+from ..lib.state import pack_state, unpack_state
 from collections import defaultdict
 from ..lib.profiler import profile
+from ..lib.keys import bucket_keys, VisitorPartitions
+from ..lib.families import get_disabled
+from .kernel import MutationKernel
+
+
+_ID_SIZE = sys.getsizeof(chr(0) * 16)
+
+
+class MetadataCache(object):
+    """
+    Bounded write-through cache of visitor metadata.
+
+    Entries are the (total, path, property_ids) objects returned by
+    VisitorModel.get_metadata(). Ingests update them in place as they
+    record the visitor's counters, so they stay current for writes made
+    by this process.
+    Entries expire ttl seconds after they were read, which bounds how
+    long writes from other processes go unseen.
+    """
+
+    def __init__(self, size=10000, ttl=1800):
+        self.ttl = ttl
+        self.entries = lrucache(size)
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key):
+        """
+        Cached metadata or None.
+        """
+        if key in self.entries:
+            expires, metadata = self.entries[key]
+            if time.time() < expires:
+                self.hits += 1
+                return metadata
+            del self.entries[key]
+        self.misses += 1
+        return None
+
+    def set(self, key, metadata):
+        """
+        Cache metadata unless another read cached it first, and return
+        the cached metadata.
+        """
+        if key in self.entries:
+            expires, cached = self.entries[key]
+            if time.time() < expires:
+                return cached
+        self.entries[key] = (time.time() + self.ttl, metadata)
+        return metadata
+
+    def remove(self, key):
+        """
+        Drop a visitor's metadata.
+        """
+        if key in self.entries:
+            del self.entries[key]
+
+    def clear_bucket(self, user_name, bucket_name):
+        """
+        Drop the metadata of every visitor in a bucket.
+        """
+        for key in list(self.entries.keys()):
+            if key[0:2] == (user_name, bucket_name):
+                del self.entries[key]
+
+    def memory(self):
+        """
+        Approximate number of bytes held by cached metadata.
+        """
+        size = 0
+        for expires, (total, path, property_ids) in self.entries.values():
+            size += sys.getsizeof(total) + sys.getsizeof(path) + \
+                sys.getsizeof(property_ids)
+            size += sum([sys.getsizeof(x) for x in path.values()])
+            size += _ID_SIZE * (len(total) + len(path) + \
+                len(property_ids) + sum([len(x) for x in path.values()]))
+        return size
+
+
+class VisitorFilters(object):
+    """
+    Per-bucket Bloom filters of visitors that have stored metadata, kept
+    in files under path.
+
+    A filter is complete when it holds every such visitor: it was started
+    for a new or emptied bucket, or rebuilt by scanning the bucket's
+    visitor rows. Only complete filters are trusted to rule a visitor
+    out. A missing or incomplete filter is rebuilt in the background the
+    first time it is needed. Filters saved by a clean shutdown load as
+    complete; a loaded file is marked incomplete on disk until the next
+    save, so after a crash it is rebuilt.
+
+    Visitors are added as this process records them, so every process
+    writing to a bucket must share its filters, e.g. by routing each
+    bucket to a single process.
+    """
+
+    def __init__(self, path, capacity=1000000, error_rate=0.01):
+        self.path = path
+        self.capacity = capacity
+        self.error_rate = error_rate
+        self.filters = {}
+        self.complete = set()
+        self.rebuilding = set()
+        self.skipped = 0
+        if not os.path.isdir(path):
+            os.makedirs(path)
+
+    def _path(self, bucket):
+        """
+        File of a (user_name, bucket_name) filter.
+        """
+        return os.path.join(
+            self.path,
+            "%s.bloom" % pack_hash(bucket).encode("hex"))
+
+    def _filter(self, bucket):
+        """
+        Filter of a (user_name, bucket_name), loaded or started empty.
+        """
+        if bucket in self.filters:
+            return self.filters[bucket]
+        try:
+            with open(self._path(bucket), "r+b") as bloom_file:
+                data = bloom_file.read()
+                if data[0:1] == "1":
+                    self.complete.add(bucket)
+                    bloom_file.seek(0)
+                    bloom_file.write("0")
+            bloom_filter = BloomFilter.loads(data[1:])
+        except IOError:
+            bloom_filter = BloomFilter(self.capacity, self.error_rate)
+        self.filters[bucket] = bloom_filter
+        if bucket not in self.complete:
+            self.rebuild(*bucket)
+        return bloom_filter
+
+    def add(self, user_name, bucket_name, visitor_id):
+        """
+        Note that a visitor has metadata.
+        """
+        self._filter((user_name, bucket_name)).add(visitor_id)
+
+    def missing(self, user_name, bucket_name, visitor_id):
+        """
+        True if the visitor certainly has no metadata.
+        """
+        bucket = (user_name, bucket_name)
+        if visitor_id in self._filter(bucket) or bucket not in self.complete:
+            return False
+        self.skipped += 1
+        return True
+
+    def reset(self, user_name, bucket_name):
+        """
+        Start an empty, complete filter for a new or emptied bucket.
+        """
+        bucket = (user_name, bucket_name)
+        self.filters[bucket] = BloomFilter(self.capacity, self.error_rate)
+        self.complete.add(bucket)
+        self.rebuilding.discard(bucket)
+
+    @inlineCallbacks
+    def rebuild(self, user_name, bucket_name):
+        """
+        Add every visitor with stored events or properties to a bucket's
+        filter by scanning its visitor rows, then mark it complete.
+        """
+        bucket = (user_name, bucket_name)
+        if bucket in self.rebuilding:
+            return
+        self.rebuilding.add(bucket)
+        bloom_filter = self._filter(bucket)
+        keys = bucket_keys(user_name, bucket_name)
+        def consumer(columns):
+            for column in columns:
+                bloom_filter.add(column.counter_column.name[0:16])
+        def state_consumer(columns):
+            for column in columns:
+                bloom_filter.add(column.column.name)
+        try:
+            for kind in ("visitor_event", "visitor_property"):
+                for key in visitor_rows(keys, kind):
+                    yield scan(key, "counter", consumer)
+            for key in visitor_rows(keys, "visitor_state"):
+                yield scan(key, "relation", state_consumer)
+        except Exception:
+            log.err(None, "Could not rebuild visitor filter.")
+            self.rebuilding.discard(bucket)
+            return
+        # A reset() while scanning replaced the filter and already
+        # completed it.
+        if bucket in self.rebuilding and \
+                self.filters.get(bucket) is bloom_filter:
+            self.rebuilding.discard(bucket)
+            self.complete.add(bucket)
+
+    def save(self):
+        """
+        Write every filter to disk, marking complete ones as such.
+        """
+        for bucket, bloom_filter in self.filters.items():
+            if bucket in self.complete:
+                flag = "1"
+            else:
+                flag = "0"
+            with open(self._path(bucket), "wb") as bloom_file:
+                bloom_file.write(flag + bloom_filter.dumps())
+
+
+METADATA_CACHE = None
+VISITOR_FILTERS = None
+# Layout of visitor metadata: "counter" rows, "blob" visitor state columns,
+# or "migrating", which writes both and reads blobs falling back to rows.
+VISITOR_STATE = "counter"
+PARTITIONS = VisitorPartitions()
+# Scheme visitors are being moved from. Visitors with nothing under
+# PARTITIONS are read from it and copied over by their next ingest.
+PREVIOUS_PARTITIONS = None
+# Pending ingests of visitors with an ingest in progress, by cache key.
+INGESTS = {}
+INGEST_STATS = {"ingests": 0, "coalesced": 0}
+
+
+def reset_bucket_visitors(user_name, bucket_name):
+    """
+    Forget what is known about the visitors of a bucket that was created
+    or deleted.
+    """
+    if METADATA_CACHE is not None:
+        METADATA_CACHE.clear_bucket(user_name, bucket_name)
+    if VISITOR_FILTERS is not None:
+        VISITOR_FILTERS.reset(user_name, bucket_name)
+
+
+def visitor_rows(keys, kind):
+    """
+    Packed keys of every visitor row of kind in a bucket under PARTITIONS
+    and PREVIOUS_PARTITIONS.
+    """
+    rows = PARTITIONS.rows(keys, kind)
+    if PREVIOUS_PARTITIONS is not None:
+        current = set(rows)
+        rows.extend([x for x in PREVIOUS_PARTITIONS.rows(keys, kind)
+            if x not in current])
+    return rows
+
+
+def _empty_metadata():
+    """
+    Metadata of a visitor with no events or properties.
+    """
+    return (
+        defaultdict(lambda:0),
+        defaultdict(lambda:defaultdict(lambda:0)),
+        [])
+
+
+def _collapse(models):
+    """
+    Group runs of the same event or property value into [model, count]
+    pairs for MutationKernel.run().
+    """
+    result = []
+    for model in models:
+        if result and type(result[-1][0]) is type(model) and \
+                result[-1][0].id == model.id:
+            result[-1][1] += 1
+        else:
+            result.append([model, 1])
+    return result
 
 
 class VisitorModel(object):
@@ -17,24 +298,84 @@ class VisitorModel(object):
     Visitors are stored in buckets and can have properties and events.
     """
 
-    def __init__(self, user_name, bucket_name, visitor_id):
+    def __init__(self, user_name, bucket_name, visitor_id, fresh=False):
         self.user_name = user_name
         self.bucket_name = bucket_name
+        self.keys = bucket_keys(user_name, bucket_name)
         self.id = pack_hash((user_name, bucket_name, visitor_id))
-        self.shard = self.id[0]
+        self.cache_key = (user_name, bucket_name, self.id)
+        self.fresh = fresh
+        self.repartitioned = False
+
+    def row(self, kind, partitions=None):
+        """
+        Packed key of the visitor's row of kind under PARTITIONS or another
+        partition scheme.
+        """
+        return (partitions or PARTITIONS).row(self.keys, kind, self.id)
 
     @profile
     @inlineCallbacks
     def get_metadata(self):
         """
-        Returns a visitor's events, path, and properties.
+        Returns a visitor's events, path, and properties. With a
+        METADATA_CACHE the result is cached and shared with later calls.
+        Nothing is read for fresh visitors, whose IDs were just minted,
+        or for visitors that VISITOR_FILTERS rules out.
+        """
+        if METADATA_CACHE is not None:
+            metadata = METADATA_CACHE.get(self.cache_key)
+            if metadata is not None:
+                returnValue(metadata)
+        if self.fresh or (VISITOR_FILTERS is not None and \
+                VISITOR_FILTERS.missing(
+                    self.user_name,
+                    self.bucket_name,
+                    self.id)):
+            metadata = _empty_metadata()
+        else:
+            metadata = yield self._read_metadata()
+        if VISITOR_FILTERS is not None:
+            VISITOR_FILTERS.add(self.user_name, self.bucket_name, self.id)
+        if METADATA_CACHE is not None:
+            metadata = METADATA_CACHE.set(self.cache_key, metadata)
+        returnValue(metadata)
+
+    @inlineCallbacks
+    def _read_metadata(self):
+        """
+        Read a visitor's events, path, and properties. Visitors with
+        nothing under PARTITIONS are read from PREVIOUS_PARTITIONS and
+        marked as repartitioned.
+        """
+        metadata = yield self._read_layout(PARTITIONS)
+        if metadata is None and PREVIOUS_PARTITIONS is not None:
+            metadata = yield self._read_layout(PREVIOUS_PARTITIONS)
+            self.repartitioned = metadata is not None
+        returnValue(metadata or _empty_metadata())
+
+    @inlineCallbacks
+    def _read_layout(self, partitions):
+        """
+        Read a visitor's events, path, and properties from the rows of a
+        partition scheme in the VISITOR_STATE layout, or None if it has
+        none there.
         """
+        if VISITOR_STATE != "counter":
+            key = self.row("visitor_state", partitions)
+            data = yield get_relation(key, column_ids=[self.id])
+            if self.id in data:
+                returnValue(unpack_state(data[self.id]))
+            if VISITOR_STATE == "blob":
+                returnValue(None)
         keys = [
-            (self.user_name, self.bucket_name, "visitor_event", self.shard),
-            (self.user_name, self.bucket_name, "visitor_path", self.shard),
-            (self.user_name, self.bucket_name, "visitor_property", self.shard)]
+            self.row("visitor_event", partitions),
+            self.row("visitor_path", partitions),
+            self.row("visitor_property", partitions)]
         prefix = self.id
         events, paths, properties = yield get_counters(keys, prefix=prefix)
+        if not events and not properties:
+            returnValue(None)
         events_result = defaultdict(lambda:0)
         for column_id in events:
             event_id = column_id[0:16]
@@ -46,23 +387,96 @@ class VisitorModel(object):
             path_result[new_event_id][event_id] += paths[column_id]
         returnValue((events_result, path_result, properties.keys()))
 
-    @profile
-    def add_property(self, _property):
+    def ingest(self, models):
         """
-        Add property to visitor.
+        Add property values and events to the visitor, in order, and
+        commit. Returns a deferred that fires once
+        they are committed.
+
+        Ingests of one visitor are serialized in this process. Ingests
+        queued while the visitor's metadata is read or its previous ingest
+        commits are applied together against a single metadata read and
+        committed at once, so uniques are counted once. Runs of the same
+        event are added once with their count, and the mutations of the
+        whole batch are computed by a MutationKernel.
         """
-        key = (self.user_name, self.bucket_name, "visitor_property", self.shard)
-        column_id = "".join([self.id, _property.id])
-        increment_counter(key, column_id=column_id)
+        deferred = Deferred()
+        INGEST_STATS["ingests"] += 1
+        if self.cache_key in INGESTS:
+            INGEST_STATS["coalesced"] += 1
+            INGESTS[self.cache_key].append((models, deferred))
+        else:
+            INGESTS[self.cache_key] = [(models, deferred)]
+            self._drain()
+        return deferred
 
-    @profile
-    def increment_path(self, event_id, new_event_id):
+    @inlineCallbacks
+    def _drain(self):
         """
-        Increment the path of visitor events from event_id -> new_event_id.
+        Apply and commit queued ingests until none are left.
         """
-        key = (self.user_name, self.bucket_name, "visitor_path", self.shard)
-        column_id = "".join([self.id, new_event_id, event_id])
-        increment_counter(key, column_id=column_id)
+        metadata = None
+        while True:
+            queued = INGESTS[self.cache_key]
+            try:
+                if metadata is None:
+                    disabled = yield get_disabled(
+                        self.user_name,
+                        self.bucket_name)
+                    metadata = yield self.get_metadata()
+                total, path, property_ids = metadata
+                queued = INGESTS[self.cache_key]
+                INGESTS[self.cache_key] = []
+                models = _collapse([x for y in queued for x in y[0]])
+                kernel = MutationKernel(
+                    self,
+                    visitor_counters=VISITOR_STATE != "blob",
+                    disabled=disabled)
+                if self.repartitioned:
+                    kernel.copy_visitor(total, path, property_ids)
+                    self.repartitioned = False
+                relations, counters = kernel.run(
+                    models,
+                    total,
+                    path,
+                    property_ids)
+                for key, column_id, value in relations:
+                    insert_relation_once(key, column_id, value)
+                if VISITOR_STATE != "counter":
+                    BUFFER.insert_relation(
+                        self.row("visitor_state"),
+                        self.id,
+                        pack_state(total, path, property_ids))
+                for key, column_id, value in counters:
+                    BUFFER.increment_counter(key, column_id, value)
+                yield BUFFER.commit()
+            except Exception:
+                result = Failure()
+                metadata = None
+                self.forget_metadata()
+            else:
+                result = None
+            if queued is INGESTS[self.cache_key]:
+                INGESTS[self.cache_key] = []
+            # Settle the queue before waking the callers, which may ingest
+            # again.
+            done = not INGESTS[self.cache_key]
+            if done:
+                del INGESTS[self.cache_key]
+            for _, deferred in queued:
+                if result is None:
+                    deferred.callback(None)
+                else:
+                    deferred.errback(result)
+            if done:
+                break
+
+    def forget_metadata(self):
+        """
+        Drop cached metadata, e.g. after its changes failed to commit.
+        """
+        if METADATA_CACHE is not None:
+            METADATA_CACHE.remove(self.cache_key)
 
     @profile
     @inlineCallbacks
@@ -70,7 +484,7 @@ class VisitorModel(object):
         """
         Get the path of visitor events.
         """
-        key = (self.user_name, self.bucket_name, "visitor_path", self.shard)
+        key = self.row("visitor_path")
         prefix = self.id
         data = yield get_counter(key, prefix=prefix)
         result = defaultdict(lambda:defaultdict(lambda:0))
@@ -80,22 +494,13 @@ class VisitorModel(object):
             result[new_event_id][event_id] += data[column_id]
         returnValue(result)
 
-    @profile
-    def increment_total(self, event_id):
-        """
-        Increment the count of visitor events.
-        """
-        key = (self.user_name, self.bucket_name, "visitor_event", self.shard)
-        column_id = "".join([self.id, event_id])
-        increment_counter(key, column_id=column_id)
-
     @profile
     @inlineCallbacks
     def get_total(self):
         """
         Get the count of visitor events.
         """
-        key = (self.user_name, self.bucket_name, "visitor_event", self.shard)
+        key = self.row("visitor_event")
         prefix = self.id
         data = yield get_counter(key, prefix=prefix)
         result = defaultdict(lambda:0)
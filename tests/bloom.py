@@ -0,0 +1,25 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from twisted.trial import unittest
+from hiitrack.lib.bloom import BloomFilter
+from hiitrack.lib.hash import pack_hash
+
+
+class BloomFilterTestCase(unittest.TestCase):
+
+    def test_filter(self):
+        bloom_filter = BloomFilter(1000, 0.01)
+        keys = [pack_hash((str(i),)) for i in range(2000)]
+        for key in keys[0:1000]:
+            bloom_filter.add(key)
+        for key in keys[0:1000]:
+            self.assertTrue(key in bloom_filter)
+        false_positives = len([x for x in keys[1000:] if x in bloom_filter])
+        self.assertTrue(false_positives < 30)
+        loaded = BloomFilter.loads(bloom_filter.dumps())
+        self.assertEqual(loaded.size, bloom_filter.size)
+        self.assertEqual(loaded.hashes, bloom_filter.hashes)
+        self.assertEqual(
+            [x in loaded for x in keys],
+            [x in bloom_filter for x in keys])
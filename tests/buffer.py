@@ -0,0 +1,174 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+from twisted.trial import unittest
+from twisted.internet.defer import inlineCallbacks, fail
+from telephus.cassandra.c08.ttypes import TimedOutException, \
+    UnavailableException
+from hiitrack.lib import cassandra
+from hiitrack.lib.cassandra import Buffer, chunk_mutations
+from hiitrack.lib.memory import MemoryBackend
+
+
+class FailingBackend(MemoryBackend):
+    """
+    Fails the first failures batch calls with exception, without applying
+    them.
+    """
+
+    def __init__(self, exception, failures):
+        MemoryBackend.__init__(self)
+        self.exception = exception
+        self.failures = failures
+        self.times = []
+
+    def _fail(self, method, *args):
+        self.times.append(time.time())
+        if self.failures:
+            self.failures -= 1
+            self.calls[method] += 1
+            return fail(self.exception())
+        return getattr(MemoryBackend, method)(self, *args)
+
+    def batch_multikey_add(self, column_family, mapping, consistency=None):
+        return self._fail("batch_multikey_add", column_family, mapping)
+
+    def batch_multikey_insert(self, column_family, mapping, consistency=None):
+        return self._fail("batch_multikey_insert", column_family, mapping)
+
+
+class BufferTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = cassandra.CLIENT
+        self.interval = cassandra.CHUNK_RETRY_INTERVAL
+        cassandra.CLIENT = MemoryBackend()
+        cassandra.CHUNK_RETRY_INTERVAL = 0.01
+
+    def tearDown(self):
+        cassandra.CLIENT = self.client
+        cassandra.CHUNK_RETRY_INTERVAL = self.interval
+
+    def stored(self, key):
+        return dict(cassandra.CLIENT.data["counter"][key].values)
+
+    @inlineCallbacks
+    def test_commit(self):
+        buffer = Buffer()
+        buffer.increment_counter("row", "a", 1)
+        yield buffer.commit()
+        self.assertEqual(self.stored("row"), {"a": 1})
+        self.assertEqual(buffer.size, 0)
+        self.assertEqual(buffer.delayed_flush, None)
+
+    @inlineCallbacks
+    def test_group_commit(self):
+        buffer = Buffer(commit_interval=0.01)
+        buffer.increment_counter("row", "a", 1)
+        first = buffer.commit()
+        buffer.increment_counter("row", "a", 2)
+        buffer.increment_counter("row", "b", 1)
+        second = buffer.commit()
+        self.assertFalse(first.called)
+        self.assertEqual(cassandra.CLIENT.calls["batch_multikey_add"], 0)
+        yield second
+        self.assertTrue(first.called)
+        # Increments of the same column are summed into one add.
+        self.assertEqual(cassandra.CLIENT.calls["batch_multikey_add"], 1)
+        self.assertEqual(self.stored("row"), {"a": 3, "b": 1})
+        self.assertEqual(buffer.delayed_flush, None)
+        self.assertEqual(buffer.flushing, [])
+
+    @inlineCallbacks
+    def test_commit_size(self):
+        buffer = Buffer(commit_interval=60, commit_size=2)
+        buffer.increment_counter("row", "a", 1)
+        first = buffer.commit()
+        self.assertNotEqual(buffer.delayed_flush, None)
+        buffer.increment_counter("row", "a", 1)
+        buffer.increment_counter("row", "b", 1)
+        second = buffer.commit()
+        # Two buffered columns flush at once, cancelling the delayed flush.
+        self.assertEqual(buffer.delayed_flush, None)
+        yield second
+        self.assertTrue(first.called)
+        self.assertEqual(self.stored("row"), {"a": 2, "b": 1})
+
+    @inlineCallbacks
+    def test_stop(self):
+        cassandra.CLIENT.latency = 0.01
+        buffer = Buffer(commit_interval=60)
+        buffer.increment_counter("row", "a", 1)
+        committed = buffer.commit()
+        buffer.increment_counter("row", "b", 1)
+        yield buffer.stop()
+        # The pending flush is sent and completes before stop() fires.
+        self.assertTrue(committed.called)
+        self.assertEqual(self.stored("row"), {"a": 1, "b": 1})
+        self.assertEqual(buffer.flushing, [])
+        yield buffer.stop()
+
+    @inlineCallbacks
+    def test_retry_client(self):
+        replica = FailingBackend(UnavailableException, 2)
+        buffer = Buffer(retries=2)
+        yield buffer._send_chunk(
+            "batch_multikey_add",
+            "counter",
+            {"row": {"a": 1}},
+            buffer.retries,
+            replica)
+        # Every attempt goes to the replica, none to the pool.
+        self.assertEqual(replica.calls["batch_multikey_add"], 3)
+        self.assertEqual(replica.data["counter"]["row"].values, {"a": 1})
+        self.assertEqual(cassandra.CLIENT.calls["batch_multikey_add"], 0)
+
+    def test_chunk_mutations(self):
+        mutations = {"a": {"1": 1, "2": 1, "3": 1}, "b": {"1": 1}}
+        self.assertEqual(chunk_mutations(mutations), [mutations])
+        chunks = chunk_mutations(mutations, max_mutations=3)
+        self.assertEqual([sum([len(x) for x in y.values()]) for y in chunks],
+            [3, 1])
+        merged = {}
+        for chunk in chunk_mutations(mutations, max_mutations=1):
+            for key, columns in chunk.items():
+                merged.setdefault(key, {}).update(columns)
+        self.assertEqual(merged, mutations)
+        # Each counter column is the key, name and 8 bytes.
+        chunks = chunk_mutations(mutations, max_bytes=20)
+        self.assertEqual(len(chunks), 2)
+        chunks = chunk_mutations({"a": {"1": "x" * 100}}, max_bytes=20)
+        self.assertEqual(len(chunks), 1)
+
+    @inlineCallbacks
+    def test_chunk_retry(self):
+        cassandra.CLIENT = FailingBackend(TimedOutException, 3)
+        buffer = Buffer(max_mutations=1, retries=2)
+        buffer.insert_relation("row", "a", "1")
+        buffer.insert_relation("row", "b", "2")
+        yield buffer.flush_relation()
+        # Both chunks fail and are retried, then only the one that failed
+        # again is sent a third time, after a longer delay.
+        calls = cassandra.CLIENT.calls["batch_multikey_insert"]
+        self.assertEqual(calls, 5)
+        self.assertEqual(
+            cassandra.CLIENT.data["relation"]["row"].values,
+            {"a": "1", "b": "2"})
+        times = cassandra.CLIENT.times
+        self.assertTrue(times[2] - times[0] >= 0.01)
+        self.assertTrue(times[4] - times[2] >= 0.02)
+
+    @inlineCallbacks
+    def test_counter_retry(self):
+        # A timed out add may have landed, so it is not sent again.
+        cassandra.CLIENT = FailingBackend(TimedOutException, 1)
+        buffer = Buffer(retries=2)
+        buffer.increment_counter("row", "a", 1)
+        yield self.assertFailure(buffer.flush_counter(), TimedOutException)
+        self.assertEqual(cassandra.CLIENT.calls["batch_multikey_add"], 1)
+        cassandra.CLIENT = FailingBackend(UnavailableException, 1)
+        buffer.increment_counter("row", "a", 1)
+        yield buffer.flush_counter()
+        self.assertEqual(cassandra.CLIENT.calls["batch_multikey_add"], 2)
+        self.assertEqual(self.stored("row"), {"a": 1})
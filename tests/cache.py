@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from twisted.trial import unittest
+from twisted.internet.defer import inlineCallbacks, Deferred, succeed
+from hiitrack.lib import cassandra
+from hiitrack.lib.cache import SliceCache
+from hiitrack.lib.memory import MemoryBackend
+
+
+class SliceCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = cassandra.CLIENT
+        self.cache = cassandra.CACHE
+        cassandra.CLIENT = MemoryBackend()
+        cassandra.CACHE = SliceCache(size=10, ttl=60, stale=60)
+
+    def tearDown(self):
+        cassandra.CLIENT = self.client
+        cassandra.CACHE = self.cache
+
+    @inlineCallbacks
+    def test_patch(self):
+        cassandra.BUFFER.increment_counter("row", "ab", 1)
+        cassandra.BUFFER.increment_counter("row", "b", 1)
+        yield cassandra.BUFFER.flush_counter()
+        data = yield cassandra.get_counter("row", prefix="a", cached=True)
+        self.assertEqual(dict(data), {"b": 1})
+        cassandra.BUFFER.increment_counter("row", "ab", 2)
+        cassandra.BUFFER.increment_counter("row", "aa", 1)
+        cassandra.BUFFER.increment_counter("row", "c", 1)
+        yield cassandra.BUFFER.flush_counter()
+        names, values = yield cassandra.get_counter_arrays(
+            "row",
+            prefix="a",
+            cached=True)
+        self.assertEqual((names, values), (["a", "b"], [1, 3]))
+        self.assertEqual(cassandra.CACHE.hits, 1)
+        self.assertEqual(cassandra.CACHE.misses, 1)
+        self.assertEqual(cassandra.CLIENT.calls["slice"], 1)
+        yield cassandra.delete_counter("row")
+        data = yield cassandra.get_counter("row", prefix="a", cached=True)
+        self.assertEqual(dict(data), {})
+        self.assertEqual(cassandra.CACHE.misses, 2)
+
+    @inlineCallbacks
+    def test_stale(self):
+        cache = SliceCache(size=10, ttl=0, stale=60)
+        loads = []
+        def load():
+            loads.append(Deferred())
+            return loads[-1]
+        first = cache.get(("row", "", "", ""), load)
+        loads[0].callback((["a"], [1]))
+        result = yield first
+        self.assertEqual(result, (["a"], [1]))
+        result = yield cache.get(("row", "", "", ""), load)
+        self.assertEqual(result, (["a"], [1]))
+        result = yield cache.get(("row", "", "", ""), load)
+        self.assertEqual(len(loads), 2)
+        self.assertEqual(cache.stale_hits, 2)
+        loads[1].callback((["a"], [2]))
+        result = yield cache.get(("row", "", "", ""), load)
+        self.assertEqual(result, (["a"], [2]))
+
+    @inlineCallbacks
+    def test_flush_overlap(self):
+        cache = SliceCache(size=10, ttl=60, stale=0)
+        load = Deferred()
+        reading = cache.get(("row", "", "", ""), lambda:load)
+        cache.begin({"row": {"a": 1}})
+        load.callback((["a"], [1]))
+        yield reading
+        cache.end(None, {"row": {"a": 1}})
+        self.assertEqual(len(cache.entries), 0)
+        yield cache.get(("row", "", "", ""), lambda:succeed((["a"], [1])))
+        cache.begin({"row": {"a": 1}})
+        cache.end(None, {"row": {"a": 1}})
+        result = yield cache.get(("row", "", "", ""), None)
+        self.assertEqual(result, (["a"], [2]))
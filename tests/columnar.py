@@ -0,0 +1,37 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from twisted.trial import unittest
+from hiitrack.lib import columnar
+from random import Random
+import struct
+
+
+class ColumnarTestCase(unittest.TestCase):
+
+    def make_columns(self, id_width):
+        random = Random(id_width)
+        ids = ["".join([chr(random.randint(0, 255)) for i in range(0, id_width)])
+            for j in range(0, 20)]
+        columns = {}
+        for i in range(0, 1000):
+            timestamp = struct.pack(">1i", random.randint(0, 2 ** 31 - 1))
+            columns[timestamp + random.choice(ids)] = random.randint(1, 100)
+        names = sorted(columns)
+        return names, [columns[x] for x in names]
+
+    def test_decode_timed(self):
+        for id_width in [16, 32]:
+            names, values = self.make_columns(id_width)
+            expected = columnar._decode_timed(names, values)
+            self.assertEqual(len(expected), 20)
+            self.assertEqual(sum([len(x[1]) for x in expected]), 1000)
+            for _id, timestamps, counts in expected:
+                self.assertEqual(timestamps, sorted(timestamps))
+            if columnar.numpy is not None:
+                self.assertEqual(
+                    columnar.decode_timed(names, values),
+                    expected)
+
+    def test_empty(self):
+        self.assertEqual(columnar.decode_timed([], []), [])
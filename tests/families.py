@@ -0,0 +1,162 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+from collections import defaultdict
+from twisted.trial import unittest
+from twisted.internet.defer import inlineCallbacks, returnValue
+from hiitrack.lib import cassandra
+from hiitrack.lib.cassandra import Buffer
+from hiitrack.lib.families import parse_families, get_disabled, \
+    DISABLED_CACHE
+from hiitrack.lib.keys import bucket_keys
+from hiitrack.lib.memory import MemoryBackend
+from hiitrack.models import visitor, BucketModel, VisitorModel, EventModel, \
+    PropertyModel, PropertyValueModel
+from hiitrack.models.kernel import MutationKernel
+from hiitrack.models.visitor import _collapse, _empty_metadata
+
+
+class CounterFamiliesTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = cassandra.CLIENT
+        self.settings = (
+            cassandra.BUFFER,
+            cassandra.CACHE,
+            cassandra.PERIODS,
+            cassandra.KNOWN,
+            visitor.METADATA_CACHE,
+            visitor.VISITOR_FILTERS)
+        cassandra.CLIENT = MemoryBackend()
+        cassandra.BUFFER = Buffer()
+        cassandra.CACHE = None
+        cassandra.PERIODS = None
+        cassandra.KNOWN = None
+        visitor.METADATA_CACHE = None
+        visitor.VISITOR_FILTERS = None
+        DISABLED_CACHE.clear()
+
+    def tearDown(self):
+        cassandra.CLIENT = self.client
+        cassandra.BUFFER, cassandra.CACHE, cassandra.PERIODS, \
+            cassandra.KNOWN, visitor.METADATA_CACHE, \
+            visitor.VISITOR_FILTERS = self.settings
+        DISABLED_CACHE.clear()
+
+    @inlineCallbacks
+    def ingest(self, bucket_name):
+        for visitor_id, names in (("a", "xyx"), ("b", "yxxz"), ("c", "x")):
+            models = [EventModel("user", bucket_name, "z")]
+            models.append(PropertyValueModel(
+                "user",
+                bucket_name,
+                "p",
+                visitor_id))
+            models.extend([EventModel("user", bucket_name, x) for x in names])
+            yield VisitorModel("user", bucket_name, visitor_id).ingest(models)
+
+    @inlineCallbacks
+    def counters(self, bucket_name):
+        """
+        Every counter read of the bucket's events, by family.
+        """
+        now = time.time()
+        result = defaultdict(dict)
+        for name in "xyz":
+            event = EventModel("user", bucket_name, name)
+            for _property in (None, PropertyModel("user", bucket_name, "p")):
+                prefix = "property_" if _property else ""
+                for i, (family, method) in enumerate((
+                        ("event", event.get_total),
+                        ("event", event.get_unique_total),
+                        ("path", event.get_path),
+                        ("path", event.get_unique_path))):
+                    data = yield method(_property)
+                    if _property is None:
+                        data = data[event.id]
+                    result[prefix + family][(name, i)] = _plain(data)
+            for interval in ("hour", "day"):
+                timed = "hourly_" if interval == "hour" else "daily_"
+                for i, (family, method) in enumerate((
+                        ("event", event.get_timed_total),
+                        ("event", event.get_timed_unique_total),
+                        ("path", event.get_timed_path),
+                        ("path", event.get_timed_unique_path))):
+                    data = yield method(now - 86400, now, interval)
+                    result[timed + family][(name, i)] = \
+                        _plain(data[event.id])
+        returnValue(result)
+
+    def test_parse(self):
+        self.assertEqual(parse_families(""), ())
+        self.assertEqual(
+            parse_families("path, daily_event,path"),
+            ("daily_event", "path"))
+        self.assertRaises(ValueError, parse_families, "weekly_event")
+
+    @inlineCallbacks
+    def test_disabled(self):
+        disabled = ("daily_event", "hourly_path", "path", "property_event")
+        yield BucketModel("user", "full").create("full")
+        yield BucketModel("user", "light").create("light", disabled)
+        DISABLED_CACHE.clear()
+        result = yield BucketModel("user", "light").get_disabled()
+        self.assertEqual(result, frozenset(disabled))
+        result = yield get_disabled("user", "full")
+        self.assertEqual(result, frozenset())
+        yield self.ingest("full")
+        yield self.ingest("light")
+        expected = yield self.counters("full")
+        result = yield self.counters("light")
+        # Paths with a property are read from the path rows.
+        unavailable = disabled + ("property_path",)
+        for family in expected:
+            if family in unavailable:
+                self.assertFalse(any(result[family].values()), family)
+            else:
+                self.assertTrue(any(expected[family].values()), family)
+                self.assertEqual(result[family], expected[family], family)
+        yield BucketModel("user", "light").delete()
+        self.assertFalse(("user", "light") in DISABLED_CACHE)
+
+    def test_kernel(self):
+        keys = bucket_keys("user", "bucket")
+        _visitor = VisitorModel("user", "bucket", "visitor")
+        models = [PropertyValueModel("user", "bucket", "p", 1)]
+        models.extend([EventModel("user", "bucket", x) for x in "abacdb"])
+        models = _collapse(models)
+        def counters(disabled):
+            relations, counters = MutationKernel(
+                _visitor,
+                disabled=disabled).run(models, *_empty_metadata())
+            return set([(x[0], x[1]) for x in counters])
+        def rows(*kinds):
+            return set([keys.counter(x, chr(i))
+                for x in kinds for i in range(256)])
+        full = counters(())
+        for family, kinds in (
+                ("hourly_event", ("hourly_event", "hourly_unique_event")),
+                ("daily_event", ("daily_event", "daily_unique_event")),
+                ("path", ("path", "unique_path")),
+                ("hourly_path", ("hourly_path", "hourly_unique_path")),
+                ("daily_path", ("daily_path", "daily_unique_path"))):
+            left_out = rows(*kinds)
+            self.assertEqual(
+                counters((family,)),
+                set([x for x in full if x[0] not in left_out]))
+        # Property families leave out columns of the rows they share.
+        for family in ("property_event", "property_path"):
+            result = counters((family,))
+            self.assertTrue(result < full)
+        property_rows = rows("property")
+        self.assertFalse([x for x in counters(("property_event",))
+            if x[0] in property_rows])
+
+def _plain(data):
+    """
+    Nested defaultdicts of counters as dicts.
+    """
+    if isinstance(data, dict):
+        return dict([(x, _plain(y)) for x, y in data.items()])
+    return data
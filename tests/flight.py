@@ -0,0 +1,66 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from twisted.trial import unittest
+from twisted.internet.defer import inlineCallbacks, DeferredList
+from telephus.cassandra.c08.ttypes import TimedOutException
+from hiitrack.lib import cassandra
+from hiitrack.lib.memory import MemoryBackend
+
+
+class SingleFlightTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = cassandra.CLIENT
+        self.flights = cassandra.FLIGHTS
+        cassandra.CLIENT = MemoryBackend(latency=0.01)
+        cassandra.FLIGHTS = cassandra.SingleFlight()
+
+    def tearDown(self):
+        cassandra.CLIENT = self.client
+        cassandra.FLIGHTS = self.flights
+
+    @inlineCallbacks
+    def test_collapse(self):
+        yield cassandra.CLIENT.batch_multikey_add(
+            "counter",
+            {"row": {"ab": 1, "ac": 2, "b": 3}})
+        results = yield DeferredList([
+            cassandra.get_counter("row", prefix="a"),
+            cassandra.get_counter("row", prefix="a"),
+            cassandra.get_counter("row", prefix="b")])
+        self.assertEqual(dict(results[0][1]), {"b": 1, "c": 2})
+        self.assertEqual(dict(results[1][1]), {"b": 1, "c": 2})
+        self.assertEqual(dict(results[2][1]), {"": 3})
+        self.assertEqual(cassandra.CLIENT.calls["slice"], 2)
+        self.assertEqual(cassandra.FLIGHTS.reads, 3)
+        self.assertEqual(cassandra.FLIGHTS.collapsed, 1)
+        self.assertEqual(cassandra.FLIGHTS.flights, {})
+
+    @inlineCallbacks
+    def test_write(self):
+        cassandra.CLIENT.latency = 0
+        yield cassandra.CLIENT.batch_multikey_insert(
+            "relation",
+            {"row": {"a": "1"}})
+        cassandra.CLIENT.latency = 0.01
+        first = cassandra.get_relation("row")
+        cassandra.CLIENT.latency = 0
+        yield cassandra.delete_relation("row", column_id="a")
+        second = yield cassandra.get_relation("row")
+        yield first
+        self.assertEqual(dict(second), {})
+        self.assertEqual(cassandra.FLIGHTS.collapsed, 0)
+
+    @inlineCallbacks
+    def test_failure(self):
+        cassandra.CLIENT.failure_rate = 1
+        results = yield DeferredList([
+            cassandra.get_relation("row", column_id="a"),
+            cassandra.get_relation("row", column_id="a")],
+            consumeErrors=True)
+        for success, result in results:
+            self.assertFalse(success)
+            self.assertTrue(result.check(TimedOutException))
+        self.assertEqual(cassandra.FLIGHTS.collapsed, 1)
+        self.assertEqual(cassandra.FLIGHTS.flights, {})
@@ -0,0 +1,114 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from twisted.trial import unittest
+from twisted.internet.defer import inlineCallbacks, returnValue
+from hiitrack.lib import cassandra
+from hiitrack.lib.cassandra import get_relation
+from hiitrack.lib.hot import HotEvents, hot_event_rows
+from hiitrack.lib.keys import bucket_keys
+from hiitrack.lib.memory import MemoryBackend
+from hiitrack.models import event as event_model
+from hiitrack.models import visitor, VisitorModel, EventModel, \
+    PropertyModel, PropertyValueModel, BucketModel
+
+
+class HotEventsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = cassandra.CLIENT
+        self.settings = (
+            cassandra.CACHE,
+            cassandra.KNOWN,
+            event_model.HOT_EVENTS,
+            visitor.METADATA_CACHE,
+            visitor.VISITOR_FILTERS)
+        cassandra.CLIENT = MemoryBackend()
+        cassandra.CACHE = None
+        cassandra.KNOWN = None
+        event_model.HOT_EVENTS = None
+        visitor.METADATA_CACHE = None
+        visitor.VISITOR_FILTERS = None
+
+    def tearDown(self):
+        cassandra.CLIENT = self.client
+        cassandra.CACHE, cassandra.KNOWN, event_model.HOT_EVENTS, \
+            visitor.METADATA_CACHE, visitor.VISITOR_FILTERS = self.settings
+
+    @inlineCallbacks
+    def ingest(self, bucket_name):
+        for visitor_id, names in (("a", "xyx"), ("b", "yxxz"), ("c", "x")):
+            models = [PropertyValueModel(
+                "user",
+                bucket_name,
+                "p",
+                visitor_id)]
+            models.extend([EventModel("user", bucket_name, x) for x in names])
+            yield VisitorModel("user", bucket_name, visitor_id).ingest(models)
+        yield PropertyValueModel("user", bucket_name, "q", 1).add(
+            VisitorModel("user", bucket_name, "b"))
+
+    @inlineCallbacks
+    def counters(self, bucket_name):
+        result = {}
+        for name in "xyz":
+            event = EventModel("user", bucket_name, name)
+            for _property in (None, PropertyModel("user", bucket_name, "q")):
+                for i, method in enumerate((
+                        event.get_total,
+                        event.get_unique_total,
+                        event.get_path,
+                        event.get_unique_path)):
+                    data = yield method(_property)
+                    result[(name, _property is None, i)] = \
+                        dict([(x, dict(y) if isinstance(y, dict) else y)
+                            for x, y in data.items()])
+            properties = yield event.get_properties()
+            result[(name, "properties")] = properties
+        returnValue(result)
+
+    @inlineCallbacks
+    def test_hot(self):
+        yield self.ingest("cold")
+        expected = yield self.counters("cold")
+        event_model.HOT_EVENTS = HotEvents(0, subrows=4, window=0, ttl=0)
+        yield self.ingest("hot")
+        # A process that has not seen the adds reads the registry.
+        event_model.HOT_EVENTS = HotEvents(0, subrows=4, window=0, ttl=0)
+        result = yield self.counters("hot")
+        self.assertEqual(result, expected)
+        keys = bucket_keys("user", "hot")
+        event = EventModel("user", "hot", "x")
+        data = cassandra.CLIENT.data["counter"].get(
+            keys.counter("event", event.shard), {})
+        self.assertFalse([x for x in data if x.startswith(event.id)])
+        self.assertTrue(any([cassandra.CLIENT.data["counter"].get(x)
+            for x in hot_event_rows(keys, "event", event.id, 4)]))
+        self.assertEqual(
+            expected[("x", True, 0)][event.id],
+            5)
+        hot_events = yield BucketModel("user", "hot").get_hot_events()
+        self.assertEqual(hot_events["x"], {"id":event.id, "subrows":4})
+
+    @inlineCallbacks
+    def test_wait(self):
+        keys = bucket_keys("user", "bucket")
+        event = EventModel("user", "bucket", "x")
+        shard_row = keys.counter("event", event.shard)
+        salted = set(hot_event_rows(keys, "event", event.id, 4))
+        hot_events = HotEvents(0, subrows=4, window=0, ttl=60)
+        hot_events.record(keys, event.id)
+        yield cassandra.BUFFER.commit()
+        registered = yield get_relation(keys.relation("hot_event"))
+        self.assertEqual(registered.keys(), [event.id])
+        # Readers that loaded the registry just before it was stored may
+        # not read the sub-rows for another ttl seconds.
+        self.assertEqual(hot_events.row(keys, "event", event.id), shard_row)
+        hot_events.since[("user", "bucket")][event.id] -= 60
+        self.assertTrue(hot_events.row(keys, "event", event.id) in salted)
+        # So may the readers of an event another process registered.
+        loaded = HotEvents(0, subrows=4, window=0, ttl=60)
+        yield loaded.load(keys)
+        self.assertEqual(loaded.row(keys, "event", event.id), shard_row)
+        loaded.since[("user", "bucket")][event.id] -= 60
+        self.assertTrue(loaded.row(keys, "event", event.id) in salted)
@@ -0,0 +1,141 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import struct
+from collections import defaultdict
+from twisted.trial import unittest
+from hiitrack.models import VisitorModel, EventModel, PropertyValueModel
+from hiitrack.models.kernel import MutationKernel
+from hiitrack.models.visitor import _collapse, _empty_metadata
+
+
+_NOW = 1330000000
+_HOUR = struct.pack(">1i", _NOW - _NOW % (60*60))
+_DAY = struct.pack(">1i", _NOW - _NOW % (60*60*24))
+_FILLER = chr(0) * 32
+
+
+class MutationKernelTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.visitor = VisitorModel("user", "bucket", "visitor")
+        self.keys = self.visitor.keys
+        self.a = EventModel("user", "bucket", "a")
+        self.b = EventModel("user", "bucket", "b")
+        self.p = PropertyValueModel("user", "bucket", "p", 1)
+        self.q = PropertyValueModel("user", "bucket", "q", 1)
+        self.expected = defaultdict(lambda:defaultdict(lambda:0))
+
+    def run_kernel(self, metadata, models):
+        """
+        Counters of a kernel run at _NOW, summed like the buffer sums them.
+        """
+        relations, counters = MutationKernel(self.visitor, _NOW).run(
+            _collapse(models),
+            *metadata)
+        result = defaultdict(lambda:defaultdict(lambda:0))
+        for key, column_id, value in counters:
+            result[key][column_id] += value
+        return relations, _plain(result)
+
+    def event(self, kind, event, value, property_id=None, suffix="",
+            timed=True):
+        """
+        Expect an event counter of kind and, if timed, its hourly and daily
+        columns.
+        """
+        property_id = property_id or _FILLER
+        columns = [(kind, event.id + property_id)]
+        if timed:
+            for prefix, timestamp in (("hourly_", _HOUR), ("daily_", _DAY)):
+                columns.append((prefix + kind, "".join([
+                    event.id,
+                    property_id[0:16],
+                    timestamp,
+                    property_id[16:32]])))
+        for row_kind, column_id in columns:
+            key = self.keys.counter(row_kind, event.id[0])
+            self.expected[key][column_id + suffix] += value
+
+    def visitor_counter(self, kind, column_id, value):
+        """
+        Expect a counter of the visitor's own rows.
+        """
+        key = self.visitor.row(kind)
+        self.expected[key][self.visitor.id + column_id] += value
+
+    def test_counters(self):
+        metadata = _empty_metadata()
+        relations, counters = self.run_kernel(
+            metadata,
+            [self.p, self.a, self.a, self.b])
+        a, b, p = self.a, self.b, self.p
+        for property_id in (None, p.id):
+            # a twice, repeating itself, then b after it.
+            self.event("event", a, 2, property_id)
+            self.event("unique_event", a, 1, property_id)
+            self.event("path", a, 1, property_id, a.id)
+            self.event("unique_path", a, 1, property_id, a.id)
+            self.event("event", b, 1, property_id)
+            self.event("unique_event", b, 1, property_id)
+            self.event("path", b, 1, property_id, a.id)
+            self.event("unique_path", b, 1, property_id, a.id)
+        for event in (a, b):
+            key = self.keys.counter("property", p.id[0])
+            self.expected[key][p.id + event.id] += 1
+        self.visitor_counter("visitor_event", a.id, 2)
+        self.visitor_counter("visitor_event", b.id, 1)
+        self.visitor_counter("visitor_path", a.id + a.id, 1)
+        self.visitor_counter("visitor_path", b.id + a.id, 1)
+        self.visitor_counter("visitor_property", p.id, 1)
+        self.assertEqual(counters, _plain(self.expected))
+        total, path, property_ids = metadata
+        self.assertEqual(dict(total), {a.id: 2, b.id: 1})
+        self.assertEqual(_plain(path), {a.id: {a.id: 1}, b.id: {a.id: 1}})
+        self.assertEqual(property_ids, [p.id])
+        names = dict([((x[0], x[1]), x[2]) for x in relations])
+        self.assertEqual(names[(self.keys.relation("event"), a.id)], "a")
+        self.assertEqual(names[(self.keys.relation("event"), b.id)], "b")
+        for key, column_id, value in p.relations():
+            self.assertEqual(names[(key, column_id)], value)
+        # A second a follows b for the first time, and a new property
+        # value takes the visitor's earlier totals and paths once.
+        self.expected.clear()
+        relations, counters = self.run_kernel(metadata, [a, self.q, self.q])
+        q = self.q
+        self.event("event", a, 1)
+        self.event("event", a, 1, p.id)
+        self.event("path", a, 1, None, a.id)
+        self.event("path", a, 1, p.id, a.id)
+        self.event("path", a, 1, None, b.id)
+        self.event("path", a, 1, p.id, b.id)
+        self.event("unique_path", a, 1, None, b.id)
+        self.event("unique_path", a, 1, p.id, b.id)
+        self.visitor_counter("visitor_event", a.id, 1)
+        self.visitor_counter("visitor_path", a.id + a.id, 1)
+        self.visitor_counter("visitor_path", a.id + b.id, 1)
+        self.event("event", a, 3, q.id, timed=False)
+        self.event("unique_event", a, 1, q.id, timed=False)
+        self.event("event", b, 1, q.id, timed=False)
+        self.event("unique_event", b, 1, q.id, timed=False)
+        self.event("path", a, 2, q.id, a.id, timed=False)
+        self.event("unique_path", a, 1, q.id, a.id, timed=False)
+        self.event("path", a, 1, q.id, b.id, timed=False)
+        self.event("unique_path", a, 1, q.id, b.id, timed=False)
+        self.event("path", b, 1, q.id, a.id, timed=False)
+        self.event("unique_path", b, 1, q.id, a.id, timed=False)
+        for event in (a, b):
+            key = self.keys.counter("property", q.id[0])
+            self.expected[key][q.id + event.id] += 1
+        self.visitor_counter("visitor_property", q.id, 1)
+        self.assertEqual(counters, _plain(self.expected))
+        self.assertEqual(property_ids, [p.id, q.id])
+
+
+def _plain(data):
+    """
+    Nested defaultdicts of counters as dicts.
+    """
+    if isinstance(data, dict):
+        return dict([(x, _plain(y)) for x, y in data.items()])
+    return data
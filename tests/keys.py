@@ -0,0 +1,26 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from twisted.trial import unittest
+from hiitrack.lib.keys import bucket_keys, COUNTER_KINDS, SHARDS
+from hiitrack.lib.hash import pack_hash
+
+
+class BucketKeysTestCase(unittest.TestCase):
+
+    def test_counter(self):
+        keys = bucket_keys("user", "bucket")
+        self.assertTrue(bucket_keys("user", "bucket") is keys)
+        for kind in COUNTER_KINDS:
+            for shard in [chr(0), chr(17), chr(255)]:
+                self.assertEqual(
+                    keys.counter(kind, shard),
+                    pack_hash(("user", "bucket", kind, shard)))
+        self.assertEqual(len(set(keys.counters())),
+            len(COUNTER_KINDS) * SHARDS)
+
+    def test_relation(self):
+        keys = bucket_keys("user", "bucket")
+        self.assertEqual(
+            keys.relation("event"),
+            pack_hash(("user", "bucket", "event")))
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from twisted.trial import unittest
+from twisted.internet.defer import inlineCallbacks
+from hiitrack.lib import cassandra
+from hiitrack.lib.bloom import BloomFilter
+from hiitrack.lib.known import KnownColumns
+from hiitrack.lib.memory import MemoryBackend
+from hiitrack.models import visitor, VisitorModel, EventModel, \
+    PropertyValueModel
+
+
+class KnownColumnsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = cassandra.CLIENT
+        self.known = cassandra.KNOWN
+        self.cache = visitor.METADATA_CACHE
+        cassandra.CLIENT = MemoryBackend()
+        cassandra.KNOWN = KnownColumns(size=2, capacity=100)
+        visitor.METADATA_CACHE = None
+
+    def tearDown(self):
+        cassandra.CLIENT = self.client
+        cassandra.KNOWN = self.known
+        visitor.METADATA_CACHE = self.cache
+
+    def test_known(self):
+        known = cassandra.KNOWN
+        known.add({"row": {"a": 1, "b": 1}})
+        self.assertTrue(known.known("row", "a"))
+        self.assertFalse(known.known("row", "c"))
+        self.assertFalse(known.known("other", "a"))
+        known.add({"row": {"c": 1}})
+        self.assertTrue(isinstance(known.rows["row"][1], BloomFilter))
+        for column_id in ("a", "b", "c"):
+            self.assertTrue(known.known("row", column_id))
+        self.assertEqual(known.avoided, 4)
+        known.forget(["row"])
+        self.assertFalse(known.known("row", "a"))
+
+    def test_bounds(self):
+        known = KnownColumns(rows=2, ttl=60)
+        for key in ("a", "b", "c"):
+            known.add({key: {"column": 1}})
+        # The least recently used row is dropped.
+        self.assertFalse(known.known("a", "column"))
+        self.assertTrue(known.known("c", "column"))
+        # Rows expire ttl seconds after they were first noted.
+        known.rows["c"][0] -= 60
+        self.assertFalse(known.known("c", "column"))
+        self.assertFalse("c" in known.rows)
+
+    @inlineCallbacks
+    def test_ingest(self):
+        _visitor = VisitorModel("user", "bucket", "visitor")
+        event = EventModel("user", "bucket", "a")
+        yield _visitor.ingest([
+            PropertyValueModel("user", "bucket", "p", "x"),
+            event])
+        calls = cassandra.CLIENT.calls["batch_multikey_insert"]
+        yield _visitor.ingest([
+            PropertyValueModel("user", "bucket", "p", "y"),
+            EventModel("user", "bucket", "a")])
+        # Only the new property value's columns are written.
+        self.assertEqual(cassandra.KNOWN.avoided, 2)
+        self.assertEqual(
+            cassandra.CLIENT.calls["batch_multikey_insert"],
+            calls + 1)
+        # Columns that may change are not noted.
+        yield cassandra.insert_relation_by_id(
+            "other",
+            "column",
+            "value",
+            commit=True)
+        self.assertFalse(cassandra.KNOWN.known("other", "column"))
+        yield cassandra.delete_relations([event.keys.relation("event")])
+        yield EventModel("user", "bucket", "a").add(_visitor)
+        name = yield EventModel("user", "bucket", event_id=event.id).get_name()
+        self.assertEqual(name, "a")
@@ -0,0 +1,73 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from twisted.trial import unittest
+from twisted.internet.defer import inlineCallbacks
+from telephus.cassandra.c08.ttypes import NotFoundException, \
+    TimedOutException
+from hiitrack.lib.memory import MemoryBackend
+
+
+class MemoryBackendTestCase(unittest.TestCase):
+
+    def make_backend(self):
+        return MemoryBackend()
+
+    @inlineCallbacks
+    def test_slice(self):
+        backend = self.make_backend()
+        yield backend.batch_multikey_insert("relation", {
+            "row": {"b": "2", "a": "1", "c": "3", "d": "4"}})
+        result = yield backend.get_slice(
+            key="row",
+            column_family="relation",
+            start="b",
+            finish="c")
+        self.assertEqual([x.column.name for x in result], ["b", "c"])
+        result = yield backend.get_slice(
+            key="row",
+            column_family="relation",
+            count=3,
+            reverse=True)
+        self.assertEqual([x.column.name for x in result], ["d", "c", "b"])
+        result = yield backend.get_slice(
+            key="row",
+            column_family="relation",
+            names=["d", "a", "z"])
+        self.assertEqual([x.column.value for x in result], ["1", "4"])
+        result = yield backend.get(
+            key="row",
+            column_family="relation",
+            column="a")
+        self.assertEqual(result.column.value, "1")
+        yield backend.remove(key="row", column_family="relation", column="a")
+        yield self.assertFailure(
+            backend.get(key="row", column_family="relation", column="a"),
+            NotFoundException)
+
+    @inlineCallbacks
+    def test_counter(self):
+        backend = self.make_backend()
+        yield backend.batch_multikey_add("counter", {"a": {"x": 1, "y": 2}})
+        yield backend.batch_multikey_add("counter", {"a": {"x": 3}})
+        result = yield backend.multiget_slice(
+            keys=["a", "b"],
+            column_family="counter")
+        self.assertEqual(
+            [(x.counter_column.name, x.counter_column.value)
+                for x in result["a"]],
+            [("x", 4), ("y", 2)])
+        self.assertEqual(result["b"], [])
+        yield backend.batch_remove_rows({"counter": ["a"]})
+        result = yield backend.get_slice(key="a", column_family="counter")
+        self.assertEqual(result, [])
+
+    @inlineCallbacks
+    def test_failure(self):
+        backend = MemoryBackend(failure_rate=1.0, latency=0.01)
+        yield self.assertFailure(
+            backend.batch_multikey_add("counter", {"a": {"x": 1}}),
+            TimedOutException)
+        backend.failure_rate = 0
+        result = yield backend.get_slice(key="a", column_family="counter")
+        self.assertEqual(result, [])
@@ -0,0 +1,115 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from twisted.trial import unittest
+from twisted.internet.defer import inlineCallbacks, fail
+from telephus.cassandra.c08.ttypes import UnavailableException
+from hiitrack.lib import cassandra
+from hiitrack.lib.keys import VisitorPartitions, bucket_keys
+from hiitrack.lib.memory import MemoryBackend
+from hiitrack.migrations.visitor_partitions import repartition_bucket
+from hiitrack.models import visitor, VisitorModel, EventModel, \
+    PropertyValueModel
+from state import plain
+
+
+class VisitorPartitionsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = cassandra.CLIENT
+        self.settings = (
+            visitor.PARTITIONS,
+            visitor.PREVIOUS_PARTITIONS,
+            visitor.METADATA_CACHE,
+            visitor.VISITOR_FILTERS)
+        cassandra.CLIENT = MemoryBackend()
+        visitor.PARTITIONS = VisitorPartitions()
+        visitor.PREVIOUS_PARTITIONS = None
+        visitor.METADATA_CACHE = None
+        visitor.VISITOR_FILTERS = None
+
+    def tearDown(self):
+        cassandra.CLIENT = self.client
+        visitor.PARTITIONS, visitor.PREVIOUS_PARTITIONS, \
+            visitor.METADATA_CACHE, visitor.VISITOR_FILTERS = self.settings
+
+    def ingest(self, visitor_id, names):
+        models = [PropertyValueModel("user", "bucket", "p", visitor_id)]
+        models.extend([EventModel("user", "bucket", x) for x in names])
+        return VisitorModel("user", "bucket", visitor_id).ingest(models)
+
+    def test_partition(self):
+        keys = bucket_keys("user", "bucket")
+        _visitor = VisitorModel("user", "bucket", "a")
+        self.assertEqual(
+            _visitor.row("visitor_event"),
+            keys.counter("visitor_event", _visitor.id[0]))
+        partitions = VisitorPartitions(1000)
+        self.assertEqual(len(set(partitions.rows(keys, "visitor_path"))), 1000)
+        self.assertTrue(
+            _visitor.row("visitor_path", partitions) in
+                partitions.rows(keys, "visitor_path"))
+        self.assertEqual(
+            VisitorPartitions(256).partition(_visitor.id),
+            ord(_visitor.id[0]))
+
+    @inlineCallbacks
+    def test_repartition(self):
+        for visitor_id in ("a", "b", "c"):
+            yield self.ingest(visitor_id, ["x", "y", "x"])
+        expected = {}
+        for visitor_id in ("a", "b", "c"):
+            metadata = yield VisitorModel(
+                "user",
+                "bucket",
+                visitor_id).get_metadata()
+            expected[visitor_id] = plain(metadata)
+        visitor.PREVIOUS_PARTITIONS = visitor.PARTITIONS
+        visitor.PARTITIONS = VisitorPartitions(1024)
+        # The ingest reads "a" from its old rows and copies it.
+        yield self.ingest("a", ["z"])
+        migrated = yield repartition_bucket(
+            "user",
+            "bucket",
+            visitor.PREVIOUS_PARTITIONS,
+            visitor.PARTITIONS,
+            delete=True)
+        self.assertEqual(migrated, 2)
+        visitor.PREVIOUS_PARTITIONS = None
+        for visitor_id in ("b", "c"):
+            metadata = yield VisitorModel(
+                "user",
+                "bucket",
+                visitor_id).get_metadata()
+            self.assertEqual(plain(metadata), expected[visitor_id])
+        metadata = yield VisitorModel("user", "bucket", "a").get_metadata()
+        total, path, property_ids = expected["a"]
+        self.assertEqual(plain(metadata)[0], dict(total, **{
+            EventModel("user", "bucket", "z").id: 1}))
+        self.assertEqual(plain(metadata)[2], property_ids)
+        keys = bucket_keys("user", "bucket")
+        for shard in range(256):
+            self.assertEqual(
+                cassandra.CLIENT.data["counter"].get(
+                    keys.counter("visitor_event", chr(shard))),
+                None)
+
+    @inlineCallbacks
+    def test_failed_repartition(self):
+        yield self.ingest("a", ["x", "y"])
+        source = visitor.PARTITIONS
+        row = VisitorModel("user", "bucket", "a").row("visitor_event")
+        client = cassandra.CLIENT
+        client.batch_multikey_add = lambda *args, **kwargs: fail(
+            UnavailableException())
+        yield self.assertFailure(
+            repartition_bucket(
+                "user",
+                "bucket",
+                source,
+                VisitorPartitions(1024),
+                delete=True),
+            UnavailableException)
+        del client.batch_multikey_add
+        # The source rows are kept when the copy failed.
+        self.assertTrue(cassandra.CLIENT.data["counter"].get(row))
@@ -0,0 +1,81 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import time
+import struct
+import shutil
+import tempfile
+from twisted.trial import unittest
+from twisted.internet.defer import inlineCallbacks, succeed
+from hiitrack.lib.periods import PeriodCache
+
+
+HOUR = 60*60
+
+
+class PeriodCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.cache = PeriodCache(os.path.join(self.path, "periods.db"), 0)
+        self.now = int(time.time()) // HOUR * HOUR
+        self.columns = {}
+        for i in range(48):
+            timestamp = self.now - i * HOUR
+            for suffix in ("a", "b"):
+                self.columns[struct.pack(">1i", timestamp) + suffix] = i
+        self.loads = []
+
+    def tearDown(self):
+        self.cache.close()
+        shutil.rmtree(self.path)
+
+    def load(self, start, finish, closed):
+        self.loads.append((start, finish, closed))
+        names = sorted([x for x in self.columns
+            if start <= struct.unpack(">1i", x[0:4])[0] <= finish])
+        return succeed((names, [self.columns[x] for x in names]))
+
+    @inlineCallbacks
+    def get(self, start, finish):
+        names, values = yield self.cache.get(
+            "row",
+            "prefix",
+            start,
+            finish,
+            HOUR,
+            self.load)
+        self.loads, loads = [], self.loads
+        expected = yield self.load(start, finish, False)
+        self.loads = loads
+        self.assertEqual((names, values), expected)
+
+    @inlineCallbacks
+    def test_get(self):
+        yield self.get(self.now - 10 * HOUR, self.now)
+        self.assertEqual(self.loads, [
+            (self.now - 10 * HOUR, self.now - HOUR, True),
+            (self.now - HOUR + 1, self.now, False)])
+        self.loads = []
+        yield self.get(self.now - 5 * HOUR, self.now)
+        self.assertEqual(self.loads, [(self.now - HOUR + 1, self.now, False)])
+        self.loads = []
+        yield self.get(self.now - 20 * HOUR, self.now - 2 * HOUR)
+        self.assertEqual(self.loads, [
+            (self.now - 20 * HOUR, self.now - 10 * HOUR - 1, True)])
+        self.assertEqual(self.cache.hits, 1)
+        self.assertEqual(self.cache.misses, 2)
+        self.cache.invalidate(["row"])
+        self.loads = []
+        yield self.get(self.now - 5 * HOUR, self.now - 5 * HOUR)
+        self.assertEqual(self.loads, [
+            (self.now - 5 * HOUR, self.now - 5 * HOUR, True)])
+
+    def test_closed(self):
+        cache = PeriodCache(os.path.join(self.path, "grace.db"), 300)
+        closed = cache.closed(HOUR, self.now + 299)
+        self.assertEqual(closed, self.now - 2 * HOUR)
+        closed = cache.closed(HOUR, self.now + 300)
+        self.assertEqual(closed, self.now - HOUR)
+        cache.close()
@@ -10,6 +10,7 @@ import ujson
 from urllib import quote
 from base64 import b64encode
 from urllib import urlencode
+from hiitrack.lib import cassandra
 
 class PropertyTestCase(unittest.TestCase):
     
@@ -77,3 +78,63 @@ class PropertyTestCase(unittest.TestCase):
             password=self.password)
         self.assertTrue(NAME in ujson.loads(result.body)["properties"].values())
 
+
+    @inlineCallbacks
+    def test_paging(self):
+        NAME = uuid.uuid4().hex
+        VALUES = [uuid.uuid4().hex for i in range(5)]
+        EVENT = uuid.uuid4().hex
+        for value in VALUES:
+            visitor_id = uuid.uuid4().hex
+            qs = urlencode({"value":b64encode(ujson.dumps(value))})
+            yield request(
+                "POST",
+                "%s/property/%s?%s" % (self.url, quote(NAME), qs),
+                data={"visitor_id":visitor_id})
+            yield request(
+                "POST",
+                "%s/event/%s" % (self.url, quote(EVENT)),
+                data={"visitor_id":visitor_id})
+        page_size = cassandra.PAGE_SIZE
+        cassandra.PAGE_SIZE = 2
+        try:
+            result = yield request(
+                "GET",
+                "%s/property/%s" % (self.url, quote(NAME)),
+                username=self.username,
+                password=self.password)
+        finally:
+            cassandra.PAGE_SIZE = page_size
+        data = ujson.loads(result.body)
+        self.assertEqual(
+            sorted([x["value"] for x in data["values"].values()]),
+            sorted(VALUES))
+        self.assertFalse("cursor" in data)
+        values = {}
+        cursor = ""
+        for i in range(3):
+            qs = urlencode({"limit":2, "cursor":cursor})
+            result = yield request(
+                "GET",
+                "%s/property/%s?%s" % (self.url, quote(NAME), qs),
+                username=self.username,
+                password=self.password)
+            data = ujson.loads(result.body)
+            self.assertTrue(len(data["values"]) <= 2)
+            self.assertEqual(data["events"].values(), [EVENT])
+            values.update(data["values"])
+            cursor = data["cursor"]
+            if cursor is None:
+                break
+        self.assertEqual(cursor, None)
+        self.assertEqual(
+            sorted([x["value"] for x in values.values()]),
+            sorted(VALUES))
+        for value in values.values():
+            self.assertEqual(value["total"].values(), [1])
+        result = yield request(
+            "GET",
+            "%s/property/%s?limit=0" % (self.url, quote(NAME)),
+            username=self.username,
+            password=self.password)
+        self.assertEqual(result.code, 400)
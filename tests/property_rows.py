@@ -0,0 +1,92 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from twisted.trial import unittest
+from twisted.internet.defer import inlineCallbacks, returnValue, fail
+from telephus.cassandra.c08.ttypes import UnavailableException
+from hiitrack.lib import cassandra
+from hiitrack.lib.keys import bucket_keys
+from hiitrack.lib.memory import MemoryBackend
+from hiitrack.migrations.property_rows import migrate_bucket
+from hiitrack.models import property as property_model
+from hiitrack.models import visitor, VisitorModel, EventModel, \
+    PropertyModel, PropertyValueModel
+
+
+class PropertyRowsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = cassandra.CLIENT
+        self.settings = (
+            cassandra.KNOWN,
+            property_model.PROPERTY_ROWS,
+            visitor.METADATA_CACHE,
+            visitor.VISITOR_FILTERS)
+        cassandra.CLIENT = MemoryBackend()
+        cassandra.KNOWN = None
+        property_model.PROPERTY_ROWS = "bucket"
+        visitor.METADATA_CACHE = None
+        visitor.VISITOR_FILTERS = None
+
+    def tearDown(self):
+        cassandra.CLIENT = self.client
+        cassandra.KNOWN, property_model.PROPERTY_ROWS, \
+            visitor.METADATA_CACHE, visitor.VISITOR_FILTERS = self.settings
+
+    def ingest(self, visitor_id, values):
+        models = [PropertyValueModel("user", "bucket", x, y)
+            for x, y in values]
+        models.append(EventModel("user", "bucket", "x"))
+        return VisitorModel("user", "bucket", visitor_id).ingest(models)
+
+    @inlineCallbacks
+    def values(self, property_name):
+        _property = PropertyModel("user", "bucket", property_name)
+        values = yield _property.get_values()
+        pages = {}
+        cursor = None
+        while True:
+            page, cursor = yield _property.get_values_page(cursor, limit=2)
+            pages.update(page)
+            if cursor is None:
+                break
+        self.assertEqual(pages, values)
+        returnValue(values)
+
+    @inlineCallbacks
+    def test_migrate(self):
+        yield self.ingest("a", [("p", 1), ("q", "a")])
+        yield self.ingest("b", [("p", 2), ("q", "b")])
+        property_model.PROPERTY_ROWS = "migrating"
+        yield self.ingest("c", [("p", 3), ("q", "c")])
+        expected = {}
+        for name in ("p", "q"):
+            expected[name] = yield self.values(name)
+        self.assertEqual(sorted(expected["p"].values()), [1, 2, 3])
+        migrated = yield migrate_bucket("user", "bucket", delete=True)
+        self.assertEqual(migrated, 6)
+        property_model.PROPERTY_ROWS = "property"
+        yield self.ingest("d", [("p", 4)])
+        expected["p"][PropertyValueModel("user", "bucket", "p", 4).id] = 4
+        for name in ("p", "q"):
+            values = yield self.values(name)
+            self.assertEqual(values, expected[name])
+        keys = bucket_keys("user", "bucket")
+        self.assertEqual(
+            cassandra.CLIENT.data["relation"].get(keys.relation("property")),
+            None)
+
+    @inlineCallbacks
+    def test_failed_migrate(self):
+        yield self.ingest("a", [("p", 1)])
+        client = cassandra.CLIENT
+        client.batch_multikey_insert = lambda *args, **kwargs: fail(
+            UnavailableException())
+        yield self.assertFailure(
+            migrate_bucket("user", "bucket", delete=True),
+            UnavailableException)
+        del client.batch_multikey_insert
+        # The bucket row is kept when the copy failed.
+        keys = bucket_keys("user", "bucket")
+        self.assertTrue(
+            cassandra.CLIENT.data["relation"].get(keys.relation("property")))
@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from twisted.trial import unittest
+from twisted.internet.defer import inlineCallbacks, succeed
+from hiitrack.lib.ring import Ring, token
+from uuid import uuid4
+
+
+class FakeTokenRange(object):
+
+    def __init__(self, start_token, end_token, endpoints):
+        self.start_token = str(start_token)
+        self.end_token = str(end_token)
+        self.endpoints = endpoints
+
+
+class FakeRingClient(object):
+    """
+    Serves a fixed four node ring.
+    """
+
+    def __init__(self):
+        step = 2 ** 127 / 4
+        self.ranges = [FakeTokenRange(
+            i * step,
+            (i + 1) * step,
+            ["10.0.0.%s" % (i + 1), "10.0.0.%s" % ((i + 1) % 4 + 1)])
+            for i in range(0, 4)]
+        self.started = False
+
+    def describe_ring(self, keyspace):
+        return succeed(self.ranges)
+
+    def startService(self):
+        self.started = True
+
+    def stopService(self):
+        self.started = False
+
+
+class RingTestCase(unittest.TestCase):
+
+    @inlineCallbacks
+    def test_group(self):
+        client = FakeRingClient()
+        ring = Ring(client, "HiiTrack", lambda endpoint: FakeRingClient())
+        self.assertEqual(ring.replica("a" * 16), None)
+        yield ring.refresh()
+        keys = [uuid4().bytes for i in range(0, 1000)]
+        mutations = dict([(key, {"column": 1}) for key in keys])
+        groups = ring.group(mutations)
+        self.assertEqual(sum([len(x) for x in groups.values()]), 1000)
+        for token_range in client.ranges:
+            for key in groups[token_range.endpoints[0]]:
+                key_token = token(key)
+                self.assertTrue(key_token > int(token_range.start_token))
+                self.assertTrue(key_token <= int(token_range.end_token))
+
+    def test_token(self):
+        # Tokens are non-negative and below 2 ** 127.
+        for i in range(0, 1000):
+            key_token = token(uuid4().bytes)
+            self.assertTrue(0 <= key_token <= 2 ** 127)
+
+    @inlineCallbacks
+    def test_clients(self):
+        ring = Ring(FakeRingClient(), "HiiTrack", lambda x: FakeRingClient())
+        yield ring.refresh()
+        client = ring.client_for("10.0.0.1")
+        self.assertTrue(client.started)
+        self.assertTrue(ring.client_for("10.0.0.1") is client)
+        ring.stop()
+        self.assertFalse(client.started)
@@ -0,0 +1,169 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import time
+from twisted.trial import unittest
+from twisted.internet.defer import inlineCallbacks, returnValue, fail
+from telephus.cassandra.c08.ttypes import TimedOutException
+from hiitrack.lib import cassandra
+from hiitrack.lib.families import DISABLED_CACHE
+from hiitrack.lib.keys import bucket_keys
+from hiitrack.lib.memory import MemoryBackend
+from hiitrack.models import event as event_model
+from hiitrack.models import visitor, VisitorModel, EventModel, \
+    PropertyModel, PropertyValueModel, BucketModel
+from hiitrack.models.rollup import DailyRollup
+
+
+class DailyRollupTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = cassandra.CLIENT
+        self.settings = (
+            cassandra.CACHE,
+            cassandra.PERIODS,
+            cassandra.KNOWN,
+            event_model.DAILY_ROLLUP,
+            visitor.METADATA_CACHE,
+            visitor.VISITOR_FILTERS)
+        cassandra.CLIENT = MemoryBackend()
+        cassandra.CACHE = None
+        cassandra.PERIODS = None
+        cassandra.KNOWN = None
+        event_model.DAILY_ROLLUP = None
+        visitor.METADATA_CACHE = None
+        visitor.VISITOR_FILTERS = None
+
+    def tearDown(self):
+        cassandra.CLIENT = self.client
+        cassandra.CACHE, cassandra.PERIODS, cassandra.KNOWN, \
+            event_model.DAILY_ROLLUP, visitor.METADATA_CACHE, \
+            visitor.VISITOR_FILTERS = self.settings
+
+    @inlineCallbacks
+    def ingest(self, bucket_name):
+        for visitor_id, names in (("a", "xyx"), ("b", "yxxz"), ("c", "x")):
+            models = [PropertyValueModel(
+                "user",
+                bucket_name,
+                "p",
+                visitor_id)]
+            models.extend([EventModel("user", bucket_name, x) for x in names])
+            yield VisitorModel("user", bucket_name, visitor_id).ingest(models)
+
+    @inlineCallbacks
+    def counters(self, bucket_name):
+        now = time.time()
+        result = {}
+        for name in "xyz":
+            event = EventModel("user", bucket_name, name)
+            for _property in (None, PropertyModel("user", bucket_name, "p")):
+                for i, method in enumerate((
+                        event.get_timed_total,
+                        event.get_timed_unique_total,
+                        event.get_timed_path,
+                        event.get_timed_unique_path)):
+                    data = yield method(
+                        now - 3 * 86400,
+                        now,
+                        "day",
+                        _property)
+                    result[(name, _property is None, i)] = \
+                        dict([(x, dict(y) if isinstance(y, dict) else y)
+                            for x, y in data.items()])
+        returnValue(result)
+
+    @inlineCallbacks
+    def test_rollup(self):
+        yield self.ingest("cold")
+        expected = yield self.counters("cold")
+        now = int(time.time())
+        rollup = event_model.DAILY_ROLLUP = DailyRollup(now - now % 3600)
+        yield self.ingest("hot")
+        result = yield self.counters("hot")
+        self.assertEqual(result, expected)
+        event = EventModel("user", "hot", "x")
+        self.assertEqual(
+            expected[("x", True, 0)][event.id][-1][1],
+            5)
+        keys = bucket_keys("user", "hot")
+        self.assertEqual(
+            cassandra.CLIENT.data["counter"].get(
+                keys.counter("daily_event", event.shard)),
+            None)
+        tomorrow = now - now % 86400 + 86400
+        rolled = yield rollup.rollup_bucket(keys, tomorrow + 1000)
+        self.assertTrue(rolled > 0)
+        watermark = yield rollup.watermark(keys)
+        self.assertEqual(watermark, tomorrow)
+        self.assertTrue(cassandra.CLIENT.data["counter"].get(
+            keys.counter("daily_event", event.shard)))
+        result = yield self.counters("hot")
+        self.assertEqual(result, expected)
+        rolled = yield rollup.rollup_bucket(keys, tomorrow + 1000)
+        self.assertEqual(rolled, 0)
+        # A process with an old watermark reads the same counts.
+        event_model.DAILY_ROLLUP = DailyRollup(rollup.since)
+        event_model.DAILY_ROLLUP.watermarks[("user", "hot")] = \
+            (now - now % 86400, time.time())
+        result = yield self.counters("hot")
+        self.assertEqual(result, expected)
+
+    @inlineCallbacks
+    def test_rerun(self):
+        yield self.ingest("cold")
+        expected = yield self.counters("cold")
+        now = int(time.time())
+        rollup = event_model.DAILY_ROLLUP = DailyRollup(now - now % 3600)
+        yield self.ingest("hot")
+        keys = bucket_keys("user", "hot")
+        tomorrow = now - now % 86400 + 86400
+        client = cassandra.CLIENT
+        calls = []
+        def batch_multikey_add(column_family, mapping, consistency=None):
+            # The second shard holding hourly columns fails.
+            if mapping:
+                calls.append(mapping)
+                if len(calls) == 2:
+                    return fail(TimedOutException())
+            return client.__class__.batch_multikey_add(
+                client,
+                column_family,
+                mapping,
+                consistency)
+        client.batch_multikey_add = batch_multikey_add
+        yield self.assertFailure(
+            rollup.rollup_bucket(keys, tomorrow + 1000),
+            TimedOutException)
+        del client.batch_multikey_add
+        watermark = yield rollup.watermark(keys, cached=False)
+        self.assertEqual(watermark, rollup.since - rollup.since % 86400)
+        # The rerun adds the shards the failed job did not mark, including
+        # the one that failed.
+        rolled = yield rollup.rollup_bucket(keys, tomorrow + 1000)
+        self.assertTrue(rolled > 0)
+        watermark = yield rollup.watermark(keys)
+        self.assertEqual(watermark, tomorrow)
+        event_model.DAILY_ROLLUP = DailyRollup(rollup.since)
+        event_model.DAILY_ROLLUP.watermarks[("user", "hot")] = \
+            (tomorrow, time.time())
+        result = yield self.counters("hot")
+        self.assertEqual(result, expected)
+
+    @inlineCallbacks
+    def test_disabled(self):
+        self.addCleanup(DISABLED_CACHE.clear)
+        now = int(time.time())
+        rollup = event_model.DAILY_ROLLUP = DailyRollup(now - now % 3600)
+        yield BucketModel("user", "light").create("light", ("daily_path",))
+        yield self.ingest("light")
+        keys = bucket_keys("user", "light")
+        tomorrow = now - now % 86400 + 86400
+        rolled = yield rollup.rollup_bucket(keys, tomorrow + 1000)
+        self.assertTrue(rolled > 0)
+        event = EventModel("user", "light", "x")
+        self.assertTrue(cassandra.CLIENT.data["counter"].get(
+            keys.counter("daily_event", event.shard)))
+        rows = set([keys.counter(x, chr(i))
+            for x in ("daily_path", "daily_unique_path") for i in range(256)])
+        self.assertFalse(rows & set(cassandra.CLIENT.data["counter"]))
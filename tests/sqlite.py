@@ -0,0 +1,36 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from hiitrack.lib.sqlite import SQLiteBackend
+import memory
+import os
+import tempfile
+import shutil
+
+
+class SQLiteBackendTestCase(memory.MemoryBackendTestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.path)
+
+    def make_backend(self):
+        return SQLiteBackend(os.path.join(self.path, "hiitrack.db"))
+
+    def test_failure(self):
+        pass
+    test_failure.skip = "Failure injection is specific to MemoryBackend."
+
+    def test_persistence(self):
+        path = os.path.join(self.path, "hiitrack.db")
+        backend = SQLiteBackend(path)
+        backend.batch_multikey_add("counter", {"a": {"x\x00": 2}})
+        backend.stopService()
+        backend = SQLiteBackend(path)
+        result = self.successResultOf(backend.get(
+            key="a",
+            column_family="counter",
+            column="x\x00"))
+        self.assertEqual(result.counter_column.value, 2)
@@ -0,0 +1,111 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from twisted.trial import unittest
+from twisted.internet.defer import inlineCallbacks, fail
+from telephus.cassandra.c08.ttypes import UnavailableException
+from hiitrack.lib import cassandra
+from hiitrack.lib.memory import MemoryBackend
+from hiitrack.lib.state import pack_state, unpack_state
+from hiitrack.migrations.visitor_state import migrate_bucket
+from hiitrack.models import visitor, VisitorModel, EventModel, \
+    PropertyValueModel
+
+
+def plain(metadata):
+    """
+    Metadata as plain dictionaries and a sorted list.
+    """
+    total, path, property_ids = metadata
+    return (
+        dict([(x, y) for x, y in total.items() if y]),
+        dict([(x, dict(y)) for x, y in path.items() if y]),
+        sorted(property_ids))
+
+
+class VisitorStateTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = cassandra.CLIENT
+        self.state = visitor.VISITOR_STATE
+        self.cache = visitor.METADATA_CACHE
+        self.filters = visitor.VISITOR_FILTERS
+        cassandra.CLIENT = MemoryBackend()
+        visitor.VISITOR_STATE = "counter"
+        visitor.METADATA_CACHE = None
+        visitor.VISITOR_FILTERS = None
+
+    def tearDown(self):
+        cassandra.CLIENT = self.client
+        visitor.VISITOR_STATE = self.state
+        visitor.METADATA_CACHE = self.cache
+        visitor.VISITOR_FILTERS = self.filters
+
+    def ingest(self, visitor_id, names):
+        models = [PropertyValueModel("user", "bucket", "p", visitor_id)]
+        models.extend([EventModel("user", "bucket", x) for x in names])
+        return VisitorModel("user", "bucket", visitor_id).ingest(models)
+
+    @inlineCallbacks
+    def test_pack(self):
+        yield self.ingest("a", ["x", "y", "x", "z", "z"])
+        metadata = yield VisitorModel("user", "bucket", "a").get_metadata()
+        self.assertEqual(
+            plain(unpack_state(pack_state(*metadata))),
+            plain(metadata))
+        self.assertEqual(
+            plain(unpack_state(pack_state({}, {}, []))),
+            ({}, {}, []))
+
+    @inlineCallbacks
+    def test_migrate(self):
+        yield self.ingest("a", ["x", "y", "x"])
+        visitor.VISITOR_STATE = "migrating"
+        yield self.ingest("b", ["y", "z"])
+        expected = {}
+        for visitor_id in ("a", "b"):
+            metadata = yield VisitorModel(
+                "user",
+                "bucket",
+                visitor_id).get_metadata()
+            expected[visitor_id] = plain(metadata)
+        migrated = yield migrate_bucket("user", "bucket")
+        self.assertEqual(migrated, 1)
+        visitor.VISITOR_STATE = "blob"
+        migrated = yield migrate_bucket("user", "bucket", delete=True)
+        self.assertEqual(migrated, 0)
+        yield self.ingest("a", ["z"])
+        calls = sum(cassandra.CLIENT.calls.values())
+        metadata = yield VisitorModel("user", "bucket", "a").get_metadata()
+        # A single read of the blob column.
+        self.assertEqual(sum(cassandra.CLIENT.calls.values()), calls + 1)
+        yield self.ingest("a", ["z"])
+        total, path, property_ids = expected["a"]
+        self.assertEqual(plain(metadata)[0], dict(total, **{
+            EventModel("user", "bucket", "z").id: 1}))
+        metadata = yield VisitorModel("user", "bucket", "b").get_metadata()
+        self.assertEqual(plain(metadata), expected["b"])
+        visitor_id = VisitorModel("user", "bucket", "a").id
+        keys = VisitorModel("user", "bucket", "a").keys
+        for kind in ("visitor_event", "visitor_path", "visitor_property"):
+            self.assertEqual(
+                cassandra.CLIENT.data["counter"].get(
+                    keys.counter(kind, visitor_id[0])),
+                None)
+
+    @inlineCallbacks
+    def test_failed_migrate(self):
+        yield self.ingest("a", ["x", "y"])
+        client = cassandra.CLIENT
+        client.batch_multikey_insert = lambda *args, **kwargs: fail(
+            UnavailableException())
+        yield self.assertFailure(
+            migrate_bucket("user", "bucket", delete=True),
+            UnavailableException)
+        del client.batch_multikey_insert
+        # The counter rows are kept when their blob was not written.
+        _visitor = VisitorModel("user", "bucket", "a")
+        self.assertTrue(cassandra.CLIENT.data["counter"].get(
+            _visitor.row("visitor_event")))
+        migrated = yield migrate_bucket("user", "bucket", delete=True)
+        self.assertEqual(migrated, 1)
@@ -8,5 +8,25 @@ from user import UserTestCase
 from funnel import FunnelTestCase
 from batch import BatchTestCase
 from cookie import CookieTestCase
-
-
+from buffer import BufferTestCase
+from wal import WriteAheadLogTestCase
+from ring import RingTestCase
+from memory import MemoryBackendTestCase
+from sqlite import SQLiteBackendTestCase
+from keys import BucketKeysTestCase
+from columnar import ColumnarTestCase
+from flight import SingleFlightTestCase
+from cache import SliceCacheTestCase
+from periods import PeriodCacheTestCase
+from visitor import MetadataCacheTestCase
+from bloom import BloomFilterTestCase
+from visitor import VisitorFiltersTestCase, IngestTestCase
+from kernel import MutationKernelTestCase
+from known import KnownColumnsTestCase
+from state import VisitorStateTestCase
+from partitions import VisitorPartitionsTestCase
+from property_rows import PropertyRowsTestCase
+from time_partitions import TimePartitionsTestCase
+from hot import HotEventsTestCase
+from rollup import DailyRollupTestCase
+from families import CounterFamiliesTestCase
@@ -0,0 +1,198 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import calendar
+import shutil
+import tempfile
+import time
+from twisted.trial import unittest
+from twisted.internet.defer import inlineCallbacks
+from hiitrack.lib import cassandra
+from hiitrack.lib.cassandra import increment_counter, pack_hour
+from hiitrack.lib.keys import TimePartitions, bucket_keys
+from hiitrack.lib.memory import MemoryBackend
+from hiitrack.lib.periods import PeriodCache
+from hiitrack.migrations.time_partitions import migrate_bucket, \
+    drop_partitions
+from hiitrack.models import event as event_model
+from hiitrack.models import visitor, VisitorModel, EventModel
+from hiitrack.models.event import get_time_partitions
+
+
+def timestamp(year, month, day):
+    return calendar.timegm((year, month, day, 0, 0, 0))
+
+
+class TimePartitionsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = cassandra.CLIENT
+        self.settings = (
+            cassandra.CACHE,
+            cassandra.PERIODS,
+            cassandra.KNOWN,
+            event_model.TIME_PARTITIONS,
+            event_model.TIME_PARTITIONS_MIGRATING,
+            visitor.METADATA_CACHE,
+            visitor.VISITOR_FILTERS)
+        cassandra.CLIENT = MemoryBackend()
+        cassandra.CACHE = None
+        cassandra.PERIODS = None
+        cassandra.KNOWN = None
+        event_model.TIME_PARTITIONS = None
+        event_model.TIME_PARTITIONS_MIGRATING = False
+        visitor.METADATA_CACHE = None
+        visitor.VISITOR_FILTERS = None
+
+    def tearDown(self):
+        cassandra.CLIENT = self.client
+        cassandra.CACHE, cassandra.PERIODS, cassandra.KNOWN, \
+            event_model.TIME_PARTITIONS, \
+            event_model.TIME_PARTITIONS_MIGRATING, visitor.METADATA_CACHE, \
+            visitor.VISITOR_FILTERS = self.settings
+
+    def test_ranges(self):
+        partitions = TimePartitions("month")
+        self.assertEqual(
+            partitions.partition(timestamp(2012, 12, 31) + 3600),
+            timestamp(2012, 12, 1))
+        self.assertEqual(
+            partitions.ranges(timestamp(2012, 12, 15), timestamp(2013, 2, 1)),
+            [(timestamp(2012, 12, 1),
+                    timestamp(2012, 12, 15),
+                    timestamp(2013, 1, 1) - 1),
+                (timestamp(2013, 1, 1),
+                    timestamp(2013, 1, 1),
+                    timestamp(2013, 2, 1) - 1),
+                (timestamp(2013, 2, 1),
+                    timestamp(2013, 2, 1),
+                    timestamp(2013, 2, 1))])
+        self.assertEqual(
+            TimePartitions(7 * 86400).ranges(100, 200),
+            [(0, 100, 200)])
+
+    @inlineCallbacks
+    def test_migrate(self):
+        event = EventModel("user", "bucket", "x")
+        keys = bucket_keys("user", "bucket")
+        prefix = event.id + chr(0) * 16
+        for month in (1, 2, 3):
+            increment_counter(
+                keys.counter("hourly_event", event.shard),
+                column_id=prefix + pack_hour(timestamp(2012, month, 10)) + \
+                    chr(0) * 16,
+                value=month)
+        yield cassandra.BUFFER.commit()
+        start, finish = timestamp(2012, 1, 1), timestamp(2012, 4, 1)
+        expected = yield event.get_timed_total(start, finish, "hour")
+        event_model.TIME_PARTITIONS = TimePartitions("month")
+        migrated = yield migrate_bucket(
+            "user",
+            "bucket",
+            event_model.TIME_PARTITIONS,
+            delete=True)
+        self.assertEqual(migrated, 3)
+        result = yield event.get_timed_total(start, finish, "hour")
+        self.assertEqual(result, expected)
+        self.assertEqual(len(result[event.id]), 3)
+        time_partitions = yield get_time_partitions(keys)
+        self.assertEqual([x[1] for x in time_partitions], [
+            timestamp(2012, 1, 1),
+            timestamp(2012, 2, 1),
+            timestamp(2012, 3, 1)])
+        dropped = yield drop_partitions(
+            "user",
+            "bucket",
+            timestamp(2012, 3, 1))
+        self.assertEqual(dropped, 2)
+        result = yield event.get_timed_total(start, finish, "hour")
+        self.assertEqual(
+            result[event.id],
+            [(timestamp(2012, 3, 10), 3)])
+
+    @inlineCallbacks
+    def test_migrating(self):
+        path = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, path)
+        event = EventModel("user", "bucket", "x")
+        keys = bucket_keys("user", "bucket")
+        prefix = event.id + chr(0) * 16
+        columns = dict([(month, prefix + pack_hour(timestamp(2012, month, 10))
+            + chr(0) * 16) for month in (1, 2, 3)])
+        for month in (1, 2, 3):
+            increment_counter(
+                keys.counter("hourly_event", event.shard),
+                column_id=columns[month],
+                value=month)
+        yield cassandra.BUFFER.commit()
+        cassandra.PERIODS = PeriodCache(os.path.join(path, "periods.db"), 0)
+        self.addCleanup(cassandra.PERIODS.close)
+        event_model.TIME_PARTITIONS = TimePartitions("month")
+        event_model.TIME_PARTITIONS_MIGRATING = True
+        # Counted in the partition after the switch.
+        increment_counter(
+            event_model.TIME_PARTITIONS.row(
+                keys,
+                "hourly_event",
+                event.shard,
+                timestamp(2012, 3, 1)),
+            column_id=columns[3],
+            value=10)
+        yield cassandra.BUFFER.commit()
+        start, finish = timestamp(2012, 1, 1), timestamp(2012, 4, 1)
+        expected = [
+            (timestamp(2012, 1, 10), 1),
+            (timestamp(2012, 2, 10), 2),
+            (timestamp(2012, 3, 10), 13)]
+        result = yield event.get_timed_total(start, finish, "hour")
+        self.assertEqual(result[event.id], expected)
+        migrated = yield migrate_bucket(
+            "user",
+            "bucket",
+            event_model.TIME_PARTITIONS)
+        self.assertEqual(migrated, 3)
+        result = yield event.get_timed_total(start, finish, "hour")
+        self.assertEqual(result[event.id], expected)
+        # Copied rows are skipped on a rerun, and dropped with delete.
+        migrated = yield migrate_bucket(
+            "user",
+            "bucket",
+            event_model.TIME_PARTITIONS,
+            delete=True)
+        self.assertEqual(migrated, 0)
+        self.assertEqual(
+            cassandra.CLIENT.data["counter"].get(
+                keys.counter("hourly_event", event.shard)),
+            None)
+        event_model.TIME_PARTITIONS_MIGRATING = False
+        result = yield event.get_timed_total(start, finish, "hour")
+        self.assertEqual(result[event.id], expected)
+        time_partitions = yield get_time_partitions(keys)
+        self.assertEqual(len(time_partitions), 3)
+
+    @inlineCallbacks
+    def test_ingest(self):
+        event_model.TIME_PARTITIONS = TimePartitions("month")
+        _visitor = VisitorModel("user", "bucket", "a")
+        yield _visitor.ingest([
+            EventModel("user", "bucket", "x"),
+            EventModel("user", "bucket", "y")])
+        event = EventModel("user", "bucket", "y")
+        now = time.time()
+        result = yield event.get_timed_path(now - 86400, now, "day")
+        self.assertEqual(
+            [x[1] for x in result[event.id][EventModel(
+                "user",
+                "bucket",
+                "x").id]],
+            [1])
+        time_partitions = yield get_time_partitions(event.keys)
+        self.assertEqual(
+            [x[1] for x in time_partitions],
+            [event_model.TIME_PARTITIONS.partition(now)])
+        keys = bucket_keys("user", "bucket")
+        self.assertEqual(
+            cassandra.CLIENT.data["counter"].get(
+                keys.counter("daily_path", event.shard)),
+            None)
@@ -0,0 +1,181 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import shutil
+import tempfile
+from collections import defaultdict
+from twisted.trial import unittest
+from twisted.internet.defer import inlineCallbacks, gatherResults
+from hiitrack.lib import cassandra
+from hiitrack.lib.memory import MemoryBackend
+from hiitrack.lib.keys import bucket_keys, COUNTER_KINDS, SHARDS
+from hiitrack.models import visitor, VisitorModel, EventModel, \
+    PropertyValueModel
+
+
+class MetadataCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = cassandra.CLIENT
+        self.cache = visitor.METADATA_CACHE
+        self.filters = visitor.VISITOR_FILTERS
+        cassandra.CLIENT = MemoryBackend()
+        visitor.METADATA_CACHE = visitor.MetadataCache(size=10, ttl=60)
+        visitor.VISITOR_FILTERS = None
+
+    def tearDown(self):
+        cassandra.CLIENT = self.client
+        visitor.METADATA_CACHE = self.cache
+        visitor.VISITOR_FILTERS = self.filters
+
+    @inlineCallbacks
+    def test_write_through(self):
+        _visitor = VisitorModel("user", "bucket", "visitor")
+        for name in ("a", "b", "a"):
+            event = EventModel("user", "bucket", name)
+            yield event.add(_visitor)
+        yield PropertyValueModel("user", "bucket", "p", "x").add(_visitor)
+        self.assertEqual(cassandra.CLIENT.calls["multiget_slice"], 1)
+        self.assertEqual(visitor.METADATA_CACHE.hits, 3)
+        self.assertEqual(visitor.METADATA_CACHE.misses, 1)
+        self.assertTrue(visitor.METADATA_CACHE.memory() > 0)
+        cached = yield _visitor.get_metadata()
+        visitor.METADATA_CACHE.remove(_visitor.cache_key)
+        stored = yield _visitor.get_metadata()
+        self.assertEqual(dict(cached[0]), dict(stored[0]))
+        self.assertEqual(
+            dict([(x, dict(cached[1][x])) for x in cached[1] if cached[1][x]]),
+            dict([(x, dict(stored[1][x])) for x in stored[1]]))
+        self.assertEqual(sorted(cached[2]), sorted(stored[2]))
+
+    def test_clear_bucket(self):
+        cache = visitor.MetadataCache(size=10, ttl=60)
+        cache.set(("user", "a", "1"), "a1")
+        cache.set(("user", "b", "1"), "b1")
+        self.assertEqual(cache.set(("user", "a", "1"), "a2"), "a1")
+        cache.clear_bucket("user", "a")
+        self.assertEqual(cache.get(("user", "a", "1")), None)
+        self.assertEqual(cache.get(("user", "b", "1")), "b1")
+        cache.ttl = -1
+        cache.set(("user", "c", "1"), "c1")
+        self.assertEqual(cache.get(("user", "c", "1")), None)
+
+
+class VisitorFiltersTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.client = cassandra.CLIENT
+        self.cache = visitor.METADATA_CACHE
+        self.filters = visitor.VISITOR_FILTERS
+        cassandra.CLIENT = MemoryBackend()
+        visitor.METADATA_CACHE = None
+        visitor.VISITOR_FILTERS = None
+
+    def tearDown(self):
+        cassandra.CLIENT = self.client
+        visitor.METADATA_CACHE = self.cache
+        visitor.VISITOR_FILTERS = self.filters
+        shutil.rmtree(self.path)
+
+    @inlineCallbacks
+    def test_filters(self):
+        old = VisitorModel("user", "bucket", "old")
+        yield EventModel("user", "bucket", "a").add(old)
+        visitor.VISITOR_FILTERS = visitor.VisitorFilters(self.path, 100)
+        new = VisitorModel("user", "bucket", "new")
+        # The existing bucket's filter is rebuilt from its visitor rows.
+        self.assertFalse(
+            visitor.VISITOR_FILTERS.missing("user", "bucket", old.id))
+        self.assertTrue(
+            visitor.VISITOR_FILTERS.missing("user", "bucket", new.id))
+        calls = cassandra.CLIENT.calls["multiget_slice"]
+        yield EventModel("user", "bucket", "a").add(new)
+        yield EventModel("user", "bucket", "a").add(old)
+        self.assertEqual(cassandra.CLIENT.calls["multiget_slice"], calls + 1)
+        visitor.VISITOR_FILTERS.save()
+        filters = visitor.VisitorFilters(self.path, 100)
+        self.assertFalse(filters.missing("user", "bucket", new.id))
+        self.assertEqual(filters.complete, set([("user", "bucket")]))
+        # Without a clean save the loaded filter is rebuilt.
+        filters = visitor.VisitorFilters(self.path, 100)
+        filters.rebuilding.add(("user", "bucket"))
+        filters._filter(("user", "bucket"))
+        self.assertEqual(filters.complete, set())
+        filters.reset("user", "bucket")
+        self.assertTrue(filters.missing("user", "bucket", new.id))
+
+    @inlineCallbacks
+    def test_fresh(self):
+        fresh = VisitorModel("user", "bucket", "fresh", fresh=True)
+        yield EventModel("user", "bucket", "a").add(fresh)
+        self.assertEqual(cassandra.CLIENT.calls["multiget_slice"], 0)
+        total, path, property_ids = yield VisitorModel(
+            "user",
+            "bucket",
+            "fresh").get_metadata()
+        self.assertEqual(total.values(), [1])
+
+
+class IngestTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.client = cassandra.CLIENT
+        self.cache = visitor.METADATA_CACHE
+        self.filters = visitor.VISITOR_FILTERS
+        cassandra.CLIENT = MemoryBackend(latency=0.01)
+        visitor.METADATA_CACHE = None
+        visitor.VISITOR_FILTERS = None
+
+    def tearDown(self):
+        cassandra.CLIENT = self.client
+        visitor.METADATA_CACHE = self.cache
+        visitor.VISITOR_FILTERS = self.filters
+
+    @inlineCallbacks
+    def test_coalesce(self):
+        coalesced = visitor.INGEST_STATS["coalesced"]
+        yield gatherResults([
+            EventModel("user", "bucket", name).add(
+                VisitorModel("user", "bucket", "visitor"))
+            for name in ("a", "a", "b")])
+        self.assertEqual(cassandra.CLIENT.calls["multiget_slice"], 1)
+        self.assertEqual(visitor.INGEST_STATS["coalesced"], coalesced + 2)
+        self.assertEqual(visitor.INGESTS, {})
+        event = EventModel("user", "bucket", "a")
+        total = yield event.get_total()
+        unique_total = yield event.get_unique_total()
+        self.assertEqual(total[event.id], 2)
+        self.assertEqual(unique_total[event.id], 1)
+        total = yield VisitorModel("user", "bucket", "visitor").get_total()
+        self.assertEqual(sorted(total.values()), [1, 2])
+
+    @inlineCallbacks
+    def test_collapse(self):
+        names = ["a", "a", "b", "b", "b", "a", "c", "c"]
+        for bucket_name, separately in (("one", True), ("all", False)):
+            _visitor = VisitorModel("user", bucket_name, "visitor")
+            models = [PropertyValueModel("user", bucket_name, "p", "x")]
+            models.extend([EventModel("user", bucket_name, x) for x in names])
+            if separately:
+                for model in models:
+                    yield model.add(_visitor)
+            else:
+                yield _visitor.ingest(models)
+        self.assertEqual(self.counters("one"), self.counters("all"))
+
+    def counters(self, bucket_name):
+        """
+        Counter columns of a bucket by kind, without the visitor ID.
+        """
+        visitor_id = VisitorModel("user", bucket_name, "visitor").id
+        keys = bucket_keys("user", bucket_name)
+        result = defaultdict(dict)
+        for kind in COUNTER_KINDS:
+            for shard in range(SHARDS):
+                row = cassandra.CLIENT.data["counter"].get(
+                    keys.counter(kind, chr(shard)))
+                if row is not None:
+                    result[kind].update([(x.replace(visitor_id, ""), y)
+                        for x, y in row.values.items()])
+        return result
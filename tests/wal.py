@@ -0,0 +1,109 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+from twisted.trial import unittest
+from twisted.internet.defer import inlineCallbacks
+from telephus.cassandra.c08.ttypes import TimedOutException, \
+    UnavailableException
+from hiitrack.lib import cassandra
+from hiitrack.lib.cassandra import Buffer
+from hiitrack.lib.memory import MemoryBackend
+from hiitrack.lib.wal import WriteAheadLog, RELATION, COUNTER
+from buffer import FailingBackend
+import os
+import tempfile
+import shutil
+
+
+class WriteAheadLogTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.path = tempfile.mkdtemp()
+        self.client = cassandra.CLIENT
+
+    def tearDown(self):
+        cassandra.CLIENT = self.client
+        shutil.rmtree(self.path)
+
+    def test_read(self):
+        wal = WriteAheadLog(self.path)
+        wal.append_relation("a" * 16, "b" * 16, "value")
+        wal.append_counter("c" * 16, "d" * 32, -3)
+        segment_id = wal.rotate()
+        records = list(wal.read([segment_id]))
+        self.assertEqual(records, [
+            (RELATION, "a" * 16, "b" * 16, "value"),
+            (COUNTER, "c" * 16, "d" * 32, -3)])
+
+    def test_replay_segments(self):
+        wal = WriteAheadLog(self.path)
+        wal.append_counter("c" * 16, "d" * 32, 1)
+        wal.rotate()
+        wal.append_counter("c" * 16, "d" * 32, 2)
+        wal.file.flush()
+        # A new process sees both segments as closed.
+        wal = WriteAheadLog(self.path)
+        segment_ids = wal.closed_segments()
+        self.assertEqual(len(segment_ids), 2)
+        values = [x[3] for x in wal.read(segment_ids)]
+        self.assertEqual(values, [1, 2])
+        wal.remove(segment_ids)
+        self.assertEqual(wal.closed_segments(), [])
+
+    def test_truncated_record(self):
+        wal = WriteAheadLog(self.path)
+        wal.append_counter("c" * 16, "d" * 32, 1)
+        wal.append_counter("c" * 16, "d" * 32, 2)
+        segment_id = wal.rotate()
+        segment_path = wal._segment_path(segment_id)
+        size = os.path.getsize(segment_path)
+        with open(segment_path, "r+b") as segment:
+            segment.truncate(size - 3)
+        values = [x[3] for x in wal.read([segment_id])]
+        self.assertEqual(values, [1])
+
+    @inlineCallbacks
+    def test_spill_replay(self):
+        cassandra.CLIENT = FailingBackend(UnavailableException, 2)
+        wal = WriteAheadLog(self.path)
+        buffer = Buffer(wal=wal)
+        buffer.insert_relation("a" * 16, "b" * 16, "value")
+        buffer.increment_counter("c" * 16, "d" * 32, 2)
+        yield buffer.flush()
+        self.assertEqual(
+            len(self.flushLoggedErrors(UnavailableException)),
+            2)
+        # Failed mutations are back in the buffer and the current segment,
+        # and the flushed segment is gone.
+        self.assertEqual(buffer.relation, {"a" * 16: {"b" * 16: "value"}})
+        self.assertEqual(buffer.counter["c" * 16], {"d" * 32: 2})
+        self.assertEqual(wal.closed_segments(), [])
+        buffer.delayed_flush.cancel()
+        wal.file.close()
+        # A new process replays the segment left behind.
+        cassandra.CLIENT = MemoryBackend()
+        wal = WriteAheadLog(self.path)
+        buffer = Buffer(wal=wal)
+        yield buffer.replay()
+        self.assertEqual(wal.closed_segments(), [])
+        self.assertEqual(
+            cassandra.CLIENT.data["relation"]["a" * 16].values,
+            {"b" * 16: "value"})
+        self.assertEqual(
+            cassandra.CLIENT.data["counter"]["c" * 16].values,
+            {"d" * 32: 2})
+        self.assertEqual(buffer.size, 0)
+
+    @inlineCallbacks
+    def test_timed_out_counter(self):
+        # The add may have been applied, so it is not logged again.
+        cassandra.CLIENT = FailingBackend(TimedOutException, 2)
+        buffer = Buffer(wal=WriteAheadLog(self.path))
+        buffer.insert_relation("a" * 16, "b" * 16, "value")
+        buffer.increment_counter("c" * 16, "d" * 32, 2)
+        yield buffer.flush()
+        self.assertEqual(len(self.flushLoggedErrors(TimedOutException)), 2)
+        self.assertEqual(buffer.relation, {"a" * 16: {"b" * 16: "value"}})
+        self.assertEqual(buffer.counter, {})
+        buffer.delayed_flush.cancel()
+        buffer.wal.file.close()